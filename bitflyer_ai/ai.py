@@ -1,15 +1,17 @@
 import datetime
-import math
 import os
-import time
 from logging import getLogger
 from pathlib import Path
 
+import bitflyer_api
+import clock
 import pandas as pd
-from bitflyer_api import (cancel_child_order, get_balance, get_child_orders,
-                          send_child_order)
-from line_messaging_api_client import LineMessagingAPIClient
-from manage import CHILD_ORDERS_DIR, REF_LOCAL
+from balance import BalanceLedger
+from ledger import OrderLedger
+from line_messaging_api_client import default_dispatcher
+from manage import CHILD_ORDERS_DIR, REF_LOCAL, USE_ORDER_STORE
+from order_store import ChildOrderStore
+from planner import ABOVE_START_PRICE, ACCEPTED, buy_inputs, plan_buys, plan_dca
 from utils import df_to_csv, path_exists, read_csv, rm_file
 
 if not REF_LOCAL:
@@ -18,6 +20,13 @@ if not REF_LOCAL:
 
 logger = getLogger(__name__)
 
+# short_termの各サイクルで参照する集計期間
+SHORT_TERM_WINDOWS = {
+    'hourly': '12h',
+    'daily': '1d',
+    'weekly': '1w',
+}
+
 
 class AI:
     """自動売買システムのアルゴリズム
@@ -37,7 +46,10 @@ class AI:
                  time_diff=9,
                  region='Asia/Tokyo',
                  bucket_name='',
-                 line_notify=LineMessagingAPIClient()):
+                 line_notify=None,
+                 inference_hook=None,
+                 exchange=bitflyer_api,
+                 current_datetime=None):
 
         self.product_code = product_code
         self.min_size = min_size
@@ -45,8 +57,14 @@ class AI:
         self.min_reward_rate = min_reward_rate
         self.min_local_price_gap_rate = min_local_price_gap_rate
 
-        self.df_balance = get_balance()
-        self.df_balance = self.df_balance.set_index('currency_code', drop=True)
+        # 注文・残高の取得先(バックテストではbacktest.SimulatedExchangeに置き換える)
+        self.exchange = exchange
+        self.currency_code = product_code.split('_')[0]
+
+        # 残高は注文の状態の変化から更新し、get_balanceとは一定間隔でのみ照合する
+        self.balance = BalanceLedger(
+            reconcile_interval=datetime.timedelta(minutes=float(os.environ.get('BALANCE_RECONCILE_MINUTES', 60)))
+        )
 
         p_child_orders_dir = Path(CHILD_ORDERS_DIR)
         p_child_orders_dir = p_child_orders_dir.joinpath(self.product_code)
@@ -55,32 +73,45 @@ class AI:
             'short': p_child_orders_dir.joinpath('short_term.csv'),
             'dca': p_child_orders_dir.joinpath('dca.csv')
         }
-        self.child_orders = {
-            'long': pd.DataFrame(),
-            'short': pd.DataFrame(),
-            'dca': pd.DataFrame(),
+        self.ledgers = {
+            'long': OrderLedger(),
+            'short': OrderLedger(),
+            'dca': OrderLedger(),
         }
 
-        self.line_notify = line_notify
+        # 通知はまとめてバックグラウンドで送る(送信はlambda_function.tradingの最後にflushする)
+        self.line_notify = line_notify if line_notify is not None else default_dispatcher()
 
         self.latest_summary = latest_summary
 
-        for term in ['long', 'short', 'dca']:
-            if path_exists(self.p_child_orders_path[term]):
-                self.child_orders[term] = read_csv(
-                    str(self.p_child_orders_path[term])
-                )
+        # 注文履歴のデータベース。USE_ORDER_STORE=Falseの場合は従来通りtermごとのcsvを使う
+        self.order_store = None
+        # csvを使う場合に、次のcommitで書き込むterm
+        self.dirty_terms = set()
+        if USE_ORDER_STORE:
+            self.order_store = ChildOrderStore(self.product_code, region=region)
+            for term in ['long', 'short', 'dca']:
+                self.ledgers[term] = self.order_store.load_ledger(term)
+        else:
+            for term in ['long', 'short', 'dca']:
+                if path_exists(self.p_child_orders_path[term]):
+                    df = read_csv(
+                        str(self.p_child_orders_path[term])
+                    )
 
-                self.child_orders[term] = self.child_orders[term].set_index(
-                    'child_order_acceptance_id',
-                    drop=True,
-                )
+                    df = df.set_index(
+                        'child_order_acceptance_id',
+                        drop=True,
+                    )
 
-                self.child_orders[term]['child_order_date'] = pd.to_datetime(self.child_orders[term]['child_order_date'])
-                self.child_orders[term]['child_order_date'] = self.child_orders[term]['child_order_date'].dt.tz_convert(region)
+                    df['child_order_date'] = pd.to_datetime(df['child_order_date'])
+                    df['child_order_date'] = df['child_order_date'].dt.tz_convert(region)
+                    self.ledgers[term] = OrderLedger.from_frame(df)
 
+        if current_datetime is None:
+            current_datetime = clock.now()
         self.datetime_references = {
-            'now': datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=9))),
+            'now': current_datetime,
         }
         self.datetime_references['hourly'] = self.datetime_references['now'] - datetime.timedelta(hours=6)
 
@@ -100,27 +131,68 @@ class AI:
             'short': max_volume_short,
         }
 
+        # Trueの場合、各期間のトレンドが下降中は買わず、上昇中は売らない
+        self.use_trend_filter = int(os.environ.get('USE_TREND_FILTER', 0))
+
+        # predictor.InferenceHook。指定した場合、予測値を注文価格とトレンドの判定に使う
+        self.inference_hook = inference_hook
+        self.predictions = None
+        # (term, cycle) -> 買い注文の計画(_plan_buys)
+        self.buy_plans = None
+
         self.max_buy_prices_rate = {
             'long': float(os.environ.get('MAX_BUY_PRICE_RATE_IN_LONG')),
             'short': float(os.environ.get('MAX_BUY_PRICE_RATE_IN_SHORT')),
             'dca': float(os.environ.get('MAX_BUY_PRICE_RATE_IN_DCA')),
         }
 
-    def _delete_order(self, term, child_order_acceptance_id):
-        target_record = self.child_orders[term].loc[child_order_acceptance_id]
-        self.child_orders[term].drop(
-            index=[child_order_acceptance_id],
-            inplace=True
-        )
-        # csvファイルを更新
-        if len(self.child_orders[term]) == 0:
-            rm_file(self.p_child_orders_path[term])
-        else:
-            df_to_csv(str(self.p_child_orders_path[term]), self.child_orders[term], index=True)
+    @property
+    def child_orders(self):
+        """termごとの注文のDataFrame(calc_profit, calc_volumeなどの集計用)"""
+        return {term: ledger.to_frame() for term, ledger in self.ledgers.items()}
+
+    def _save_child_orders(self, term, records=(), deleted_ids=()):
+        if self.order_store is not None:
+            # 変更した注文のみを反映する(確定はcommitで行う)
+            self.order_store.upsert(term, records, columns=self.ledgers[term].columns)
+            self.order_store.delete(term, deleted_ids)
+            return
+        # csvファイルは注文の更新のたびではなく、commitでtermごとに1回だけ書き込む
+        self.dirty_terms.add(term)
 
-        logger.debug(f'{str(self.p_child_orders_path[term])} が更新されました。')
+    def _delete_order(self, term, child_order_acceptance_id):
+        target_record = self.ledgers[term].delete(child_order_acceptance_id)
+        self._save_child_orders(term, deleted_ids=[child_order_acceptance_id])
         return target_record
 
+    def commit(self):
+        """注文履歴と残高の変更を確定する(変更がなければ書き込まない)"""
+        if self.order_store is not None:
+            self.order_store.commit()
+        for term in sorted(self.dirty_terms):
+            if self.ledgers[term].empty:
+                if path_exists(self.p_child_orders_path[term]):
+                    rm_file(self.p_child_orders_path[term])
+            else:
+                df_to_csv(str(self.p_child_orders_path[term]), self.ledgers[term].to_frame(), index=True)
+            logger.debug(f'{str(self.p_child_orders_path[term])} が更新されました。')
+        self.dirty_terms = set()
+        self.balance.save()
+
+    def close(self):
+        if self.order_store is not None:
+            self.order_store.close()
+            self.order_store = None
+
+    def _available(self, currency_code):
+        """利用可能な残高(照合が必要な場合のみget_balanceを呼び出す)"""
+        if self.balance.needs_reconcile(self.datetime_references['now']):
+            # 照合の直前までの約定を反映しておかないと、照合後に同じ約定を二重に反映してしまう
+            for term in ['long', 'short', 'dca']:
+                self.update_child_orders(term=term)
+            self.balance.reconcile(self.exchange.get_balance(), self.datetime_references['now'])
+        return self.balance.available(currency_code)
+
     def load_latest_child_orders(self,
                                  term,
                                  child_order_cycle,
@@ -129,29 +201,34 @@ class AI:
         logger.debug(f'child_order_acceptance_id: {child_order_acceptance_id}')
         # get a child order from api
         child_orders_tmp = pd.DataFrame()
-        start_time = time.time()
+        start_time = clock.time()
         while child_orders_tmp.empty:
-            child_orders_tmp = get_child_orders(
+            child_orders_tmp = self.exchange.get_child_orders(
                 product_code=self.product_code,
                 region='Asia/Tokyo',
                 child_order_acceptance_id=child_order_acceptance_id
             )
-            if time.time() - start_time > 5:
+            if child_orders_tmp.empty:
+                # 取得できるまで0.25秒ごとに再取得する(SimulatedClockでは待たずに時刻が進む)
+                clock.sleep(0.25)
+            if clock.time() - start_time > 5:
                 logger.warning(f'{child_order_acceptance_id} はすでに存在しないため、ファイルから削除します。')
-                child_orders_tmp = self._delete_order(
+                deleted_record = self._delete_order(
                     term=term,
                     child_order_acceptance_id=child_order_acceptance_id
                 )
+                self.balance.apply(self.balance.order_effect(self.currency_code, deleted_record), {})
+                self.balance.invalidate('注文が手動で削除されました')
                 self.line_notify.notify(
                     "\n【注文が手動で削除されました】\n"
                     + f"term:\n{term}\n"
                     + f"child_order_cycle:\n{child_order_cycle}\n"
                     + f"child_order_acceptance_id:\n{child_order_acceptance_id}"
                 )
-                if child_orders_tmp['side'] == "SELL":
-                    child_order_acceptance_id = child_orders_tmp['related_child_order_acceptance_id']
+                if deleted_record.side == "SELL":
+                    child_order_acceptance_id = deleted_record.related_child_order_acceptance_id
                     related_child_order_acceptance_id = 'no_id'
-                    child_orders_tmp = get_child_orders(
+                    child_orders_tmp = self.exchange.get_child_orders(
                         product_code=self.product_code,
                         region='Asia/Tokyo',
                         child_order_acceptance_id=child_order_acceptance_id
@@ -159,66 +236,49 @@ class AI:
                 else:
                     return
 
-        child_orders_tmp['child_order_cycle'] = child_order_cycle
-        child_orders_tmp['related_child_order_acceptance_id'] = related_child_order_acceptance_id
-        child_orders_tmp['total_commission_yen'] = 0
-        child_orders_tmp['profit'] = 0
-        child_orders_tmp['volume'] = child_orders_tmp['price'] * child_orders_tmp['size']
-
-        if self.child_orders[term].empty:
-            self.child_orders[term] = child_orders_tmp
-        else:
-            self.child_orders[term].loc[child_order_acceptance_id] = child_orders_tmp.loc[child_order_acceptance_id]
-
-        if self.child_orders[term].at[child_order_acceptance_id,
-                                      'child_order_state'] == 'COMPLETED':
+        values = child_orders_tmp.loc[child_order_acceptance_id].to_dict()
+        values['child_order_cycle'] = child_order_cycle
+        values['related_child_order_acceptance_id'] = related_child_order_acceptance_id
+        values['total_commission_yen'] = 0
+        values['profit'] = 0
+        values['volume'] = values['price'] * values['size']
+        balance_before = self.balance.order_effect(
+            self.currency_code, self.ledgers[term].get(child_order_acceptance_id))
+        record = self.ledgers[term].upsert(child_order_acceptance_id, values)
+
+        if record.child_order_state == 'COMPLETED':
             # 取引手数料を算出
-            total_commission = self.child_orders[term].at[child_order_acceptance_id,
-                                                          'total_commission']
-            price = self.child_orders[term].at[child_order_acceptance_id, 'price']
-            self.child_orders[term].at[child_order_acceptance_id,
-                                       'total_commission_yen'] = price * total_commission
-
-            if self.child_orders[term].at[child_order_acceptance_id, 'related_child_order_acceptance_id'] == 'no_id' \
-                    or self.child_orders[term].at[child_order_acceptance_id, 'side'] == 'SELL':
+            record.total_commission_yen = record.price * record.total_commission
+
+            if record.related_child_order_acceptance_id == 'no_id' or record.side == 'SELL':
                 logger.info(
-                    f'[{self.product_code} {term} {child_order_cycle} {self.child_orders[term].at[child_order_acceptance_id, "side"]}  {child_order_acceptance_id}] 約定しました!'
+                    f'[{self.product_code} {term} {child_order_cycle} {record.side}  {child_order_acceptance_id}] 約定しました!'
                 )
                 self.line_notify.notify(
                     "\n【約定しました】\n"
                     + f"term:\n{term}\n"
                     + f"child_order_cycle:\n{child_order_cycle}\n"
-                    + f"order_price:\n{price}\n"
-                    + f"price_discount_rate:\n{round(price/self.latest_summary['BUY']['all']['price']['high'],3)}\n"
-                    + f"size:\n{self.child_orders[term].at[child_order_acceptance_id, 'size']}\n"
-                    + f"volume:\n{self.child_orders[term].at[child_order_acceptance_id, 'volume']}\n"
+                    + f"order_price:\n{record.price}\n"
+                    + f"price_discount_rate:\n{round(record.price/self.latest_summary['BUY']['all']['price']['high'],3)}\n"
+                    + f"size:\n{record.size}\n"
+                    + f"volume:\n{record.volume}\n"
                     + f"child_order_acceptance_id:\n{child_order_acceptance_id}"
                 )
 
-            if self.child_orders[term].at[child_order_acceptance_id, 'side'] == 'SELL':
-                sell_price = self.child_orders[term].at[child_order_acceptance_id, 'price']
-                sell_size = self.child_orders[term].at[child_order_acceptance_id, 'size']
-                sell_commission = self.child_orders[term].at[child_order_acceptance_id,
-                                                             'total_commission_yen']
+            if record.side == 'SELL':
+                buy_record = self.ledgers[term].get(related_child_order_acceptance_id)
 
-                buy_price = self.child_orders[term].at[related_child_order_acceptance_id, 'price']
-                buy_size = self.child_orders[term].at[related_child_order_acceptance_id, 'size']
-                buy_commission = self.child_orders[term].at[related_child_order_acceptance_id,
-                                                            'total_commission_yen']
-
-                profit = sell_price * sell_size - buy_price * buy_size
-                profit -= sell_commission + buy_commission
+                profit = record.price * record.size - buy_record.price * buy_record.size
+                profit -= record.total_commission_yen + buy_record.total_commission_yen
 
                 logger.info(f'[{self.product_code} {term} {child_order_cycle}] {profit}円の利益が発生しました。')
 
-                self.child_orders[term].at[child_order_acceptance_id, 'profit'] = profit
-                self.child_orders[term]['cumsum_profit'] = self.child_orders[term]['profit'].cumsum()
+                record.profit = profit
 
                 self.line_notify.notify(f"{profit}円の利益が発生しました")
 
-        # csvファイルを更新
-        df_to_csv(str(self.p_child_orders_path[term]), self.child_orders[term], index=True)
-        logger.debug(f'{str(self.p_child_orders_path[term])} が更新されました。')
+        self.balance.apply(balance_before, self.balance.order_effect(self.currency_code, record))
+        self._save_child_orders(term, records=[record])
 
     def update_child_orders(self,
                             term,
@@ -229,17 +289,13 @@ class AI:
         # --------------------------------
         # 既存の注文における約定状態を更新
         # --------------------------------
-        for child_order_acceptance_id_tmp in self.child_orders[term].index.tolist():
-            if self.child_orders[term].at[child_order_acceptance_id_tmp,
-                                          'child_order_state'] == 'ACTIVE':
-                self.load_latest_child_orders(
-                    term=term,
-                    child_order_cycle=self.child_orders[term].at[child_order_acceptance_id_tmp,
-                                                                 'child_order_cycle'],
-                    child_order_acceptance_id=child_order_acceptance_id_tmp,
-                    related_child_order_acceptance_id=self.child_orders[term].at[child_order_acceptance_id_tmp,
-                                                                                 'related_child_order_acceptance_id']
-                )
+        for record in self.ledgers[term].select(state='ACTIVE'):
+            self.load_latest_child_orders(
+                term=term,
+                child_order_cycle=record.child_order_cycle,
+                child_order_acceptance_id=record.child_order_acceptance_id,
+                related_child_order_acceptance_id=record.related_child_order_acceptance_id
+            )
         # --------------------------------
         # related_child_order_acceptance_idを指定して、注文情報を更新
         # --------------------------------
@@ -261,19 +317,21 @@ class AI:
         # ----------------------------------------------------------------
         # キャンセル処理
         # ----------------------------------------------------------------
-        response = cancel_child_order(
+        response = self.exchange.cancel_child_order(
             product_code=self.product_code,
             child_order_acceptance_id=child_order_acceptance_id
         )
         if response.status_code == 200:
-            self._delete_order(term, child_order_acceptance_id)
+            canceled_record = self._delete_order(term, child_order_acceptance_id)
+            self.balance.apply(
+                self.balance.order_effect(self.currency_code, canceled_record),
+                self.balance.order_effect(self.currency_code, canceled_record, state='CANCELED')
+            )
             print('================================================================')
             logger.info(
                 f'[{self.product_code} {term} {child_order_cycle}  {child_order_type} {child_order_acceptance_id}] のキャンセルに成功しました。'
             )
             print('================================================================')
-            self.df_balance = get_balance()
-            self.df_balance = self.df_balance.set_index('currency_code', drop=True)
         else:
             response_json = response.json()
             logger.error(response_json['error_message'])
@@ -286,129 +344,135 @@ class AI:
             )
             raise Exception("Cancel of buying order was failed")
 
-    def _buy(self, term, child_order_cycle, local_prices):
-        global_prices = self.latest_summary['BUY']['all']['price']
-        local_global_price_rate = local_prices['low'] / global_prices['high']
-        max_price_rate_th = 1 / 2
-
-        if 1 - local_global_price_rate > max_price_rate_th:
-            price_rate = 1
-        else:
-            price_rate = -4 * (1 - self.max_buy_prices_rate[term]) * (max_price_rate_th - local_global_price_rate) ** 2 + 1
-            # price_rate = 2 * (1 - self.max_buy_prices_rate[term]) * (max_price_rate_th - local_global_price_rate) + self.max_buy_prices_rate[term]
-            # price_rate = 4 * (1 - self.max_buy_prices_rate[term]) * (max_price_rate_th - local_global_price_rate) ** 2 + self.max_buy_prices_rate[term]
-
-        price = int(local_prices['low'] * price_rate)
-        if price >= global_prices['high'] * self.max_buy_prices_rate[term]:
-            logger.info(
-                f'[{self.product_code} {term} {child_order_cycle} {price}] 過去最高価格に近いため、購入できません。'
-            )
-            return
-        elif price <= self.latest_summary['BUY']['now']['price'] * 0.75:
-            logger.info(
-                f'[{self.product_code} {term} {child_order_cycle} {price}] 注文価格が低すぎるため、購入できません。'
-            )
-            return
-        elif price > local_prices['high'] * (1 - self.min_local_price_gap_rate):
-            logger.info(
-                f'[{self.product_code} {term} {child_order_cycle} {price} {local_prices["high"] * (1 - self.min_local_price_gap_rate)}] 注文価格が直近の最高価格と近すぎるため、購入できません。'
-            )
-            return
-        elif local_prices['high'] / local_prices['low'] < (1 + self.min_local_price_gap_rate):
+    def enabled_cycles(self):
+        """long_term, short_termで注文対象となる(term, cycle)の一覧"""
+        cycle_flags = {
+            'long': [('daily', 'LONG_DAILY', 0), ('weekly', 'LONG_WEEKLY', 1), ('monthly', 'LONG_MONTHLY', 0)],
+            'short': [('hourly', 'SHORT_HOURLY', 1), ('daily', 'SHORT_DAILY', 0), ('weekly', 'SHORT_WEEKLY', 0)],
+        }
+        combinations = []
+        for term, flags in cycle_flags.items():
+            if not int(os.environ.get(f'{self.product_code}_{term.upper()}', 0)):
+                continue
+            for child_order_cycle, env_name, default in flags:
+                if int(os.environ.get(env_name, default)):
+                    combinations.append((term, child_order_cycle))
+        return combinations
+
+    def _prediction(self, term, child_order_cycle):
+        """(term, cycle)の予測値を返す
+
+        最初の呼び出し時に有効な全ての(term, cycle)をまとめて推論する。
+        推論しない、またはタイムアウトした場合はNoneを返す。
+        """
+        if self.inference_hook is None:
+            return None
+        if self.predictions is None:
+            self.predictions = self.inference_hook.run(
+                self.product_code,
+                self.enabled_cycles(),
+                self.datetime_references['now']
+            ) or {}
+        return self.predictions.get((term, child_order_cycle))
+
+    def _plan_buys(self, term, child_order_cycle):
+        """(term, cycle)の買い注文の計画(price, size, 見送りの理由)を返す
+
+        最初の呼び出し時に、有効な全ての(term, cycle)の価格・量・価格の条件を
+        planner.plan_buysでまとめて計算する。
+        """
+        if self.buy_plans is None:
+            self.buy_plans = {}
+        if (term, child_order_cycle) not in self.buy_plans:
+            combinations = [
+                combination for combination in self.enabled_cycles() + [(term, child_order_cycle)]
+                if combination not in self.buy_plans
+            ]
+            combinations = list(dict.fromkeys(combinations))
+            predictions = [self._prediction(*combination) or {} for combination in combinations]
+            available_jpy = self._available('JPY')
+            plan = plan_buys(
+                **buy_inputs(self.latest_summary, combinations, use_trend_filter=self.use_trend_filter),
+                max_buy_price_rate=[self.max_buy_prices_rate[combination[0]] for combination in combinations],
+                min_volume=[self.min_volume[combination[0]] for combination in combinations],
+                max_volume=[self.max_volume[combination[0]] for combination in combinations],
+                min_size=self.min_size,
+                min_local_price_gap_rate=self.min_local_price_gap_rate,
+                available_jpy=available_jpy,
+                use_trend_filter=self.use_trend_filter,
+                buy_price_rate=[prediction.get('buy_price_rate', float('nan')) for prediction in predictions],
+                ret=[prediction.get('ret', float('nan')) for prediction in predictions],
+            )
+            for i, combination in enumerate(combinations):
+                self.buy_plans[combination] = {
+                    'price': int(plan.price[i]),
+                    'size': float(plan.size[i]),
+                    'volume': float(plan.volume[i]),
+                    'reason': int(plan.reason[i]),
+                    'message': plan.reject_message(i),
+                    'available_jpy': available_jpy,
+                }
+        return self.buy_plans[(term, child_order_cycle)]
+
+    def _buy(self, term, child_order_cycle):
+        plan = self._plan_buys(term, child_order_cycle)
+        if plan['available_jpy'] != self._available('JPY'):
+            # 計画後の注文・キャンセルで残高が変わっているため、現在の残高で量を計算し直す
+            del self.buy_plans[(term, child_order_cycle)]
+            plan = self._plan_buys(term, child_order_cycle)
+        price = plan['price']
+        size = plan['size']
+        if plan['reason'] != ACCEPTED:
             logger.info(
-                f'[{self.product_code} {term} {child_order_cycle} {price} {local_prices["high"] * (1 - self.min_local_price_gap_rate)}] 直近の最高価格と最低価格のギャップが小さすぎるため、購入できません。'
+                f'[{self.product_code} {term} {child_order_cycle} {price} {plan["volume"]}] {plan["message"]}'
             )
             return
 
-        # size_rate = 100 * (self.max_buy_prices_rate[term] - price / global_prices['high']) ** 2 + 1
-        # size = self.min_size[term] * size_rate
-
-        # volume_rate = 100 * (self.max_buy_prices_rate[term] - price / global_prices['high']) ** 2 + 1
-        # volume = self.min_volume[term] * volume_rate
+        self._execute_buy(term, child_order_cycle, price, size)
 
-        # if volume < self.min_volume[term]:
-        #     volume = self.min_volume[term]
-        # elif volume > self.max_volume[term]:
-        #     volume = self.max_volume[term]
-
-        # 最大volumeで注文する際の過去最大価格に対する注文価格の割合
-        max_volume_rate = 0.5
-
-        if (price / global_prices['high']) <= max_volume_rate:
-            volume = self.max_volume[term]
-        else:
-            volume = - ((self.max_volume[term] - self.min_volume[term]) / (self.max_buy_prices_rate[term] - max_volume_rate)) * \
-                ((price / global_prices['high']) - max_volume_rate) + self.max_volume[term]
-
-        if volume > self.df_balance.at['JPY', 'available']:
-            volume = int(self.df_balance.at['JPY', 'available'])
-
-        size = volume / price
-        sig_digits = 3
-        size = math.floor(size * 10 ** sig_digits) / (10 ** sig_digits)
-
-        if size < self.min_size:
-            size = self.min_size
-
-        if size * price > self.df_balance.at['JPY', 'available']:
-            logger.info(
-                f'[{self.product_code} {term} {child_order_cycle} {volume}] JPYが不足しているため新規の買い注文ができません。'
-            )
-            return
-
-        buy_active_same_price = pd.DataFrame()
-        target_buy_history = pd.DataFrame()
-        target_buy_history_active = pd.DataFrame()
-        target_buy_history_completed = pd.DataFrame()
-        same_category_buy_order = pd.DataFrame()
+    def _execute_buy(self, term, child_order_cycle, price, size):
+        """計画した買い注文を、注文履歴と照らし合わせて発注する(必要な場合は既存の注文をキャンセルする)"""
+        ledger = self.ledgers[term]
         target_datetime = self.datetime_references[child_order_cycle]
-        if not self.child_orders[term].empty:
-            buy_active_same_price = self.child_orders[term].query(
-                'side == "BUY" and child_order_state == "ACTIVE" and price == @price and size == @size'
-            )
-            not_saled_buy_order = self.child_orders[term].query(
-                'side == "BUY" and child_order_state == "COMPLETED" and related_child_order_acceptance_id == "no_id"'
-            )
-            target_buy_history = self.child_orders[term].query(
-                'side == "BUY" and child_order_date > @target_datetime and child_order_cycle == @child_order_cycle'
-            )
-            target_buy_history_active = target_buy_history.query(
-                'child_order_state == "ACTIVE"'
-            )
-            target_buy_history_completed = target_buy_history.query(
-                'child_order_state == "COMPLETED"'
-            )
-            same_category_buy_order = self.child_orders[term].query(
-                'side == "BUY" and child_order_state == "ACTIVE" and child_order_cycle == @child_order_cycle'
-            ).copy()
-            same_category_sell_order = self.child_orders[term].query(
-                'side == "SELL" and child_order_state == "ACTIVE" and child_order_cycle == @child_order_cycle'
-            ).copy()
-
-        if not buy_active_same_price.empty:
+        buy_active_same_price = [
+            record for record in ledger.select(side='BUY', state='ACTIVE')
+            if record.price == price and record.size == size
+        ]
+        not_saled_buy_order = ledger.select(side='BUY', state='COMPLETED', related='no_id')
+        target_buy_history = ledger.since(target_datetime, side='BUY', cycle=child_order_cycle)
+        target_buy_history_active = [
+            record for record in target_buy_history if record.child_order_state == 'ACTIVE'
+        ]
+        target_buy_history_completed = [
+            record for record in target_buy_history if record.child_order_state == 'COMPLETED'
+        ]
+        same_category_buy_order = ledger.select(side='BUY', state='ACTIVE', cycle=child_order_cycle)
+        same_category_sell_order = ledger.select(side='SELL', state='ACTIVE', cycle=child_order_cycle)
+
+        if len(buy_active_same_price) > 0:
             logger.info(
                 f'[{self.product_code} {term} {child_order_cycle}] 同じ価格かつ同じサイズでの注文がすでにあるため、購入できません。'
             )
             return
 
-        if not not_saled_buy_order.empty and term == 'short':
+        if len(not_saled_buy_order) > 0 and term == 'short':
             logger.info(
                 f'[{self.product_code} {term} {child_order_cycle}] 以前の買い注文に対する売り注文が完了していないため、新規の買い注文はできません。'
             )
             return
 
-        if not target_buy_history_completed.empty:
+        if len(target_buy_history_completed) > 0:
             logger.info(
                 f'[{self.product_code} {term} {child_order_cycle}] 約定済みの注文から十分な時間が経過していないため、新規の買い注文はできません。'
             )
             return
 
-        if not same_category_sell_order.empty:
+        if len(same_category_sell_order) > 0:
             logger.info(
                 f'[{self.product_code} {term} {child_order_cycle}] 同じサイクルを持つACTIVEな売り注文が存在するため、新規の買い注文はできません。'
             )
             return
-        elif same_category_buy_order.empty:
+        elif len(same_category_buy_order) == 0:
             logger.info(
                 f'[{self.product_code} {term} {child_order_cycle}] 同じサイクルを持つACTIVEな買い注文が存在しないため、買い注文を行います。'
             )
@@ -417,19 +481,19 @@ class AI:
                 logger.error(
                     f'[{term} {child_order_cycle}]同じサイクルを持つACTIVEな買い注文が2つ以上あります。'
                 )
-            if target_buy_history_active.empty:
+            if len(target_buy_history_active) == 0:
                 logger.info(
-                    f'[{self.product_code} {term} {child_order_cycle} {same_category_buy_order.index[0]}] 前回の注文からサイクル時間以上の間約定しなかったため、買い注文を更新します。'
+                    f'[{self.product_code} {term} {child_order_cycle} {same_category_buy_order[0].child_order_acceptance_id}] 前回の注文からサイクル時間以上の間約定しなかったため、買い注文を更新します。'
                 )
                 self.line_notify.notify(
                     f"\n【{self.product_code} の買い注文をキャンセルしました】\n"
                     + "reason:\n前回の注文からサイクル時間以上の間約定しなかったため\n"
                     + f"term:\n{term}\n"
                     + f"child_order_cycle:\n{child_order_cycle}\n"
-                    + f"child_order_acceptance_id:\n{same_category_buy_order.index[0]}"
+                    + f"child_order_acceptance_id:\n{same_category_buy_order[0].child_order_acceptance_id}"
                 )
             else:
-                if price == same_category_buy_order['price'].values[0]:
+                if price == same_category_buy_order[0].price:
                     logger.info(
                         f'[{self.product_code} {term} {child_order_cycle}] すでに注文済みのため、購入できません。'
                     )
@@ -443,22 +507,22 @@ class AI:
                         + "reason:\n適正注文価格が変動したため\n"
                         + f"term:\n{term}\n"
                         + f"child_order_cycle:\n{child_order_cycle}\n"
-                        + f"child_order_acceptance_id:\n{same_category_buy_order.index[0]}"
+                        + f"child_order_acceptance_id:\n{same_category_buy_order[0].child_order_acceptance_id}"
                     )
 
             logger.info(
-                f'[{self.product_code} {term} {child_order_cycle} {same_category_buy_order["price"].values[0]} {same_category_buy_order["size"].values[0]}] 買い注文をキャンセルします。'
+                f'[{self.product_code} {term} {child_order_cycle} {same_category_buy_order[0].price} {same_category_buy_order[0].size}] 買い注文をキャンセルします。'
             )
             self._cancel(
                 term=term,
                 child_order_cycle=child_order_cycle,
-                child_order_acceptance_id=same_category_buy_order.index[0],
+                child_order_acceptance_id=same_category_buy_order[0].child_order_acceptance_id,
                 child_order_type='buy'
             )
         # ----------------------------------------------------------------
         # 買い注文
         # ----------------------------------------------------------------
-        response = send_child_order(
+        response = self.exchange.send_child_order(
             self.product_code, 'LIMIT', 'BUY', price=price, size=size
         )
         response_json = response.json()
@@ -487,6 +551,7 @@ class AI:
         else:
             response_json = response.json()
             logger.error(response_json['error_message'])
+            self.balance.invalidate('買い注文が拒否されました')
             self.line_notify.notify(
                 f"\n【{self.product_code} の買い注文に失敗しました】\n"
                 + f"reason:\n{response_json['error_message']}\n"
@@ -494,16 +559,35 @@ class AI:
                 + f"child_order_cycle:\n{child_order_cycle}"
             )
 
-    def _sell(self, term, child_order_cycle, price):
-        if self.child_orders[term].empty:
+    def _trend(self, side, window):
+        """トレンドによる判定を行う場合のみ、期間windowのトレンドを求める(指標の更新を伴うため)"""
+        if not self.use_trend_filter:
+            return None
+        return self.latest_summary[side][window]['trend']
+
+    def _sell(self, term, child_order_cycle, price, trend=None):
+        prediction = self._prediction(term, child_order_cycle)
+        if prediction is not None:
+            if 'ret' in prediction:
+                trend = 'UP' if prediction['ret'] > 0 else 'DOWN'
+            if 'sell_price_rate' in prediction:
+                price = int(price * min(max(prediction['sell_price_rate'], 1.0), 1.1))
+
+        if self.use_trend_filter and trend == 'UP':
+            logger.info(
+                f'[{self.product_code} {term} {child_order_cycle}] 上昇トレンド中のため、売り注文を見送ります。'
+            )
+            return
+
+        if self.ledgers[term].empty:
             logger.info(
                 f'[{self.product_code} {term} {child_order_cycle}] 買い注文がないため、売り注文はできません。'
             )
             return
 
-        related_buy_order = self.child_orders[term].query(
-            'side=="BUY" and child_order_state == "COMPLETED" and child_order_cycle == @child_order_cycle and related_child_order_acceptance_id == "no_id"').copy()
-        if related_buy_order.empty:
+        related_buy_order = self.ledgers[term].select(
+            side='BUY', state='COMPLETED', cycle=child_order_cycle, related='no_id')
+        if len(related_buy_order) == 0:
             logger.info(
                 f'[{self.product_code} {term} {child_order_cycle}] 約定済みの買い注文がないため、売り注文はできません。'
             )
@@ -512,18 +596,18 @@ class AI:
                 logger.warning(
                     f'[{self.product_code} {term} {child_order_cycle}] 同じフラグを持つ約定済みの買い注文が2つ以上あります。'
                 )
-            for i in range(len(related_buy_order)):
-                # price = int(int(related_buy_order['price'].values[i]) * rate)
+            for buy_record in related_buy_order:
+                # price = int(int(buy_record.price) * rate)
                 # if price < self.latest_summary['SELL']['6h']['price']['high']:
                 #     price = self.latest_summary['SELL']['6h']['price']['high']
-                if price <= related_buy_order['price'].values[i] * (1 + self.min_reward_rate):
+                if price <= buy_record.price * (1 + self.min_reward_rate):
                     logger.info(
-                        f'[{self.product_code} {term} {child_order_cycle} {price} {related_buy_order["price"]}] 売値が買値よりも低いため、売り注文はできません。'
+                        f'[{self.product_code} {term} {child_order_cycle} {price} {buy_record.price}] 売値が買値よりも低いため、売り注文はできません。'
                     )
                     continue
-                size = round(float(related_buy_order['size'].values[i]), 3)
-                response = send_child_order(self.product_code, 'LIMIT', 'SELL',
-                                            price=price, size=size)
+                size = round(float(buy_record.size), 3)
+                response = self.exchange.send_child_order(self.product_code, 'LIMIT', 'SELL',
+                                                          price=price, size=size)
                 if response.status_code == 200:
                     response_json = response.json()
                     print('================================================================')
@@ -536,14 +620,14 @@ class AI:
                     self.update_child_orders(
                         term=term,
                         child_order_cycle=child_order_cycle,
-                        related_child_order_acceptance_id=related_buy_order.index[i],
+                        related_child_order_acceptance_id=buy_record.child_order_acceptance_id,
                         child_order_acceptance_id=response_json['child_order_acceptance_id'],
                     )
                     self.update_child_orders(
                         term=term,
                         child_order_cycle=child_order_cycle,
                         related_child_order_acceptance_id=response_json['child_order_acceptance_id'],
-                        child_order_acceptance_id=related_buy_order.index[i],
+                        child_order_acceptance_id=buy_record.child_order_acceptance_id,
                     )
                     self.line_notify.notify(
                         f"\n{self.product_code}の売り注文を行いました\n"
@@ -558,28 +642,28 @@ class AI:
                 else:
                     response_json = response.json()
                     logger.error(response_json['error_message'])
+                    self.balance.invalidate('売り注文が拒否されました')
                     self.line_notify.notify(
                         f"\n【{self.product_code} の売り注文に失敗しました】\n"
                         + f"reason:\n{response_json['error_message']}\n"
                         + f"term:\n{term}\n"
                         + f"child_order_cycle:\n{child_order_cycle}\n"
-                        + f"related_child_order_acceptance_id:\n{related_buy_order.index[i]}"
+                        + f"related_child_order_acceptance_id:\n{buy_record.child_order_acceptance_id}"
                     )
 
     def update_unrealized_profit(self, term):
-        if not self.child_orders[term].empty:
-            self.child_orders[term]['profit'] = self.child_orders[term]['size'] \
-                * (self.latest_summary['BUY']['now']['price'] - self.child_orders[term]['price']) \
-                - self.child_orders[term]['total_commission_yen']
-
-            self.child_orders[term].loc[self.child_orders[term]
-                                        ['child_order_state'] == 'ACTIVE', 'profit'] = 0
-
-            self.child_orders[term]['cumsum_profit'] = self.child_orders[term]['profit'].cumsum()
+        if not self.ledgers[term].empty:
+            now_price = self.latest_summary['BUY']['now']['price']
+            for record in self.ledgers[term]:
+                if record.child_order_state == 'ACTIVE':
+                    record.profit = 0
+                else:
+                    record.profit = record.size * (now_price - record.price) - record.total_commission_yen
 
-            # csvファイルを更新
-            df_to_csv(str(self.p_child_orders_path[term]), self.child_orders[term], index=True)
-            logger.debug(f'{str(self.p_child_orders_path[term])} が更新されました。')
+            if self.order_store is not None:
+                self.order_store.update_unrealized_profit(term, now_price)
+            else:
+                self._save_child_orders(term)
 
     def long_term(self):
         # 最新情報を取得
@@ -589,24 +673,21 @@ class AI:
             # daily
             self._buy(
                 term='long',
-                child_order_cycle='daily',
-                local_prices=self.latest_summary['BUY']['1d']['price']
+                child_order_cycle='daily'
             )
 
         if int(os.environ.get('LONG_WEEKLY', 1)):
             # weekly
             self._buy(
                 term='long',
-                child_order_cycle='weekly',
-                local_prices=self.latest_summary['BUY']['1w']['price']
+                child_order_cycle='weekly'
             )
 
         if int(os.environ.get('LONG_MONTHLY', 0)):
             # monthly
             self._buy(
                 term='long',
-                child_order_cycle='monthly',
-                local_prices=self.latest_summary['BUY']['1m']['price']
+                child_order_cycle='monthly'
             )
 
     def short_term(self):
@@ -618,46 +699,59 @@ class AI:
             # hourly
             self._buy(
                 term='short',
-                child_order_cycle='hourly',
-                local_prices=self.latest_summary['BUY']['12h']['price']
+                child_order_cycle='hourly'
             )
 
             self._sell(
                 term='short',
                 child_order_cycle='hourly',
                 # rate=float(os.environ.get('SELL_RATE_SHORT_HOURLY', 1.10)),
-                price=self.latest_summary['SELL']['12h']['price']['high']
+                price=self.latest_summary['SELL']['12h']['price']['high'],
+                trend=self._trend('SELL', '12h')
             )
 
         if int(os.environ.get('SHORT_DAILY', 0)):
             # daily
             self._buy(
                 term='short',
-                child_order_cycle='daily',
-                local_prices=self.latest_summary['BUY']['1d']['price']
+                child_order_cycle='daily'
             )
 
             self._sell(
                 term='short',
                 child_order_cycle='daily',
                 # rate=float(os.environ.get('SELL_RATE_SHORT_DAILY', 1.10)),
-                price=self.latest_summary['SELL']['1d']['price']['high']
+                price=self.latest_summary['SELL']['1d']['price']['high'],
+                trend=self._trend('SELL', '1d')
             )
 
         if int(os.environ.get('SHORT_WEEKLY', 0)):
             # weekly
             self._buy(
                 term='short',
-                child_order_cycle='weekly',
-                local_prices=self.latest_summary['BUY']['1w']['price']
+                child_order_cycle='weekly'
             )
             self._sell(
                 term='short',
                 child_order_cycle='weekly',
                 # rate=float(os.environ.get('SELL_RATE_SHORT_WEEKLY', 1.10)),
-                price=self.latest_summary['SELL']['1w']['price']['high']
+                price=self.latest_summary['SELL']['1w']['price']['high'],
+                trend=self._trend('SELL', '1w')
             )
 
+    def sell_filled(self, child_order_cycle):
+        """short_termの買い注文が約定した直後に、short_termと同じ価格で売り注文を出す
+
+        realtime.OrderEventSubscriberが約定イベントを受け取った際に呼び出す。
+        """
+        window = SHORT_TERM_WINDOWS[child_order_cycle]
+        self._sell(
+            term='short',
+            child_order_cycle=child_order_cycle,
+            price=self.latest_summary['SELL'][window]['price']['high'],
+            trend=self._trend('SELL', window)
+        )
+
     def dca(self, min_volume, max_volume, st_buy_price_rate=1, price_rate=1, cycle='monthly'):
         """フレキシブルドルコスト平均法(Flexible Dollar Cost Averaging)による積立投資
 
@@ -670,51 +764,37 @@ class AI:
         # 最新情報を取得
         self.update_child_orders(term='dca')
 
-        price = int(self.latest_summary['BUY']['now']['price'] * price_rate)
+        plan = plan_dca(
+            now_price=self.latest_summary['BUY']['now']['price'],
+            global_high=self.latest_summary['BUY']['all']['price']['high'],
+            min_volume=min_volume,
+            max_volume=max_volume,
+            min_size=self.min_size,
+            max_buy_price_rate=self.max_buy_prices_rate['dca'],
+            available_jpy=self._available('JPY'),
+            st_buy_price_rate=st_buy_price_rate,
+            price_rate=price_rate,
+        )
+        price = int(plan.price[0])
+        size = float(plan.size[0])
+        volume = float(plan.volume[0])
 
-        if price > self.latest_summary['BUY']['all']['price']['high'] * st_buy_price_rate:
+        if plan.reason[0] == ABOVE_START_PRICE:
             logger.info(
                 f"[{self.product_code} DCA {cycle} {price} {self.latest_summary['BUY']['all']['price']['high'] * st_buy_price_rate}] 注文価格が過去最高価格の{st_buy_price_rate}倍以上であるため注文できません。"
             )
             return
 
-        if min_volume < self.latest_summary['BUY']['now']['price'] * self.min_size:
-            min_volume = int(self.latest_summary['BUY']['now']['price'] * self.min_size)
-
-        if max_volume < min_volume:
-            max_volume = min_volume
-
-        current_price_discount_rate = price / self.latest_summary['BUY']['all']['price']['high']
-
-        # x = current_price_discount_rate
-        # coef = (max_volume - min_volume) / (1 - self.max_buy_prices_rate['dca'])**2
-        # volume = coef * (1 - current_price_discount_rate)**2 + min_volume
-        #        = (max_volume - min_volume) / (1 - self.max_buy_prices_rate['dca'])**2 * (1 - current_price_discount_rate)**2 + min_volume
-
-        x = current_price_discount_rate
-        coef = (max_volume - min_volume) / (self.max_buy_prices_rate['dca'] - st_buy_price_rate)**2
-        volume = coef * (x - st_buy_price_rate)**2 + min_volume
-
-        if volume > max_volume:
-            volume = max_volume
-
-        size = volume / price
-        sig_digits = 3
-        size = math.floor(size * 10 ** sig_digits) / (10 ** sig_digits)
-
-        if size < self.min_size:
-            size = self.min_size
-
-        if not self.child_orders['dca'].empty:
+        if not self.ledgers['dca'].empty:
             target_date = self.datetime_references[cycle]
-            latest_trade_date = self.child_orders['dca'].query('child_order_date > @target_date')
+            latest_trade_date = self.ledgers['dca'].since(target_date)
             if len(latest_trade_date) == 1:
                 logger.info(
                     f'[{self.product_code} DCA {cycle}] すでに注文済みです。'
                 )
                 return
 
-        if size * price > self.df_balance.at['JPY', 'available']:
+        if plan.reason[0] != ACCEPTED:
             logger.info(
                 f'[{self.product_code} DCA {cycle} {volume}] JPYが不足しているため新規の買い注文ができません。'
             )
@@ -723,7 +803,7 @@ class AI:
         # ----------------------------------------------------------------
         # 買い注文
         # ----------------------------------------------------------------
-        response = send_child_order(
+        response = self.exchange.send_child_order(
             self.product_code, 'LIMIT', 'BUY', price=price, size=size
         )
         response_json = response.json()
@@ -1,6 +1,6 @@
+import hashlib
 import os
 from base64 import b64decode
-from io import StringIO
 from logging import getLogger
 
 import boto3
@@ -19,24 +19,132 @@ class S3:
         self.resource = boto3.resource('s3')
         self.bucket = self.resource.Bucket(BUCKET_NAME)
 
-    def read_csv(self, object_key):
-        # objkey = container_name + '/' + filename + '.csv'  # 多分普通のパス
+        # 最後に読み書きしたオブジェクトのETag(単一PUTではmd5と一致する)
+        self.etags = {}
+        self.write_stats = {
+            'put_count': 0,
+            'put_bytes': 0,
+            'skipped_put_count': 0,
+            'skipped_put_bytes': 0,
+        }
+
+    def _remember_etag(self, object_key, etag):
+        if etag:
+            self.etags[object_key] = etag.strip('"')
+
+    def read_csv(self, object_key, usecols=None, chunksize=None):
+        """S3上のcsvを読み込む
+
+        StreamingBodyをそのままパーサに渡すため、bytes -> str -> StringIO
+        のような中間コピーを作らない。
+
+        Args:
+            object_key (str): 読み込むオブジェクトのキー
+            usecols (list, optional): 読み込む列名。Noneの場合は全列。
+            chunksize (int, optional): 指定した場合は、chunksize行ずつの
+                DataFrameを返すイテレータを返す。
+
+        Returns:
+            pd.DataFrame or pd.io.parsers.TextFileReader
+        """
         obj = self.client.get_object(Bucket=BUCKET_NAME, Key=object_key)
-        body = obj['Body'].read()
-        bodystr = body.decode('utf-8')
-        df = pd.read_csv(StringIO(bodystr))
-        return df
+        self._remember_etag(object_key, obj.get('ETag'))
+        return pd.read_csv(
+            obj['Body'],
+            usecols=usecols,
+            chunksize=chunksize,
+            encoding='utf-8'
+        )
+
+    def download(self, object_key, local_path, if_none_match=None):
+        """オブジェクトをローカルファイルへストリーミングで保存する
+
+        Args:
+            object_key (str): ダウンロードするオブジェクトのキー
+            local_path (str): 保存先のローカルパス
+            if_none_match (str, optional): 指定したETagと一致する場合は
+                本文を転送しない。
+
+        Returns:
+            str or None: 新しいETag。変更がなかった場合はNone。
+        """
+        get_kwargs = {'Bucket': BUCKET_NAME, 'Key': object_key}
+        if if_none_match is not None:
+            get_kwargs['IfNoneMatch'] = f'"{if_none_match}"'
+        try:
+            obj = self.client.get_object(**get_kwargs)
+        except ClientError as e:
+            if e.response.get('ResponseMetadata', {}).get('HTTPStatusCode') == 304:
+                return None
+            raise
+
+        with open(local_path, 'wb') as f:
+            for chunk in obj['Body'].iter_chunks(1024 * 1024):
+                f.write(chunk)
+        self._remember_etag(object_key, obj.get('ETag'))
+        return self.etags[object_key]
+
+    def iter_csv(self, object_key, chunksize=100000, usecols=None):
+        """S3上のcsvをchunksize行ずつ読み込むジェネレータ"""
+        reader = self.read_csv(
+            object_key,
+            usecols=usecols,
+            chunksize=chunksize
+        )
+        with reader:
+            for df_chunk in reader:
+                yield df_chunk
 
     def to_csv(self, object_key, df, index):
-        df_csv = df.to_csv(index=index)
-        new_object = self.bucket.Object(object_key)
-        new_object.put(Body=df_csv)
+        """DataFrameをcsvとしてS3に保存する
+
+        内容のmd5が既存オブジェクトのETagと一致する場合はPUTを省略する。
+
+        Args:
+            object_key (str): 保存先のキー
+            df (pd.DataFrame): 保存するデータ
+            index (bool): indexを保存するかどうか
+
+        Returns:
+            bool: PUTを行った場合はTrue、省略した場合はFalse
+        """
+        body = df.to_csv(index=index).encode('utf-8')
+        return self.put_bytes(object_key, body)
+
+    def put_bytes(self, object_key, body):
+        content_hash = hashlib.md5(body).hexdigest()
+
+        if self.etags.get(object_key, content_hash) == content_hash:
+            # 記憶しているETagはウォームコンテナで古くなっている可能性があるため、
+            # 省略できそうな場合はHEAD(PUTよりも安価)で現在のETagを確認する
+            self.key_exists(object_key)
+
+        if self.etags.get(object_key) == content_hash:
+            self.write_stats['skipped_put_count'] += 1
+            self.write_stats['skipped_put_bytes'] += len(body)
+            logger.debug(f'[{object_key}] 内容が変更されていないため、アップロードを省略しました。')
+            return False
+
+        response = self.client.put_object(Bucket=BUCKET_NAME, Key=object_key, Body=body)
+        self._remember_etag(object_key, response.get('ETag'))
+        self.write_stats['put_count'] += 1
+        self.write_stats['put_bytes'] += len(body)
+        return True
+
+    def report_write_stats(self):
+        logger.info(
+            f'[S3] PUT: {self.write_stats["put_count"]}回 {self.write_stats["put_bytes"]}B, '
+            + f'省略したPUT: {self.write_stats["skipped_put_count"]}回 {self.write_stats["skipped_put_bytes"]}B'
+        )
+        return dict(self.write_stats)
 
     def key_exists(self, object_key):
         try:
-            self.client.head_object(Bucket=BUCKET_NAME, Key=object_key)
+            response = self.client.head_object(Bucket=BUCKET_NAME, Key=object_key)
+            self._remember_etag(object_key, response.get('ETag'))
             return True
         except ClientError:
+            self.etags.pop(object_key, None)
             return False
 
     def listdir(self, object_key):
@@ -50,28 +158,55 @@ class S3:
         ]
         return result
 
+    def list_keys(self, prefix):
+        """prefix以下の全てのオブジェクトキーを返す(1000件ごとのページングに対応)"""
+        paginator = self.client.get_paginator('list_objects_v2')
+        keys = []
+        for page in paginator.paginate(Bucket=BUCKET_NAME, Prefix=prefix):
+            keys += [obj['Key'] for obj in page.get('Contents', [])]
+        return keys
+
+    def delete_keys(self, keys):
+        """オブジェクトを一括削除する
+
+        delete_objectsは1回の呼び出しで1000件までしか削除できないため分割する。
+
+        Returns:
+            int: 削除に成功したオブジェクト数
+        """
+        deleted_count = 0
+        for i in range(0, len(keys), 1000):
+            objects = [{'Key': key} for key in keys[i:i + 1000]]
+            response = self.client.delete_objects(
+                Bucket=BUCKET_NAME,
+                Delete={
+                    'Objects': objects,
+                    'Quiet': True
+                }
+            )
+            for error in response.get('Errors', []):
+                logger.warning(f'[{error["Key"]}] 削除に失敗しました。{error.get("Message", "")}')
+            deleted_count += len(objects) - len(response.get('Errors', []))
+        for key in keys:
+            self.etags.pop(key, None)
+        return deleted_count
+
     def delete_dir(self, dirpath):
-        objects_collection = self.bucket.objects.filter(
-            Prefix=dirpath
-        )
-        objects = []
-        for obj in objects_collection:
-            objects.append({'Key': obj.key})
+        keys = self.list_keys(dirpath)
 
-        if objects == []:
+        if keys == []:
             logger.debug(f'{dirpath} はすでに存在しません。')
+            return 0
+
+        deleted_count = self.delete_keys(keys)
+        if deleted_count == len(keys):
+            logger.debug(f'[{dirpath}] ディレクトリの削除に成功しました。')
         else:
-            response = self.bucket.delete_objects(
-                Delete={
-                    "Objects": objects
-                }
-            )
-            if response['ResponseMetadata']['HTTPStatusCode'] == 200:
-                logger.debug(f'[{dirpath}] ディレクトリの削除に成功しました。')
-            else:
-                logger.warning(f'[{dirpath}] ディレクトリの削除に失敗しました。')
+            logger.warning(f'[{dirpath}] ディレクトリの削除に失敗しました。')
+        return deleted_count
 
     def delete_file(self, object_key):
+        self.etags.pop(object_key, None)
         try:
             self.client.delete_object(Bucket=BUCKET_NAME, Key=object_key)
         except ClientError:
@@ -0,0 +1,583 @@
+import datetime
+import os
+from contextlib import contextmanager
+from logging import getLogger
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from ai import AI
+from balance import balance_ledger_path
+from indicators import TREND_SPECS
+from manage import CHILD_ORDERS_DIR
+from order_store import order_store_delta_dir, order_store_path
+from panel import load_panel
+from utils import rm_dir, storage_overlay
+
+logger = getLogger(__name__)
+
+MINUTE_NS = 60 * 10 ** 9
+DAY_MINUTES = 24 * 60
+
+# 最小注文数量の既定値(bitFlyerのBTC_JPYの最小注文数量)
+DEFAULT_MIN_SIZE = 0.001
+
+# indicators.TREND_SPECSの間隔 -> 1分足の本数
+FREQ_MINUTES = {
+    '10m': 10,
+    '1h': 60,
+    '1d': DAY_MINUTES,
+}
+
+
+class NullNotifier:
+    """バックテスト中は通知を送らない"""
+
+    def notify(self, message='message'):
+        logger.debug(message)
+
+    def flush(self, timeout=None):
+        return True
+
+
+class SimulatedResponse:
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self.body = body
+
+    def json(self):
+        return self.body
+
+
+class SimulatedExchange:
+    """bitflyer_apiの注文・残高関数と同じ形で応答する取引所のシミュレータ
+
+    LIMIT注文は、注文後の1分足で約定価格が指値に達した時点(買いは安値 <= 指値、
+    売りは高値 >= 指値)で、指値で全量約定したものとする。
+    約定判定は注文ごとに1分足の配列をnumpyで走査し、DataFrameは使わない。
+    """
+
+    def __init__(self, product_code, initial_jpy, initial_coin=0.0, commission_rate=0.0015):
+        self.product_code = product_code
+        self.currency = product_code.split('_')[0]
+        self.commission_rate = commission_rate
+        self.balances = {'JPY': float(initial_jpy), self.currency: float(initial_coin)}
+        self.orders = {}
+        self.active_ids = []
+        self.current_datetime = None
+        self.sequence = 0
+
+    def _reserved(self):
+        reserved = {'JPY': 0.0, self.currency: 0.0}
+        for child_order_acceptance_id in self.active_ids:
+            order = self.orders[child_order_acceptance_id]
+            if order['side'] == 'BUY':
+                reserved['JPY'] += order['price'] * order['size']
+            else:
+                reserved[self.currency] += order['size']
+        return reserved
+
+    def get_board_state(self, product_code):
+        return {'health': 'NORMAL', 'state': 'RUNNING'}
+
+    def get_balance(self):
+        reserved = self._reserved()
+        return pd.DataFrame([
+            {
+                'currency_code': currency_code,
+                'amount': amount,
+                'available': amount - reserved[currency_code],
+            }
+            for currency_code, amount in self.balances.items()
+        ])
+
+    def send_child_order(self, product_code, child_order_type, side, price, size,
+                         minute_to_expire=43200, time_in_force='GTC'):
+        available = self.get_balance().set_index('currency_code')['available']
+        if side == 'BUY' and price * size > available['JPY']:
+            return SimulatedResponse(400, {'status': -200, 'error_message': 'Insufficient funds'})
+        if side == 'SELL' and size > available[self.currency]:
+            return SimulatedResponse(400, {'status': -200, 'error_message': 'Insufficient funds'})
+
+        self.sequence += 1
+        child_order_acceptance_id = f'JRF{self.current_datetime.strftime("%Y%m%d")}-{self.sequence:06}'
+        self.orders[child_order_acceptance_id] = {
+            'id': self.sequence,
+            'child_order_id': f'JOR{self.current_datetime.strftime("%Y%m%d")}-{self.sequence:06}',
+            'product_code': product_code,
+            'side': side,
+            'child_order_type': child_order_type,
+            'price': price,
+            'average_price': 0,
+            'size': size,
+            'child_order_state': 'ACTIVE',
+            'expire_date': self.current_datetime + datetime.timedelta(minutes=minute_to_expire),
+            'child_order_date': self.current_datetime,
+            'child_order_acceptance_id': child_order_acceptance_id,
+            'outstanding_size': size,
+            'cancel_size': 0,
+            'executed_size': 0,
+            'total_commission': 0,
+        }
+        self.active_ids.append(child_order_acceptance_id)
+        return SimulatedResponse(200, {'child_order_acceptance_id': child_order_acceptance_id})
+
+    def cancel_child_order(self, product_code, child_order_acceptance_id):
+        if child_order_acceptance_id in self.active_ids:
+            self.active_ids.remove(child_order_acceptance_id)
+            order = self.orders[child_order_acceptance_id]
+            order['child_order_state'] = 'CANCELED'
+            order['cancel_size'] = order['outstanding_size']
+            order['outstanding_size'] = 0
+        return SimulatedResponse(200, {})
+
+    def get_child_orders(self, product_code, region='Asia/Tokyo', child_order_acceptance_id='', **kwargs):
+        if child_order_acceptance_id not in self.orders:
+            return pd.DataFrame()
+        df = pd.DataFrame([self.orders[child_order_acceptance_id]])
+        df['child_order_date'] = pd.to_datetime(df['child_order_date']).dt.tz_convert(region)
+        return df.set_index('child_order_acceptance_id')
+
+    def match(self, times, lows, highs, i_start, i_end):
+        """1分足のi_startからi_end(含まない)までで指値に達した注文を約定させる"""
+        for child_order_acceptance_id in list(self.active_ids):
+            order = self.orders[child_order_acceptance_id]
+            # 注文時刻以降に始まり、有効期限までに始まる足のみを対象とする
+            i_first = max(i_start, int(np.searchsorted(times, pd.Timestamp(order['child_order_date']).value)))
+            expire_ns = pd.Timestamp(order['expire_date']).value
+            i_last = min(i_end, int(np.searchsorted(times, expire_ns)))
+            if i_first < i_last:
+                if order['side'] == 'BUY':
+                    hits = np.flatnonzero(lows[i_first:i_last] <= order['price'])
+                else:
+                    hits = np.flatnonzero(highs[i_first:i_last] >= order['price'])
+                if len(hits) > 0:
+                    self._fill(order)
+                    continue
+            if i_end > 0 and times[i_end - 1] + MINUTE_NS >= expire_ns:
+                self.active_ids.remove(child_order_acceptance_id)
+                order['child_order_state'] = 'EXPIRED'
+
+    def _fill(self, order):
+        commission = order['size'] * self.commission_rate
+        if order['side'] == 'BUY':
+            self.balances['JPY'] -= order['price'] * order['size']
+            self.balances[self.currency] += order['size'] - commission
+        else:
+            self.balances[self.currency] -= order['size']
+            self.balances['JPY'] += order['price'] * (order['size'] - commission)
+        order['child_order_state'] = 'COMPLETED'
+        order['average_price'] = order['price']
+        order['executed_size'] = order['size']
+        order['outstanding_size'] = 0
+        order['total_commission'] = commission
+        self.active_ids.remove(order['child_order_acceptance_id'])
+
+
+class BlockExtrema:
+    """区間の最大値・最小値を、日単位のブロックと端数の走査で求める"""
+
+    def __init__(self, highs, lows, block=DAY_MINUTES):
+        self.highs = highs
+        self.lows = lows
+        self.block = block
+        n_blocks = len(highs) // block
+        self.block_highs = highs[:n_blocks * block].reshape(n_blocks, block).max(axis=1)
+        self.block_lows = lows[:n_blocks * block].reshape(n_blocks, block).min(axis=1)
+
+    def query(self, i_start, i_end):
+        """i_start <= i < i_end の (最大値, 最小値)"""
+        b_start = -(-i_start // self.block)
+        b_end = i_end // self.block
+        if b_start >= b_end:
+            return self.highs[i_start:i_end].max(), self.lows[i_start:i_end].min()
+        parts_high = [self.block_highs[b_start:b_end].max()]
+        parts_low = [self.block_lows[b_start:b_end].min()]
+        for i_a, i_b in [(i_start, b_start * self.block), (b_end * self.block, i_end)]:
+            if i_a < i_b:
+                parts_high.append(self.highs[i_a:i_b].max())
+                parts_low.append(self.lows[i_a:i_b].min())
+        return max(parts_high), min(parts_low)
+
+
+class PrefixSlope:
+    """等間隔の終値に対する任意区間の線形回帰の傾きを累積和から求める"""
+
+    def __init__(self, values):
+        k = np.arange(len(values), dtype='float64')
+        self.sum_y = np.r_[0, np.cumsum(values)]
+        self.sum_ky = np.r_[0, np.cumsum(k * values)]
+
+    def slope(self, i_start, i_end):
+        n = i_end - i_start
+        if n < 2:
+            return None
+        sum_y = self.sum_y[i_end] - self.sum_y[i_start]
+        sum_xy = self.sum_ky[i_end] - self.sum_ky[i_start] - i_start * sum_y
+        sum_x = n * (n - 1) / 2
+        sum_x2 = (n - 1) * n * (2 * n - 1) / 6
+        return (n * sum_xy - sum_x * sum_y) / (n * sum_x2 - sum_x * sum_x)
+
+
+class BarSeries:
+    """1分足(全区間)の配列と、集計用の前処理結果"""
+
+    def __init__(self, times, opens, highs, lows, closes):
+        self.times = times
+        self.opens = opens
+        self.highs = highs
+        self.lows = lows
+        self.closes = closes
+        self.extrema = BlockExtrema(highs, lows)
+        self.slopes = {
+            freq: PrefixSlope(closes[minutes - 1::minutes])
+            for freq, minutes in FREQ_MINUTES.items()
+        }
+
+
+class BacktestSummary:
+    """シミュレーション時刻時点のLatestSummary
+
+    latest_summary['BUY']['1w']['price'] のように本番と同じ形でアクセスできる。
+    期間の区切りはLatestSummaryに合わせ、週は8日分、月は前月の初日から、年は13か月分とする。
+    """
+
+    def __init__(self, series, i_now, current_datetime):
+        self.series = series
+        # i_now本目(含まない)までが確定した1分足
+        self.i_now = i_now
+        self.current_datetime = current_datetime
+        self.used_windows = []
+        self._windows = {}
+
+    def __getitem__(self, side):
+        if side not in ['BUY', 'SELL']:
+            raise KeyError(side)
+        return _BacktestSummarySide(self, side)
+
+    def _index_of(self, target_datetime):
+        i = int(np.searchsorted(self.series['BUY'].times, pd.Timestamp(target_datetime).value, side='left'))
+        return min(max(i, 0), self.i_now - 1)
+
+    def _window_start(self, name):
+        today = self.current_datetime.replace(hour=0, minute=0, second=0, microsecond=0)
+        if name == '6h':
+            return self._index_of(self.current_datetime - datetime.timedelta(hours=6))
+        if name == '12h':
+            return self._index_of(self.current_datetime - datetime.timedelta(hours=12))
+        if name == '1d':
+            return self._index_of(self.current_datetime - datetime.timedelta(days=1))
+        if name == '1w':
+            return self._index_of(today - datetime.timedelta(days=7))
+        if name == '1m':
+            return self._index_of((self.current_datetime - datetime.timedelta(days=32)).replace(
+                day=1, hour=0, minute=0, second=0, microsecond=0))
+        if name == '1y':
+            return self._index_of((today - pd.DateOffset(months=12)).replace(day=1))
+        if name == 'all':
+            return 0
+        raise KeyError(name)
+
+    def _trend(self, side, name):
+        freq, period = TREND_SPECS[name]
+        minutes = FREQ_MINUTES[freq]
+        i_end = self.i_now // minutes
+        slope = self.series[side].slopes[freq].slope(max(i_end - period, 0), i_end)
+        if slope is None:
+            return 'DOWN'
+        return 'UP' if slope > 0 else 'DOWN'
+
+    def window(self, name):
+        if name not in self._windows:
+            window = {}
+            for side in ['BUY', 'SELL']:
+                series = self.series[side]
+                if name == 'now':
+                    window[side] = {'price': float(series.closes[self.i_now - 1])}
+                    continue
+                i_start = self._window_start(name)
+                high, low = series.extrema.query(i_start, self.i_now)
+                window[side] = {
+                    'price': {
+                        'open': float(series.opens[i_start]),
+                        'high': float(high),
+                        'low': float(low),
+                        'close': float(series.closes[self.i_now - 1]),
+                    },
+                    'trend': self._trend(side, name),
+                }
+            self._windows[name] = window
+            self.used_windows.append(name)
+        return self._windows[name]
+
+
+class _BacktestSummarySide:
+    def __init__(self, summary, side):
+        self.summary = summary
+        self.side = side
+
+    def __getitem__(self, name):
+        return self.summary.window(name)[self.side]
+
+    def __contains__(self, name):
+        try:
+            self.summary.window(name)
+        except KeyError:
+            return False
+        return True
+
+    def get(self, name, default=None):
+        if name in self:
+            return self[name]
+        return default
+
+
+@contextmanager
+def override_environ(env):
+    previous = {key: os.environ.get(key) for key in env.keys()}
+    os.environ.update({key: str(value) for key, value in env.items()})
+    try:
+        yield
+    finally:
+        for key, value in previous.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+
+
+def _fill_leading_nan(values):
+    valid = np.flatnonzero(~np.isnan(values))
+    if len(valid) == 0:
+        raise ValueError('対象期間の約定データが存在しません。')
+    values[:valid[0]] = values[valid[0]]
+    return values
+
+
+def load_series(product_code, start, end, warmup_days=400):
+    """バックテストに使う1分足を、開始時刻のwarmup_days日前から読み込む
+
+    Returns:
+        dict: 'BUY', 'SELL' -> BarSeries
+    """
+    load_start = (start - datetime.timedelta(days=warmup_days)).replace(
+        hour=0, minute=0, second=0, microsecond=0)
+    series = {}
+    for side in ['BUY', 'SELL']:
+        panel = load_panel(
+            [product_code], load_start, end,
+            freq_dir='1m',
+            side=side.lower(),
+            fields=('open_price', 'high_price', 'low_price', 'close_price'),
+        )
+        values = {field: _fill_leading_nan(panel.sel(product_code, field).copy()) for field in panel.fields}
+        series[side] = BarSeries(
+            panel.times.asi8,
+            values['open_price'],
+            values['high_price'],
+            values['low_price'],
+            values['close_price'],
+        )
+    return series
+
+
+class Backtest:
+    """保存済みの1分足を時刻順に再生し、本番と同じAIの判断で売買をシミュレーションする
+
+    interval_minutesごとにAIを作成してlong_term, short_term, dcaを呼び出し、
+    その間の1分足で注文の約定を判定する。
+    注文履歴などの書き込みはutils.storage_overlayでメモリ上に保持するため、
+    本番のストレージには書き込まない。
+
+    Args:
+        product_code (str): プロダクト
+        start (datetime.datetime): 開始時刻(タイムゾーン付き)
+        end (datetime.datetime): 終了時刻(タイムゾーン付き)
+        initial_jpy (float, optional): 初期のJPY残高
+        initial_coin (float, optional): 初期の暗号資産残高
+        interval_minutes (int, optional): AIを呼び出す間隔(Lambdaの実行間隔)
+        commission_rate (float, optional): 取引手数料率
+        warmup_days (int, optional): 開始時刻より前に読み込む日数。1y, allの集計に使う
+        long_term (bool, optional): ai.long_termを呼び出すかどうか
+        short_term (bool, optional): ai.short_termを呼び出すかどうか
+        dca (list, optional): ai.dcaの引数(dict)のリスト
+        min_size (float, optional): 最小注文数量(AIのmin_size)
+        ai_kwargs (dict, optional): AIに渡すその他の引数(max_volume_longなど)
+        env (dict, optional): 実行中に設定する環境変数(MAX_BUY_PRICE_RATE_IN_LONGなど)
+    """
+
+    def __init__(self, product_code, start, end,
+                 initial_jpy=1000000,
+                 initial_coin=0.0,
+                 interval_minutes=60,
+                 commission_rate=0.0015,
+                 warmup_days=400,
+                 long_term=True,
+                 short_term=True,
+                 dca=None,
+                 min_size=DEFAULT_MIN_SIZE,
+                 ai_kwargs=None,
+                 env=None):
+        self.product_code = product_code
+        self.start = start
+        self.end = end
+        self.initial_jpy = initial_jpy
+        self.initial_coin = initial_coin
+        self.interval_minutes = interval_minutes
+        self.commission_rate = commission_rate
+        self.warmup_days = warmup_days
+        self.long_term = long_term
+        self.short_term = short_term
+        self.dca = dca or []
+        self.min_size = min_size
+        self.ai_kwargs = ai_kwargs or {}
+        self.env = env or {}
+
+    def _snapshot(self, child_orders, latest_summary):
+        """calc_profit, calc_volumeと同じ定義の累積の利益・取引量"""
+        realized_profit = 0.0
+        unrealized_profit = 0.0
+        buy_volume = 0.0
+        sell_volume = 0.0
+        for term in ['long', 'dca']:
+            if not child_orders[term].empty:
+                unrealized_profit += float(child_orders[term]['profit'].sum())
+                buy_volume += float(child_orders[term]['volume'].sum())
+        if not child_orders['short'].empty:
+            df_short = child_orders['short']
+            realized_profit += float(df_short['profit'].sum())
+            df_active_sell_order = df_short.query('side == "SELL" and child_order_state == "ACTIVE"')
+            for child_order_acceptance_id in df_active_sell_order['related_child_order_acceptance_id'].values.tolist():
+                unrealized_profit += (latest_summary['SELL']['now']['price'] - df_short.at[child_order_acceptance_id, 'price']) \
+                    * df_short.at[child_order_acceptance_id, 'size'] \
+                    - df_short.at[child_order_acceptance_id, 'total_commission_yen']
+            buy_volume += float(df_short.loc[df_short['side'] == 'BUY', 'volume'].sum())
+            sell_volume += float(df_short.loc[df_short['side'] == 'SELL', 'volume'].sum())
+        return {
+            'realized_profit': realized_profit,
+            'unrealized_profit': unrealized_profit,
+            'buy_volume': buy_volume,
+            'sell_volume': sell_volume,
+        }
+
+    def run(self, series=None):
+        """
+        Args:
+            series (dict, optional): load_seriesで読み込み済みの1分足。
+                同じ期間を繰り返し実行する場合(sweep)に渡す
+
+        Returns:
+            BacktestResult: 日・月・年ごとの利益と取引量、残高の推移、注文履歴
+        """
+        if series is None:
+            series = load_series(self.product_code, self.start, self.end, self.warmup_days)
+        times = series['BUY'].times
+        # 買い・売りどちらの約定でも指値に達したとみなす
+        lows = np.fmin(series['BUY'].lows, series['SELL'].lows)
+        highs = np.fmax(series['BUY'].highs, series['SELL'].highs)
+
+        exchange = SimulatedExchange(
+            self.product_code, self.initial_jpy, self.initial_coin, self.commission_rate)
+
+        i_first = int(np.searchsorted(times, pd.Timestamp(self.start).value, side='left'))
+        decision_indices = range(max(i_first, 1), len(times) + 1, self.interval_minutes)
+        if len(decision_indices) == 0:
+            raise ValueError(f'[{self.product_code} {self.start} - {self.end}] バックテストの期間が空です。')
+
+        snapshots = {}
+        balances = []
+        i_matched = i_first
+        with storage_overlay() as overlay, override_environ(self.env):
+            # 本番の注文履歴を読み込まないよう、空の状態から始める
+            for filename in ['long_term.csv', 'short_term.csv', 'dca.csv']:
+                overlay.delete(Path(CHILD_ORDERS_DIR).joinpath(self.product_code, filename))
+            overlay.delete(order_store_path(self.product_code))
+            rm_dir(order_store_delta_dir(self.product_code))
+            overlay.delete(balance_ledger_path())
+            for i_now in decision_indices:
+                exchange.match(times, lows, highs, i_matched, i_now)
+                i_matched = i_now
+                current_datetime = pd.Timestamp(times[i_now - 1] + MINUTE_NS, tz='UTC').tz_convert(
+                    'Asia/Tokyo').to_pydatetime()
+                exchange.current_datetime = current_datetime
+
+                latest_summary = BacktestSummary(series, i_now, current_datetime)
+                ai = AI(
+                    latest_summary=latest_summary,
+                    product_code=self.product_code,
+                    line_notify=NullNotifier(),
+                    exchange=exchange,
+                    current_datetime=current_datetime,
+                    **{'min_size': self.min_size, **self.ai_kwargs}
+                )
+                if self.long_term:
+                    ai.long_term()
+                if self.short_term:
+                    ai.short_term()
+                for dca_kwargs in self.dca:
+                    ai.dca(**dca_kwargs)
+
+                for term in ['long', 'short', 'dca']:
+                    ai.update_child_orders(term=term)
+                ai.update_unrealized_profit(term='long')
+                ai.update_unrealized_profit(term='dca')
+
+                # 日毎に最後の時点の値が残る
+                snapshots[current_datetime.strftime('%Y/%m/%d')] = self._snapshot(ai.child_orders, latest_summary)
+                balances.append({'date': current_datetime, **exchange.balances})
+                ai.commit()
+                ai.close()
+
+            child_orders = ai.child_orders
+
+        logger.info(
+            f'[{self.product_code} {self.start} - {self.end}] バックテスト完了 '
+            + f'({len(decision_indices)}回 {len(exchange.orders)}注文)')
+        return BacktestResult(
+            self.product_code, snapshots, pd.DataFrame(balances).set_index('date'), child_orders)
+
+
+class BacktestResult:
+    """バックテストの結果
+
+    daily_profit, daily_volumeなどはcalc_profit, calc_volumeが保存するcsvと同じ列を持つ。
+    """
+
+    def __init__(self, product_code, snapshots, df_balance, child_orders):
+        self.product_code = product_code
+        self.df_balance = df_balance
+        self.child_orders = child_orders
+
+        df_cumulative = pd.DataFrame.from_dict(snapshots, orient='index')
+        df_cumulative.index.name = 'date'
+        # 累積値の差分を日毎の値にする
+        df_daily = df_cumulative.diff().fillna(df_cumulative.iloc[:1]).round(1)
+
+        self.daily_profit = pd.DataFrame({
+            'total_profit': df_daily['realized_profit'] + df_daily['unrealized_profit'],
+            'realized_profit': df_daily['realized_profit'],
+            'unrealized_profit': df_daily['unrealized_profit'],
+            f'{product_code}_total_profit': df_daily['realized_profit'] + df_daily['unrealized_profit'],
+            f'{product_code}_realized_profit': df_daily['realized_profit'],
+            f'{product_code}_unrealized_profit': df_daily['unrealized_profit'],
+        })
+        self.daily_volume = pd.DataFrame({
+            'total_volume': df_daily['buy_volume'] + df_daily['sell_volume'],
+            'buy_volume': df_daily['buy_volume'],
+            'sell_volume': df_daily['sell_volume'],
+            f'{product_code}_total_volume': df_daily['buy_volume'] + df_daily['sell_volume'],
+            f'{product_code}_buy_volume': df_daily['buy_volume'],
+            f'{product_code}_sell_volume': df_daily['sell_volume'],
+        })
+
+        self.monthly_profit = self._sum_by(self.daily_profit, 7)
+        self.yearly_profit = self._sum_by(self.daily_profit, 4)
+        self.monthly_volume = self._sum_by(self.daily_volume, 7)
+        self.yearly_volume = self._sum_by(self.daily_volume, 4)
+
+    @staticmethod
+    def _sum_by(df_daily, n_chars):
+        df = df_daily.groupby(df_daily.index.str[:n_chars]).sum()
+        df.index.name = 'date'
+        return df
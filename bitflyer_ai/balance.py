@@ -0,0 +1,139 @@
+import datetime
+import math
+from logging import getLogger
+from pathlib import Path
+
+from manage import BALANCE_DIR, BALANCE_LEDGER_FILENAME
+from utils import path_exists, read_json, write_json
+
+logger = getLogger(__name__)
+
+# この差を超えるずれは照合時に記録する(JPY以外は数量)
+DRIFT_TOLERANCE = {'JPY': 1.0}
+DEFAULT_DRIFT_TOLERANCE = 1e-6
+
+
+def balance_ledger_path():
+    return Path(BALANCE_DIR).joinpath(BALANCE_LEDGER_FILENAME)
+
+
+def _number(value):
+    if value is None:
+        return 0.0
+    value = float(value)
+    return 0.0 if math.isnan(value) else value
+
+
+class BalanceLedger:
+    """口座の残高(amount, available)を、AIが把握している注文の状態の変化から更新する
+
+    注文の送信(ACTIVE)でavailableを拘束し、約定(COMPLETED)でamountを移し、
+    キャンセル・失効・削除で拘束を解く。get_balanceとの照合(reconcile)は、
+    前回の照合からreconcile_interval以上経過した場合と、ずれが疑われる場合
+    (availableが負になった、注文が拒否された、注文が手動で削除された)にのみ行う。
+    JPYは全てのプロダクトで共有するため、残高は1つのファイルに保存する。
+
+    Args:
+        reconcile_interval (datetime.timedelta): get_balanceと照合する間隔
+    """
+
+    def __init__(self, reconcile_interval):
+        self.p_path = balance_ledger_path()
+        self.reconcile_interval = reconcile_interval
+        # currency_code -> {'amount': float, 'available': float}
+        self.balances = {}
+        self.reconciled_at = None
+        self.stale = True
+        self.modified = False
+        if path_exists(self.p_path):
+            state = read_json(self.p_path)
+            self.balances = state['balances']
+            self.reconciled_at = datetime.datetime.fromisoformat(state['reconciled_at'])
+            self.stale = state.get('stale', False)
+
+    def needs_reconcile(self, current_datetime):
+        if self.stale or self.reconciled_at is None:
+            return True
+        return current_datetime - self.reconciled_at >= self.reconcile_interval
+
+    def invalidate(self, reason):
+        """次に残高を参照する際にget_balanceと照合する"""
+        if not self.stale:
+            logger.info(f'残高のずれが疑われるため、get_balanceと照合し直します。({reason})')
+        self.stale = True
+        self.modified = True
+
+    def reconcile(self, df_balance, current_datetime):
+        """get_balanceの結果で置き換える"""
+        balances = {
+            row['currency_code']: {'amount': float(row['amount']), 'available': float(row['available'])}
+            for row in df_balance.to_dict(orient='records')
+        }
+        for currency_code, tracked in self.balances.items():
+            actual = balances.get(currency_code, {'amount': 0.0, 'available': 0.0})
+            drift = actual['available'] - tracked['available']
+            if abs(drift) > DRIFT_TOLERANCE.get(currency_code, DEFAULT_DRIFT_TOLERANCE):
+                logger.info(
+                    f'[{currency_code}] 記録していた残高とget_balanceの結果がずれていました。'
+                    + f'(available: {tracked["available"]} -> {actual["available"]})'
+                )
+        self.balances = balances
+        self.reconciled_at = current_datetime
+        self.stale = False
+        self.modified = True
+
+    def available(self, currency_code):
+        return self.balances.get(currency_code, {}).get('available', 0.0)
+
+    @staticmethod
+    def order_effect(currency_code, record, state=None):
+        """注文が残高に与える影響(currency_code -> [amount, available]の増減)
+
+        Args:
+            currency_code (str): 注文の暗号資産(BTC_JPYの場合はBTC)
+            record (ledger.OrderRecord): 注文。Noneの場合は影響なし
+            state (str, optional): 指定した場合、この状態であるものとして計算する
+        """
+        if record is None:
+            return {}
+        state = state or record.child_order_state
+        price = _number(record.price)
+        size = _number(record.size)
+        if state == 'COMPLETED':
+            executed_size = size
+        else:
+            executed_size = _number(record.extra.get('executed_size'))
+        reserved_size = size - executed_size if state == 'ACTIVE' else 0.0
+        commission = _number(record.total_commission)
+
+        if record.side == 'BUY':
+            return {
+                'JPY': [-price * executed_size, -price * (executed_size + reserved_size)],
+                currency_code: [executed_size - commission, executed_size - commission],
+            }
+        return {
+            'JPY': [price * executed_size, price * executed_size],
+            currency_code: [-(executed_size + commission), -(executed_size + commission + reserved_size)],
+        }
+
+    def apply(self, before, after):
+        """注文の状態の変化(order_effectの差)を残高に反映する"""
+        for currency_code in set(before) | set(after):
+            balance = self.balances.setdefault(currency_code, {'amount': 0.0, 'available': 0.0})
+            amount_before, available_before = before.get(currency_code, [0.0, 0.0])
+            amount_after, available_after = after.get(currency_code, [0.0, 0.0])
+            balance['amount'] += amount_after - amount_before
+            balance['available'] += available_after - available_before
+            self.modified = True
+            if balance['available'] < -DRIFT_TOLERANCE.get(currency_code, DEFAULT_DRIFT_TOLERANCE):
+                self.invalidate(f'{currency_code}のavailableが負になりました')
+
+    def save(self):
+        if not self.modified or self.reconciled_at is None:
+            return
+        write_json(self.p_path, {
+            'balances': self.balances,
+            'reconciled_at': self.reconciled_at.isoformat(),
+            'stale': self.stale,
+        })
+        self.modified = False
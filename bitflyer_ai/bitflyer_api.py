@@ -9,6 +9,7 @@ import pandas as pd
 import requests
 
 from manage import LOCAL
+from schema import compact_executions
 
 logger = getLogger(__name__)
 
@@ -49,6 +50,16 @@ HTTP_PRIVATE_API = {
 }
 
 
+def credentials():
+    """APIキーとシークレット(Lambdaでは暗号化された環境変数を復号する)"""
+    api_key = os.environ.get('API_KEY')
+    api_secret = os.environ.get('API_SECRET')
+    if not LOCAL:
+        api_key = aws.decrypt(api_key)
+        api_secret = aws.decrypt(api_secret)
+    return api_key, api_secret
+
+
 class BitflyerAPI:
     """BitflyerAPI
     TODO: add functions to this class
@@ -76,12 +87,7 @@ class BitflyerAPI:
         self.method = method
         self.unix_time = str(time.time())
 
-        self.api_key = os.environ.get('API_KEY')
-        self.api_secret = os.environ.get('API_SECRET')
-
-        if not LOCAL:
-            self.api_key = aws.decrypt(self.api_key)
-            self.api_secret = aws.decrypt(self.api_secret)
+        self.api_key, self.api_secret = credentials()
 
     def sign(self, body={}):
         if self.method == 'GET':
@@ -193,7 +199,7 @@ def get_executions(product_code,
                    count=100,
                    before=0,
                    after=0,
-                   region='Asia/Tokyo'):
+                   region=None):
     """約定履歴を取得
 
     Args:
@@ -201,10 +207,10 @@ def get_executions(product_code,
         count (int, optional):  結果の個数を指定。デフォルトは100。
         before (str, optional): このパラメータに指定した値より小さい id を持つデータを取得。
         after (str, optional): このパラメータに指定した値より大きい id を持つデータを取得。
-        region (str, optional): 住んでいる地域。
+        region (str, optional): 住んでいる地域。指定しない場合、indexはUTCのまま返す。
 
     Returns:
-        [type]: [description]
+        pd.DataFrame: schema.compact_executionsで変換した約定履歴
     """
     method = 'GET'
     process_path = HTTP_PUBLIC_API[method]['executions']
@@ -223,7 +229,9 @@ def get_executions(product_code,
             df_result['exec_date'] = pd.to_datetime(
                 df_result['exec_date'], utc=True)
             df_result = df_result.set_index('exec_date', drop=True)
-            df_result = df_result.tz_convert(region)
+            df_result = compact_executions(df_result)
+            if region is not None:
+                df_result = df_result.tz_convert(region)
 
         return df_result
     else:
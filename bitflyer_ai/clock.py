@@ -0,0 +1,79 @@
+import datetime
+import time as _time
+from contextlib import contextmanager
+
+JST = datetime.timezone(datetime.timedelta(hours=9))
+
+
+class SystemClock:
+    """実際の時刻"""
+
+    def now(self, tz=JST):
+        return datetime.datetime.now(tz)
+
+    def time(self):
+        return _time.time()
+
+    def sleep(self, seconds):
+        _time.sleep(seconds)
+
+
+class SimulatedClock:
+    """シミュレーション用の時刻
+
+    sleepは待たずに時刻を進めるため、ポーリングのループも即座に終わる。
+
+    Args:
+        start (datetime.datetime): 開始時刻(タイムゾーン付き)
+    """
+
+    def __init__(self, start):
+        if start.tzinfo is None:
+            raise ValueError('タイムゾーン付きの時刻を指定してください。')
+        self.current = start
+
+    def now(self, tz=JST):
+        return self.current.astimezone(tz)
+
+    def time(self):
+        return self.current.timestamp()
+
+    def sleep(self, seconds):
+        self.advance(seconds)
+
+    def advance(self, seconds):
+        self.current += datetime.timedelta(seconds=seconds)
+
+    def set(self, current):
+        self.current = current
+
+
+_clock = SystemClock()
+
+
+def get_clock():
+    return _clock
+
+
+@contextmanager
+def use_clock(clock):
+    """withブロック内でnow, time, sleepが参照する時刻をclockに置き換える"""
+    global _clock
+    previous_clock = _clock
+    _clock = clock
+    try:
+        yield clock
+    finally:
+        _clock = previous_clock
+
+
+def now(tz=JST):
+    return _clock.now(tz)
+
+
+def time():
+    return _clock.time()
+
+
+def sleep(seconds):
+    _clock.sleep(seconds)
@@ -0,0 +1,13 @@
+import pytest
+
+import preprocess
+import utils
+
+
+@pytest.fixture
+def local_storage(tmp_path, monkeypatch):
+    """tmp_pathをローカルのストレージとして使う(REF_LOCAL=Trueと同じ動作にする)"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(utils, 'REF_LOCAL', True)
+    monkeypatch.setattr(preprocess, 'REF_LOCAL', True)
+    return tmp_path
@@ -0,0 +1,251 @@
+import datetime
+import io
+import time
+from logging import getLogger
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from manage import EXECUTION_HISTORY_DIR, FEATURE_FILENAME
+from preprocess import densify_bars, read_bars
+from utils import path_exists, read_bytes, read_json, write_bytes, write_json
+
+logger = getLogger(__name__)
+
+# 特徴量の定義を変更した場合は上げる(保存済みの日も作り直す)
+FEATURE_VERSION = 1
+
+RETURN_WINDOWS = [1, 5, 15, 60]
+VOLATILITY_WINDOWS = [15, 60]
+IMBALANCE_WINDOWS = [1, 15, 60]
+VOLUME_WINDOWS = [1, 15]
+
+# 窓付きの特徴量を日の先頭から計算するために必要な前日の本数
+CONTEXT_BARS = max(RETURN_WINDOWS + VOLATILITY_WINDOWS + IMBALANCE_WINDOWS + VOLUME_WINDOWS)
+
+FEATURE_COLUMNS = (
+    [f'ret_{window}' for window in RETURN_WINDOWS]
+    + [f'vol_{window}' for window in VOLATILITY_WINDOWS]
+    + [f'imbalance_{window}' for window in IMBALANCE_WINDOWS]
+    + [f'volume_{window}' for window in VOLUME_WINDOWS]
+    + ['spread', 'range']
+)
+
+MINUTE_NS = 60 * 10 ** 9
+
+# 日が変わってからこの時間が経過するまでは、遅れて届く約定で前日の足が更新されうるため作成済みとしない
+COMPLETE_GRACE = datetime.timedelta(hours=1)
+
+
+def feature_path(product_code, target_date):
+    return Path(EXECUTION_HISTORY_DIR).joinpath(
+        product_code,
+        target_date.strftime('%Y'),
+        target_date.strftime('%m'),
+        target_date.strftime('%d'),
+        '1m',
+        FEATURE_FILENAME
+    )
+
+
+def feature_state_path(product_code):
+    return Path(EXECUTION_HISTORY_DIR).joinpath(product_code, 'features.json')
+
+
+def _rolling_sum(x, window):
+    """先頭からwindow-1本はNaNとする移動合計(累積和の差分で計算する)"""
+    if window == 1:
+        return x.copy()
+    cumsum = np.cumsum(np.nan_to_num(x))
+    result = np.full(len(x), np.nan)
+    if len(x) >= window:
+        result[window - 1:] = cumsum[window - 1:] - np.r_[0, cumsum[:-window]]
+    return result
+
+
+def _shift_diff(x, window):
+    result = np.full(len(x), np.nan)
+    result[window:] = x[window:] - x[:-window]
+    return result
+
+
+def _day_grid(target_date):
+    start = pd.Timestamp(target_date).tz_localize('Asia/Tokyo')
+    return start, start + pd.Timedelta(days=1) - pd.Timedelta(minutes=1)
+
+
+def _read_day_bars(product_code, target_date, prev_close=None):
+    """1日分の1分足を約定のなかった区間も含めて(1440本)読み込む"""
+    p_dir = feature_path(product_code, target_date).parent
+    start, end = _day_grid(target_date)
+    bars = {}
+    for side in ['buy', 'sell']:
+        df = read_bars(p_dir.joinpath(f'{side}.csv'))
+        if df.empty:
+            return None
+        bars[side] = densify_bars(
+            df, 'T', start=start, end=end,
+            prev_close=None if prev_close is None else prev_close[side])
+    return bars
+
+
+def compute_features(bars, context_bars=None):
+    """1分足から特徴量の列を一括で計算する
+
+    Args:
+        bars (dict): 'buy', 'sell' -> densify_bars済みの1分足
+        context_bars (dict, optional): 前日の1分足。窓付きの特徴量を日の先頭から計算するために使う
+
+    Returns:
+        dict: 列名 -> np.ndarray
+    """
+    n_rows = len(bars['buy'])
+    columns = {}
+    for side in ['buy', 'sell']:
+        df = bars[side]
+        if context_bars is not None:
+            df = pd.concat([context_bars[side].iloc[-CONTEXT_BARS:], df])
+        columns[side] = {
+            col_name: df[col_name].values.astype('float64')
+            for col_name in ['high_price', 'low_price', 'close_price', 'total_size']
+        }
+    buy = columns['buy']
+    sell = columns['sell']
+
+    mid = (buy['close_price'] + sell['close_price']) / 2
+    log_mid = np.log(mid)
+    log_return = _shift_diff(log_mid, 1)
+
+    features = {}
+    for window in RETURN_WINDOWS:
+        features[f'ret_{window}'] = _shift_diff(log_mid, window)
+    for window in VOLATILITY_WINDOWS:
+        # 標準偏差 = sqrt(E[x^2] - E[x]^2)
+        mean = _rolling_sum(log_return, window) / window
+        mean_sq = _rolling_sum(log_return ** 2, window) / window
+        features[f'vol_{window}'] = np.sqrt(np.maximum(mean_sq - mean ** 2, 0))
+        features[f'vol_{window}'][np.isnan(log_return)] = np.nan
+    for window in IMBALANCE_WINDOWS:
+        buy_size = _rolling_sum(buy['total_size'], window)
+        sell_size = _rolling_sum(sell['total_size'], window)
+        total_size = buy_size + sell_size
+        with np.errstate(divide='ignore', invalid='ignore'):
+            features[f'imbalance_{window}'] = np.where(
+                total_size > 0, (buy_size - sell_size) / total_size, 0.0)
+        features[f'imbalance_{window}'][np.isnan(total_size)] = np.nan
+    for window in VOLUME_WINDOWS:
+        features[f'volume_{window}'] = _rolling_sum(buy['total_size'] + sell['total_size'], window)
+    # 買いは売り板、売りは買い板に対して約定するため、終値の差をスプレッドの代わりにする
+    features['spread'] = (buy['close_price'] - sell['close_price']) / mid
+    features['range'] = (
+        np.maximum(buy['high_price'], sell['high_price'])
+        - np.minimum(buy['low_price'], sell['low_price'])) / mid
+
+    return {col_name: values[-n_rows:].astype('float32') for col_name, values in features.items()}
+
+
+def save_features(p_path, timestamps, features):
+    buffer = io.BytesIO()
+    np.savez_compressed(
+        buffer, ts=timestamps, version=np.array(FEATURE_VERSION), **features)
+    write_bytes(p_path, buffer.getvalue())
+
+
+def update_features(product_code, current_datetime, days=30, time_budget=None):
+    """保存済みの1分足から日毎の特徴量を作成する
+
+    前回までに作成済みの日(features.jsonに記録)より後の日のみを計算する。
+    当日分と、日が変わってからCOMPLETE_GRACEが経過していない前日分は確定していないため、
+    毎回作り直し、作成済みとしては記録しない。足が存在せず作成できなかった日があれば、
+    それ以降の日も作成済みとしない(次回以降に作り直す)。
+
+    Args:
+        product_code (str): プロダクト
+        current_datetime (datetime.datetime): 現在時刻
+        days (int, optional): 作成済みの記録がない場合に遡る日数
+        time_budget (float, optional): 秒数。超えた場合は残りの日を作成せずに終了する
+            (作成済みとして記録していない日は次回以降に作成される)
+
+    Returns:
+        int: 作成した日数
+    """
+    start_time = time.time()
+    p_state_path = feature_state_path(product_code)
+    state = {}
+    if path_exists(p_state_path):
+        state = read_json(p_state_path)
+
+    end_date = current_datetime.date()
+    if state.get('version') == FEATURE_VERSION and 'last_date' in state:
+        start_date = datetime.date.fromisoformat(state['last_date']) + datetime.timedelta(days=1)
+    else:
+        start_date = end_date - datetime.timedelta(days=days)
+
+    context_bars = _read_day_bars(product_code, start_date - datetime.timedelta(days=1))
+    target_date = start_date
+    completed_date = None
+    contiguous = True
+    day_count = 0
+    while target_date <= end_date:
+        if time_budget is not None and time.time() - start_time > time_budget:
+            logger.info(f'[{product_code} {target_date}] {time_budget}秒を超えたため、以降の日の特徴量は次回作成します。')
+            break
+        prev_close = None
+        if context_bars is not None:
+            prev_close = {side: context_bars[side]['close_price'].values[-1] for side in ['buy', 'sell']}
+        bars = _read_day_bars(product_code, target_date, prev_close=prev_close)
+        if bars is not None:
+            features = compute_features(bars, context_bars=context_bars)
+            save_features(
+                feature_path(product_code, target_date), bars['buy'].index.asi8, features)
+            day_count += 1
+            logger.debug(f'[{product_code} {target_date}] 特徴量作成完了')
+        else:
+            contiguous = False
+        day_end = datetime.datetime.combine(
+            target_date + datetime.timedelta(days=1), datetime.time(), tzinfo=current_datetime.tzinfo)
+        if contiguous and current_datetime >= day_end + COMPLETE_GRACE:
+            completed_date = target_date
+        context_bars = bars
+        target_date += datetime.timedelta(days=1)
+
+    if completed_date is not None:
+        write_json(p_state_path, {
+            'version': FEATURE_VERSION,
+            'last_date': completed_date.isoformat(),
+        })
+    logger.info(f'[{product_code}] {day_count}日分の特徴量を作成しました。')
+    return day_count
+
+
+def load_features(product_code, start_date, end_date, columns=None):
+    """start_dateからend_dateまで(両端を含む)の特徴量を読み込む
+
+    npzは列ごとに保存しているため、columnsを指定した場合はその列のみ展開する。
+
+    Returns:
+        pd.DataFrame: indexが時刻(Asia/Tokyo)、列が特徴量
+    """
+    if columns is None:
+        columns = FEATURE_COLUMNS
+    timestamps_list = []
+    values_list = {col_name: [] for col_name in columns}
+    target_date = start_date
+    while target_date <= end_date:
+        p_path = feature_path(product_code, target_date)
+        if path_exists(p_path):
+            with np.load(io.BytesIO(read_bytes(p_path))) as npz:
+                if int(npz['version']) == FEATURE_VERSION:
+                    timestamps_list.append(npz['ts'])
+                    for col_name in columns:
+                        values_list[col_name].append(npz[col_name])
+        target_date += datetime.timedelta(days=1)
+
+    if len(timestamps_list) == 0:
+        return pd.DataFrame(columns=columns)
+    df = pd.DataFrame(
+        {col_name: np.concatenate(values) for col_name, values in values_list.items()},
+        index=pd.to_datetime(np.concatenate(timestamps_list), utc=True).tz_convert('Asia/Tokyo'))
+    df.index.name = 'exec_date'
+    return df
@@ -0,0 +1,211 @@
+import argparse
+import datetime
+import io
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from logging import getLogger
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import clock
+from manage import EXECUTION_HISTORY_DIR, ROW_RETENTION_DAYS
+from preprocess import (day_coverage, gen_execution_summaries, read_day_rows,
+                        register_coverage, row_archive_part_path,
+                        save_day_executions)
+from schema import EXECUTION_COLUMNS, ORDER_ID_COLUMNS, compact_executions
+from tape import tape_path
+from utils import path_exists, read_csv, rm_file
+
+logger = getLogger(__name__)
+
+# 1プロセスが一度に解析するバイト数
+CHUNK_BYTES = 64 * 1024 ** 2
+
+REQUIRED_COLUMNS = ['id', 'side', 'price', 'size', 'exec_date']
+
+DAY_NS = 24 * 60 * 60 * 10 ** 9
+JST_OFFSET_NS = 9 * 60 * 60 * 10 ** 9
+
+
+def _dump_format(p_dump_path):
+    suffix = p_dump_path.suffix.lower()
+    if suffix == '.csv':
+        return 'csv'
+    if suffix in ['.jsonl', '.json', '.ndjson']:
+        return 'jsonl'
+    raise ValueError(f'[{p_dump_path}] 対応していない形式です。(csv, jsonlのみ、圧縮ファイルは展開してください)')
+
+
+def split_chunks(p_dump_path, chunk_bytes=CHUNK_BYTES, skip_header=False):
+    """ファイルを行の途中で切れないように、おおよそchunk_bytesごとのバイト範囲に分割する
+
+    Returns:
+        list: (開始位置, 終了位置)のリスト
+    """
+    file_size = p_dump_path.stat().st_size
+    offsets = []
+    with open(p_dump_path, 'rb') as f:
+        if skip_header:
+            f.readline()
+        offsets.append(f.tell())
+        while True:
+            f.seek(min(offsets[-1] + chunk_bytes, file_size))
+            f.readline()
+            position = f.tell()
+            if position >= file_size:
+                break
+            offsets.append(position)
+    offsets.append(file_size)
+    return [(start, end) for start, end in zip(offsets[:-1], offsets[1:]) if start < end]
+
+
+def normalize_executions(df, product_code=None):
+    """外部の約定履歴をget_executionsと同じ形式(UTCのindex、省メモリな型)に変換する"""
+    missing_columns = [col for col in REQUIRED_COLUMNS if col not in df.columns]
+    if len(missing_columns) > 0:
+        raise ValueError(f'必要な列が存在しません。({missing_columns})')
+    if product_code is not None and 'product_code' in df.columns:
+        df = df[df['product_code'].values == product_code]
+    df = df.assign(**{col_name: '' for col_name in ORDER_ID_COLUMNS if col_name not in df.columns})
+    df = df[EXECUTION_COLUMNS + ['exec_date']].copy()
+    # bitFlyerのexec_dateはタイムゾーンなしのUTC
+    df['exec_date'] = pd.to_datetime(df['exec_date'], utc=True)
+    df['side'] = df['side'].fillna('').astype(str).str.upper()
+    df = compact_executions(df.set_index('exec_date'))
+    return df
+
+
+def _parse_chunk(p_dump_path, fmt, columns, start, end, product_code, p_spool_dir, i_chunk):
+    """バイト範囲を解析し、日(Asia/Tokyo)ごとに一時ファイルへ書き出す(子プロセスで実行)"""
+    with open(p_dump_path, 'rb') as f:
+        f.seek(start)
+        body = f.read(end - start)
+    if fmt == 'csv':
+        df = pd.read_csv(io.BytesIO(body), names=columns, header=None)
+    else:
+        df = pd.read_json(io.BytesIO(body), lines=True, dtype=False)
+    df = normalize_executions(df, product_code=product_code)
+    if df.empty:
+        return {}
+
+    day_numbers = (df.index.asi8 + JST_OFFSET_NS) // DAY_NS
+    rows = {}
+    for day_number in np.unique(day_numbers):
+        target_date = datetime.date(1970, 1, 1) + datetime.timedelta(days=int(day_number))
+        p_day_dir = p_spool_dir.joinpath(target_date.strftime('%Y-%m-%d'))
+        p_day_dir.mkdir(parents=True, exist_ok=True)
+        df_day = df[day_numbers == day_number]
+        df_day.to_pickle(p_day_dir.joinpath(f'{i_chunk:06}.pkl'))
+        rows[target_date] = len(df_day)
+    return rows
+
+
+def _read_executions(p_path, compression=None):
+    return _to_executions(read_csv(str(p_path), compression=compression))
+
+
+def _to_executions(df):
+    df['exec_date'] = pd.to_datetime(df['exec_date'], utc=True)
+    return compact_executions(df.set_index('exec_date'))
+
+
+def _load_existing_day(product_code, target_date):
+    """保存済みの1日分の生データを、row/(追記分を含む)、日ごとのアーカイブの順に探して読み込む"""
+    p_row_dir = Path(EXECUTION_HISTORY_DIR).joinpath(
+        product_code,
+        target_date.strftime('%Y'),
+        target_date.strftime('%m'),
+        target_date.strftime('%d'),
+        'row')
+    df_row = read_day_rows(p_row_dir)
+    if df_row is not None:
+        return _to_executions(df_row)
+    p_part_path = row_archive_part_path(product_code, target_date)
+    if path_exists(p_part_path):
+        return _read_executions(p_part_path, compression='gzip')
+    return pd.DataFrame()
+
+
+def import_dump(product_code, dump_path, processes=None, chunk_bytes=CHUNK_BYTES, region='Asia/Tokyo'):
+    """外部ツールで出力した約定履歴(csv / json lines)を取り込む
+
+    ファイルをバイト範囲に分割して複数プロセスで解析し、日毎に
+    get_executions_historyと同じ形式(生データ、テープ、リサンプリング済みデータ)で保存する。
+    保存済みの日がある場合は結合してidの重複を除く。
+    ROW_RETENTION_DAYS日以上前の日の生データは、compact_row_dataと同じ圧縮アーカイブに直接保存する。
+    最後に取り込んだ月の集計データを作成し、日毎の範囲をまとめてcoverage.csvに記録する。
+
+    Args:
+        product_code (str): プロダクト
+        dump_path (str): 取り込むファイル
+        processes (int, optional): 解析に使うプロセス数。省略した場合はCPU数
+        chunk_bytes (int, optional): 1プロセスが一度に解析するバイト数
+        region (str, optional): 保存時のタイムゾーン
+
+    Returns:
+        dict: 日付 -> 保存した約定数
+    """
+    p_dump_path = Path(dump_path)
+    fmt = _dump_format(p_dump_path)
+    columns = None
+    if fmt == 'csv':
+        columns = pd.read_csv(p_dump_path, nrows=0).columns.tolist()
+    chunks = split_chunks(p_dump_path, chunk_bytes=chunk_bytes, skip_header=fmt == 'csv')
+    logger.info(f'[{product_code} {p_dump_path}] {len(chunks)}個に分割して解析します。')
+
+    archive_cutoff_date = (clock.now() - datetime.timedelta(days=ROW_RETENTION_DAYS)).date()
+    p_spool_dir = Path(tempfile.mkdtemp(prefix='bitflyer_ai_import_'))
+    saved_rows = {}
+    coverages = {}
+    try:
+        with ProcessPoolExecutor(max_workers=processes or os.cpu_count()) as executor:
+            futures = [
+                executor.submit(
+                    _parse_chunk, p_dump_path, fmt, columns, start, end, product_code, p_spool_dir, i_chunk)
+                for i_chunk, (start, end) in enumerate(chunks)
+            ]
+            parsed_rows = 0
+            for i, future in enumerate(futures):
+                parsed_rows += sum(future.result().values())
+                logger.debug(f'[{product_code}] 解析中... ({i + 1}/{len(chunks)} {parsed_rows}行)')
+
+        for p_day_dir in sorted(p_spool_dir.iterdir()):
+            target_date = datetime.datetime.strptime(p_day_dir.name, '%Y-%m-%d').date()
+            df_list = [pd.read_pickle(p_path) for p_path in sorted(p_day_dir.glob('*.pkl'))]
+            df_list.append(_load_existing_day(product_code, target_date))
+            df = pd.concat([df for df in df_list if not df.empty])
+            df = df[~df['id'].duplicated().values].sort_values('id').sort_index(kind='stable')
+
+            # テープは保存済みの最後のidより新しい約定のみ追記されるため、
+            # 既存の日に古い約定を追加する場合に備えて作り直す
+            p_tape_path = tape_path(product_code, target_date)
+            if path_exists(p_tape_path):
+                rm_file(p_tape_path)
+            save_day_executions(
+                product_code, target_date, df, region=region, archive=target_date <= archive_cutoff_date)
+            coverages[target_date.strftime('%Y-%m-%d')] = day_coverage(df)
+            saved_rows[target_date] = len(df)
+            logger.info(f'[{product_code} {target_date}] {len(df)}件の約定を保存しました。')
+    finally:
+        shutil.rmtree(p_spool_dir, ignore_errors=True)
+        # 途中で失敗した場合も、保存済みの日の範囲は記録する
+        register_coverage(product_code, coverages, source='import')
+
+    for year, month in sorted({(target_date.year, target_date.month) for target_date in saved_rows}):
+        gen_execution_summaries(product_code=product_code, year=year, month=month)
+
+    logger.info(f'[{product_code} {p_dump_path}] {len(saved_rows)}日分の約定を取り込みました。')
+    return saved_rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='外部の約定履歴を取り込む')
+    parser.add_argument('product_code')
+    parser.add_argument('dump_path')
+    parser.add_argument('--processes', type=int, default=None)
+    args = parser.parse_args()
+    import_dump(args.product_code, args.dump_path, processes=args.processes)
@@ -0,0 +1,393 @@
+import datetime
+import math
+from collections import deque
+from logging import getLogger
+from pathlib import Path
+
+import pandas as pd
+
+from manage import EXECUTION_HISTORY_DIR
+from utils import path_exists, read_csv, read_json, write_json
+
+logger = getLogger(__name__)
+
+# latest_summaryの期間 -> (使用するリサンプリング間隔, 傾きを求める本数)
+TREND_SPECS = {
+    '6h': ('10m', 36),
+    '12h': ('10m', 72),
+    '1d': ('1h', 24),
+    '1w': ('1h', 168),
+    '1m': ('1d', 30),
+    '1y': ('1d', 365),
+    'all': ('1d', 730),
+}
+
+FREQUENCIES = {
+    '10m': datetime.timedelta(minutes=10),
+    '1h': datetime.timedelta(hours=1),
+    '1d': datetime.timedelta(days=1),
+}
+
+
+class EMA:
+    def __init__(self, period, value=None):
+        self.period = period
+        self.alpha = 2 / (period + 1)
+        self.value = value
+
+    def update(self, x):
+        if self.value is None:
+            self.value = x
+        else:
+            self.value += self.alpha * (x - self.value)
+        return self.value
+
+    def to_state(self):
+        return {'period': self.period, 'value': self.value}
+
+
+class SMA:
+    def __init__(self, period, values=()):
+        self.period = period
+        self.values = deque(values, maxlen=period)
+        self.total = sum(self.values)
+
+    @property
+    def value(self):
+        if len(self.values) == 0:
+            return None
+        return self.total / len(self.values)
+
+    def update(self, x):
+        if len(self.values) == self.period:
+            self.total -= self.values[0]
+        self.values.append(x)
+        self.total += x
+        return self.value
+
+    def to_state(self):
+        return {'period': self.period, 'values': list(self.values)}
+
+
+class RSI:
+    """Wilderの平滑化によるRSI"""
+
+    def __init__(self, period=14, avg_gain=None, avg_loss=None, prev_close=None):
+        self.period = period
+        self.avg_gain = avg_gain
+        self.avg_loss = avg_loss
+        self.prev_close = prev_close
+
+    @property
+    def value(self):
+        if self.avg_gain is None:
+            return None
+        if self.avg_loss == 0:
+            return 100.0
+        return 100 - 100 / (1 + self.avg_gain / self.avg_loss)
+
+    def update(self, close):
+        if self.prev_close is not None:
+            change = close - self.prev_close
+            gain = max(change, 0)
+            loss = max(-change, 0)
+            if self.avg_gain is None:
+                self.avg_gain = gain
+                self.avg_loss = loss
+            else:
+                self.avg_gain += (gain - self.avg_gain) / self.period
+                self.avg_loss += (loss - self.avg_loss) / self.period
+        self.prev_close = close
+        return self.value
+
+    def to_state(self):
+        return {
+            'period': self.period,
+            'avg_gain': self.avg_gain,
+            'avg_loss': self.avg_loss,
+            'prev_close': self.prev_close,
+        }
+
+
+class ATR:
+    """Wilderの平滑化によるATR"""
+
+    def __init__(self, period=14, value=None, prev_close=None):
+        self.period = period
+        self.value = value
+        self.prev_close = prev_close
+
+    def update(self, high, low, close):
+        if self.prev_close is None:
+            true_range = high - low
+        else:
+            true_range = max(high - low, abs(high - self.prev_close), abs(low - self.prev_close))
+        if self.value is None:
+            self.value = true_range
+        else:
+            self.value += (true_range - self.value) / self.period
+        self.prev_close = close
+        return self.value
+
+    def to_state(self):
+        return {'period': self.period, 'value': self.value, 'prev_close': self.prev_close}
+
+
+class BollingerBands:
+    def __init__(self, period=20, k=2, values=()):
+        self.period = period
+        self.k = k
+        self.values = deque(values, maxlen=period)
+        self.total = sum(self.values)
+        self.total_sq = sum(x * x for x in self.values)
+
+    @property
+    def value(self):
+        n = len(self.values)
+        if n == 0:
+            return None
+        mid = self.total / n
+        std = math.sqrt(max(self.total_sq / n - mid * mid, 0))
+        return {'mid': mid, 'upper': mid + self.k * std, 'lower': mid - self.k * std}
+
+    def update(self, x):
+        if len(self.values) == self.period:
+            oldest = self.values[0]
+            self.total -= oldest
+            self.total_sq -= oldest * oldest
+        self.values.append(x)
+        self.total += x
+        self.total_sq += x * x
+        return self.value
+
+    def to_state(self):
+        return {'period': self.period, 'k': self.k, 'values': list(self.values)}
+
+
+class LinearRegressionSlope:
+    """直近period本に対する最小二乗法の傾き
+
+    x = 0, 1, ..., n-1 としたときのΣy, Σxyを保持し、
+    古い値が抜けるときは Σxy' = Σxy - (Σy - y_0) + (n-1)y_new で更新する。
+    """
+
+    def __init__(self, period, values=()):
+        self.period = period
+        self.values = deque(maxlen=period)
+        self.sum_y = 0.0
+        self.sum_xy = 0.0
+        for y in values:
+            self.update(y)
+
+    @property
+    def value(self):
+        n = len(self.values)
+        if n < 2:
+            return None
+        sum_x = n * (n - 1) / 2
+        sum_x2 = (n - 1) * n * (2 * n - 1) / 6
+        return (n * self.sum_xy - sum_x * self.sum_y) / (n * sum_x2 - sum_x * sum_x)
+
+    def update(self, y):
+        n = len(self.values)
+        if n == self.period:
+            oldest = self.values[0]
+            self.sum_xy += -(self.sum_y - oldest) + (n - 1) * y
+            self.sum_y += y - oldest
+        else:
+            self.sum_xy += n * y
+            self.sum_y += y
+        self.values.append(y)
+        return self.value
+
+    def to_state(self):
+        return {'period': self.period, 'values': list(self.values)}
+
+
+class IndicatorSet:
+    """1つのリサンプリング間隔に対する指標一式"""
+
+    def __init__(self, freq, slope_periods, state=None):
+        self.freq = freq
+        state = state or {}
+        self.last_ts = state.get('last_ts')
+        self.ema_fast = EMA(**state.get('ema_fast', {'period': 12}))
+        self.ema_slow = EMA(**state.get('ema_slow', {'period': 26}))
+        self.sma = SMA(**state.get('sma', {'period': 20}))
+        self.rsi = RSI(**state.get('rsi', {'period': 14}))
+        self.atr = ATR(**state.get('atr', {'period': 14}))
+        self.bollinger = BollingerBands(**state.get('bollinger', {'period': 20}))
+        slope_states = state.get('slopes', {})
+        self.slopes = {
+            period: LinearRegressionSlope(**slope_states.get(str(period), {'period': period}))
+            for period in slope_periods
+        }
+
+    def update(self, ts, high, low, close):
+        """新しい足を1本追加する(処理済みの足は無視する)"""
+        if self.last_ts is not None and ts <= self.last_ts:
+            return False
+        self.ema_fast.update(close)
+        self.ema_slow.update(close)
+        self.sma.update(close)
+        self.rsi.update(close)
+        self.atr.update(high, low, close)
+        self.bollinger.update(close)
+        for slope in self.slopes.values():
+            slope.update(close)
+        self.last_ts = ts
+        return True
+
+    def fill_gap(self, ts, step_ns):
+        """前回の足からtsまでの約定がなかった区間を、直前の終値の足で埋める
+
+        足は約定があった区間のみ保存しているため、本数が時間の長さと対応するように補完する
+        (preprocess.densify_barsと同じ前方補完)。
+        """
+        close = self.atr.prev_close
+        if self.last_ts is None or close is None:
+            return 0
+        count = 0
+        next_ts = self.last_ts + step_ns
+        while next_ts < ts:
+            self.update(next_ts, close, close, close)
+            count += 1
+            next_ts += step_ns
+        return count
+
+    def snapshot(self):
+        return {
+            'ema_fast': self.ema_fast.value,
+            'ema_slow': self.ema_slow.value,
+            'sma': self.sma.value,
+            'rsi': self.rsi.value,
+            'atr': self.atr.value,
+            'bollinger': self.bollinger.value,
+            'slopes': {period: slope.value for period, slope in self.slopes.items()},
+        }
+
+    def to_state(self):
+        return {
+            'last_ts': self.last_ts,
+            'ema_fast': self.ema_fast.to_state(),
+            'ema_slow': self.ema_slow.to_state(),
+            'sma': self.sma.to_state(),
+            'rsi': self.rsi.to_state(),
+            'atr': self.atr.to_state(),
+            'bollinger': self.bollinger.to_state(),
+            'slopes': {str(period): slope.to_state() for period, slope in self.slopes.items()},
+        }
+
+
+class IndicatorEngine:
+    """保存済みの足から指標を逐次更新し、状態を呼び出し間で保持する
+
+    前回処理した足の時刻を記録しておき、それ以降に確定した足のみを追加するため、
+    1回の実行の計算量は前回からの経過時間に比例する。
+    """
+
+    def __init__(self, product_code):
+        self.product_code = product_code
+        self.p_product_dir = Path(EXECUTION_HISTORY_DIR).joinpath(product_code)
+        self.p_state_path = self.p_product_dir.joinpath('indicators.json')
+
+        state = {}
+        if path_exists(self.p_state_path):
+            state = read_json(self.p_state_path)
+
+        self.indicator_sets = {}
+        for side in ['BUY', 'SELL']:
+            for freq in FREQUENCIES.keys():
+                slope_periods = sorted({
+                    period for spec_freq, period in TREND_SPECS.values() if spec_freq == freq
+                })
+                self.indicator_sets[(side, freq)] = IndicatorSet(
+                    freq, slope_periods, state.get(f'{side}_{freq}'))
+
+    def _max_period(self, freq):
+        return max(self.indicator_sets[('BUY', freq)].slopes.keys())
+
+    def _day_dir(self, target_date):
+        return self.p_product_dir.joinpath(
+            target_date.strftime('%Y'), target_date.strftime('%m'), target_date.strftime('%d'))
+
+    def _read_intraday_bars(self, freq, side, target_date):
+        p_path = self._day_dir(target_date).joinpath(freq, f'{side.lower()}.csv')
+        if not path_exists(p_path):
+            return []
+        df = read_csv(str(p_path))
+        df = df.dropna(subset=['close_price'])
+        timestamps = pd.to_datetime(df['exec_date'], utc=True).values.astype('int64')
+        return list(zip(
+            timestamps.tolist(),
+            df['high_price'].values.tolist(),
+            df['low_price'].values.tolist(),
+            df['close_price'].values.tolist(),
+        ))
+
+    def _read_daily_bar(self, side, target_date):
+        p_path = self._day_dir(target_date).joinpath('summary.csv')
+        if not path_exists(p_path):
+            return []
+        df_summary = read_csv(str(p_path)).set_index('CATEGORY')
+        ts = pd.Timestamp(target_date).tz_localize('Asia/Tokyo').value
+        return [(
+            ts,
+            float(df_summary.at['high_price', side]),
+            float(df_summary.at['low_price', side]),
+            float(df_summary.at['close_price', side]),
+        )]
+
+    def update(self, current_datetime):
+        """current_datetimeまでに確定した足を全ての指標に追加する"""
+        current_ts = pd.Timestamp(current_datetime).value
+        for (side, freq), indicator_set in self.indicator_sets.items():
+            step = FREQUENCIES[freq]
+            # 前回の処理から本数以上経過している場合は、必要な本数だけで初期化する
+            warmup_start = current_datetime - step * (self._max_period(freq) + 1)
+            if indicator_set.last_ts is None or pd.Timestamp(indicator_set.last_ts, tz='UTC') < warmup_start:
+                slope_periods = list(indicator_set.slopes.keys())
+                indicator_set = IndicatorSet(freq, slope_periods)
+                self.indicator_sets[(side, freq)] = indicator_set
+                start_date = warmup_start.date()
+            else:
+                start_date = pd.Timestamp(indicator_set.last_ts, tz='UTC').tz_convert('Asia/Tokyo').date()
+
+            target_date = start_date
+            end_date = current_datetime.date()
+            added_count = 0
+            while target_date <= end_date:
+                if freq == '1d':
+                    # 当日の足は確定していない
+                    bars = [] if target_date == end_date else self._read_daily_bar(side, target_date)
+                else:
+                    bars = self._read_intraday_bars(freq, side, target_date)
+                step_ns = int(step.total_seconds() * 1e9)
+                for ts, high, low, close in bars:
+                    if ts + step_ns > current_ts:
+                        continue
+                    if indicator_set.last_ts is not None and ts <= indicator_set.last_ts:
+                        continue
+                    if freq != '1d':
+                        added_count += indicator_set.fill_gap(ts, step_ns)
+                    added_count += indicator_set.update(ts, high, low, close)
+                target_date += datetime.timedelta(days=1)
+            logger.debug(f'[{self.product_code} {side} {freq}] {added_count}本の足で指標を更新しました。')
+
+    def save(self):
+        state = {
+            f'{side}_{freq}': indicator_set.to_state()
+            for (side, freq), indicator_set in self.indicator_sets.items()
+        }
+        write_json(self.p_state_path, state)
+
+    def snapshot(self, side, freq):
+        return self.indicator_sets[(side, freq)].snapshot()
+
+    def trend(self, side, window):
+        """期間windowのトレンドを線形回帰の傾きから判定する"""
+        freq, period = TREND_SPECS[window]
+        slope = self.indicator_sets[(side, freq)].slopes[period].value
+        if slope is None:
+            return 'DOWN'
+        return 'UP' if slope > 0 else 'DOWN'
@@ -1,17 +1,21 @@
-import datetime
 import os
 from logging import (DEBUG, INFO, FileHandler, StreamHandler, basicConfig,
                      getLogger)
 from pathlib import Path
 
+import bitflyer_api
+import clock
 import pandas as pd
 from ai import AI
-from bitflyer_api import get_board_state
 from dateutil.relativedelta import relativedelta
-from manage import PROFIT_DIR, REF_LOCAL, VOLUME_DIR
-from preprocess import (delete_row_data, gen_execution_summaries,
+from features import update_features
+from lease import StorageLease
+from manage import (ORDERS_LEASE_NAME, PROFIT_DIR, REF_LOCAL,
+                    ROW_RETENTION_DAYS, VOLUME_DIR)
+from predictor import InferenceHook
+from preprocess import (compact_row_data, gen_execution_summaries,
                         get_executions_history, obtain_latest_summary)
-from utils import df_to_csv, path_exists, read_csv
+from utils import df_to_csv, path_exists, read_csv, report_write_stats
 
 if REF_LOCAL:
     sh = StreamHandler()
@@ -40,6 +44,9 @@ else:
 
 logger = getLogger(__name__)
 
+# 取引所(残高・注文・板の状態の取得先)。simulate.run_scheduleではbacktest.SimulatedExchangeに置き換える
+exchange = bitflyer_api
+
 
 def calc_profit(product_code, child_orders, latest_summary):
     """利益を計算する関数
@@ -60,7 +67,7 @@ def calc_profit(product_code, child_orders, latest_summary):
     p_monthly_profit_path = p_profit_dir.joinpath('monthly_profit.csv')
     p_yearly_profit_path = p_profit_dir.joinpath('yearly_profit.csv')
 
-    current_datetime = datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=9)))
+    current_datetime = clock.now()
 
     current_month_start_datetime = current_datetime.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
     current_month_end_datetime = current_month_start_datetime + relativedelta(months=+1)
@@ -256,7 +263,7 @@ def calc_volume(product_code, child_orders):
     p_monthly_volume_path = p_volume_dir.joinpath('monthly_volume.csv')
     p_yearly_volume_path = p_volume_dir.joinpath('yearly_volume.csv')
 
-    current_datetime = datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=9)))
+    current_datetime = clock.now()
 
     current_month_start_datetime = current_datetime.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
     current_month_end_datetime = current_month_start_datetime + relativedelta(months=+1)
@@ -417,23 +424,40 @@ def calc_volume(product_code, child_orders):
         df_to_csv(str(p_yearly_volume_path), df_yearly_volume, index=True)
 
 
+def create_ai(product_code, latest_summary, inference_hook=None):
+    """環境変数の設定でAIを作成する"""
+    return AI(
+        product_code=product_code,
+        min_size=float(os.environ.get(f'{product_code}_MIN_SIZE', 0)),
+        min_volume_short=float(os.environ.get(f'{product_code}_SHORT_MIN_VOLUME', 1000)),
+        max_volume_short=float(os.environ.get(f'{product_code}_SHORT_MAX_VOLUME', 10000)),
+        min_volume_long=float(os.environ.get(f'{product_code}_LONG_MIN_VOLUME', 10000)),
+        max_volume_long=float(os.environ.get(f'{product_code}_LONG_MAX_VOLUME', 30000)),
+        min_reward_rate=float(os.environ.get(f'{product_code}_MIN_REWARD_RATE', 0.01)),
+        min_local_price_gap_rate=float(os.environ.get(f'{product_code}_MIN_LOCAL_PRICE_GAP_RATE', 0.03)),
+        time_diff=9,
+        latest_summary=latest_summary,
+        inference_hook=inference_hook,
+        exchange=exchange
+    )
+
+
 def trading(product_code):
-    board_state = get_board_state(product_code)
+    board_state = exchange.get_board_state(product_code)
     if board_state['state'] != 'RUNNING':
         logger.info(
             f'[{product_code} {board_state["state"]}] 現在取引所は稼働していません。')
         return
 
-    current_datetime = datetime.datetime.now(
-        datetime.timezone(datetime.timedelta(hours=9)))
+    current_datetime = clock.now()
 
-    logger.info(f'[{product_code}] 不必要な生データを削除中...')
-    delete_row_data(
+    logger.info(f'[{product_code}] 不必要な生データを圧縮中...')
+    compact_row_data(
         product_code=product_code,
         current_datetime=current_datetime,
-        days=7
+        days=ROW_RETENTION_DAYS
     )
-    logger.info(f'[{product_code}] 不必要な生データの削除完了')
+    logger.info(f'[{product_code}] 不必要な生データの圧縮完了')
 
     logger.info(f'[{product_code}] 取引情報更新中...')
     latest_summary = obtain_latest_summary(
@@ -441,65 +465,128 @@ def trading(product_code):
     )
     logger.info(f'[{product_code}] 取引情報更新完了')
 
-    ai = AI(
-        product_code=product_code,
-        min_size=float(os.environ.get(f'{product_code}_MIN_SIZE', 0)),
-        min_volume_short=float(os.environ.get(f'{product_code}_SHORT_MIN_VOLUME', 1000)),
-        max_volume_short=float(os.environ.get(f'{product_code}_SHORT_MAX_VOLUME', 10000)),
-        min_volume_long=float(os.environ.get(f'{product_code}_LONG_MIN_VOLUME', 10000)),
-        max_volume_long=float(os.environ.get(f'{product_code}_LONG_MAX_VOLUME', 30000)),
-        min_reward_rate=float(os.environ.get(f'{product_code}_MIN_REWARD_RATE', 0.01)),
-        min_local_price_gap_rate=float(os.environ.get(f'{product_code}_MIN_LOCAL_PRICE_GAP_RATE', 0.03)),
-        time_diff=9,
-        latest_summary=latest_summary
-    )
-
-    logger.info(f'[{product_code}] 注文中...')
-    if int(os.environ.get(f'{product_code}_LONG', 0)):
-        ai.long_term()
-    if int(os.environ.get(f'{product_code}_SHORT', 0)):
-        ai.short_term()
-
-    if int(os.environ.get(f'{product_code}_DCA_MAX_VOLUME_MONTHLY', 0)) != 0:
-        ai.dca(
-            min_volume=float(os.environ.get(f'{product_code}_DCA_MIN_VOLUME_MONTHLY', 0)),
-            max_volume=float(os.environ.get(f'{product_code}_DCA_MAX_VOLUME_MONTHLY', 0)),
-            st_buy_price_rate=float(os.environ.get(f'{product_code}_DCA_ST_BUY_PRICE_RATE', 1)),
-            price_rate=float(os.environ.get(f'{product_code}_DCA_PRICE_RATE_MONTHLY', 1)),
-            cycle='monthly'
-        )
-    if int(os.environ.get(f'{product_code}_DCA_MAX_VOLUME_WEEKLY', 0)) != 0:
-        ai.dca(
-            min_volume=float(os.environ.get(f'{product_code}_DCA_MIN_VOLUME_WEEKLY', 0)),
-            max_volume=float(os.environ.get(f'{product_code}_DCA_MAX_VOLUME_WEEKLY', 0)),
-            st_buy_price_rate=float(os.environ.get(f'{product_code}_DCA_ST_BUY_PRICE_RATE', 1)),
-            price_rate=float(os.environ.get(f'{product_code}_DCA_PRICE_RATE_WEEKLY', 1)),
-            cycle='weekly'
+    inference_hook = None
+    if os.environ.get('MODEL_PATH'):
+        # 推論には当日分までの特徴量が必要になる(作成済みの日は計算しない)
+        update_features(
+            product_code,
+            clock.now(),
+            time_budget=float(os.environ.get('FEATURE_TIME_BUDGET', 10.0))
         )
-    if int(os.environ.get(f'{product_code}_DCA_MAX_VOLUME_DAILY', 0)) != 0:
-        ai.dca(
-            min_volume=float(os.environ.get(f'{product_code}_DCA_MIN_VOLUME_DAILY', 0)),
-            max_volume=float(os.environ.get(f'{product_code}_DCA_MAX_VOLUME_DAILY', 0)),
-            st_buy_price_rate=float(os.environ.get(f'{product_code}_DCA_ST_BUY_PRICE_RATE', 1)),
-            price_rate=float(os.environ.get(f'{product_code}_DCA_PRICE_RATE_DAILY', 1)),
-            cycle='daily'
+        inference_hook = InferenceHook(
+            model_path=os.environ.get('MODEL_PATH'),
+            timeout=float(os.environ.get('INFERENCE_TIMEOUT', 2.0))
         )
 
-    logger.info(f'[{product_code}] 注文完了')
+    # 注文履歴・残高の台帳はrealtime.OrderEventSubscriberも更新するため、読み込みから保存までを排他にする
+    lease = StorageLease(ORDERS_LEASE_NAME)
+    if not lease.acquire(timeout=float(os.environ.get('ORDERS_LEASE_TIMEOUT', 60))):
+        logger.warning(f'[{product_code}] 注文履歴を更新中のプロセスがあるため、今回の注文を見送ります。')
+        return
+
+    try:
+        ai = create_ai(product_code, latest_summary, inference_hook=inference_hook)
+    except Exception:
+        lease.release()
+        raise
+
+    try:
+        logger.info(f'[{product_code}] 注文中...')
+        # 送信・キャンセルした注文は、Lambdaがタイムアウトしても失われないよう注文の種類ごとに確定する
+        if int(os.environ.get(f'{product_code}_LONG', 0)):
+            ai.long_term()
+            ai.commit()
+        if int(os.environ.get(f'{product_code}_SHORT', 0)):
+            ai.short_term()
+            ai.commit()
+
+        if int(os.environ.get(f'{product_code}_DCA_MAX_VOLUME_MONTHLY', 0)) != 0:
+            ai.dca(
+                min_volume=float(os.environ.get(f'{product_code}_DCA_MIN_VOLUME_MONTHLY', 0)),
+                max_volume=float(os.environ.get(f'{product_code}_DCA_MAX_VOLUME_MONTHLY', 0)),
+                st_buy_price_rate=float(os.environ.get(f'{product_code}_DCA_ST_BUY_PRICE_RATE', 1)),
+                price_rate=float(os.environ.get(f'{product_code}_DCA_PRICE_RATE_MONTHLY', 1)),
+                cycle='monthly'
+            )
+            ai.commit()
+        if int(os.environ.get(f'{product_code}_DCA_MAX_VOLUME_WEEKLY', 0)) != 0:
+            ai.dca(
+                min_volume=float(os.environ.get(f'{product_code}_DCA_MIN_VOLUME_WEEKLY', 0)),
+                max_volume=float(os.environ.get(f'{product_code}_DCA_MAX_VOLUME_WEEKLY', 0)),
+                st_buy_price_rate=float(os.environ.get(f'{product_code}_DCA_ST_BUY_PRICE_RATE', 1)),
+                price_rate=float(os.environ.get(f'{product_code}_DCA_PRICE_RATE_WEEKLY', 1)),
+                cycle='weekly'
+            )
+            ai.commit()
+        if int(os.environ.get(f'{product_code}_DCA_MAX_VOLUME_DAILY', 0)) != 0:
+            ai.dca(
+                min_volume=float(os.environ.get(f'{product_code}_DCA_MIN_VOLUME_DAILY', 0)),
+                max_volume=float(os.environ.get(f'{product_code}_DCA_MAX_VOLUME_DAILY', 0)),
+                st_buy_price_rate=float(os.environ.get(f'{product_code}_DCA_ST_BUY_PRICE_RATE', 1)),
+                price_rate=float(os.environ.get(f'{product_code}_DCA_PRICE_RATE_DAILY', 1)),
+                cycle='daily'
+            )
+            ai.commit()
+
+        logger.info(f'[{product_code}] 注文完了')
+
+        ai.update_child_orders(term='long')
+        ai.update_child_orders(term='short')
+        ai.update_child_orders(term='dca')
+
+        logger.info(f'[{product_code}] 利益集計中...')
+        ai.update_unrealized_profit(term='long')
+        ai.update_unrealized_profit(term='dca')
+        child_orders = ai.child_orders
+        calc_profit(product_code, child_orders, latest_summary)
+        logger.info(f'[{product_code}] 利益集計完了')
+
+        logger.info(f'[{product_code}] 取引量集計中...')
+        calc_volume(product_code, child_orders)
+        logger.info(f'[{product_code}] 取引量集計完了')
+    finally:
+        # 残りの注文履歴・残高の変更を確定・保存してから、リースを解放する
+        try:
+            ai.commit()
+            ai.close()
+        finally:
+            lease.release()
+        # 実行中の通知を1件にまとめて送信する(Lambdaが停止する前に送り終える)
+        ai.line_notify.flush(timeout=float(os.environ.get('NOTIFY_FLUSH_TIMEOUT', 3.0)))
+
+    logger.info(f'[{product_code}] 参照した集計期間: {latest_summary.used_windows}')
+
+
+def compaction(product_code, days=ROW_RETENTION_DAYS, scan_days=365):
+    """生データの圧縮のみを行うジョブ"""
+    current_datetime = clock.now()
+
+    logger.info(f'[{product_code}] 生データの圧縮ジョブ開始')
+    report = compact_row_data(
+        product_code=product_code,
+        current_datetime=current_datetime,
+        days=days,
+        scan_days=scan_days
+    )
+    logger.info(
+        f'[{product_code}] 生データの圧縮ジョブ完了 '
+        + f'({report["days"]}日 {report["rows"]}行 {report["archived_bytes"]}B {report["deleted_files"]}ファイル削除)'
+    )
+    return report
 
-    ai.update_child_orders(term='long')
-    ai.update_child_orders(term='short')
-    ai.update_child_orders(term='dca')
 
-    logger.info(f'[{product_code}] 利益集計中...')
-    ai.update_unrealized_profit(term='long')
-    ai.update_unrealized_profit(term='dca')
-    calc_profit(product_code, ai.child_orders, latest_summary)
-    logger.info(f'[{product_code}] 利益集計完了')
+def features(product_code, days=30):
+    """特徴量の作成のみを行うジョブ"""
+    current_datetime = clock.now()
 
-    logger.info(f'[{product_code}] 取引量集計中...')
-    calc_volume(product_code, ai.child_orders)
-    logger.info(f'[{product_code}] 取引量集計完了')
+    logger.info(f'[{product_code}] 特徴量作成ジョブ開始')
+    day_count = update_features(
+        product_code=product_code,
+        current_datetime=current_datetime,
+        days=days
+    )
+    logger.info(f'[{product_code}] 特徴量作成ジョブ完了 ({day_count}日)')
+    return day_count
 
 
 def lambda_handler(event, context):
@@ -511,9 +598,33 @@ def lambda_handler(event, context):
         # 'XRP_JPY',
         # 'MONA_JPY',
     ]
+
+    # event例: {"job": "compaction", "days": 7, "scan_days": 365}
+    if isinstance(event, dict) and event.get('job') == 'compaction':
+        for product_code in product_code_list:
+            compaction(
+                product_code=product_code,
+                days=int(event.get('days', ROW_RETENTION_DAYS)),
+                scan_days=int(event.get('scan_days', 365))
+            )
+        report_write_stats()
+        return
+
+    # event例: {"job": "features", "days": 30}
+    if isinstance(event, dict) and event.get('job') == 'features':
+        for product_code in product_code_list:
+            features(
+                product_code=product_code,
+                days=int(event.get('days', 30))
+            )
+        report_write_stats()
+        return
+
     for product_code in product_code_list:
         trading(product_code=product_code)
 
+    report_write_stats()
+
         # load data
         # current_datetime = datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=9)))
         # before_15d_datetime = current_datetime - datetime.timedelta(days=15)
@@ -0,0 +1,84 @@
+import os
+from logging import getLogger
+from pathlib import Path
+
+import clock
+from manage import LEASE_DIR
+from utils import path_exists, read_json, rm_file, write_json
+
+logger = getLogger(__name__)
+
+
+def lease_path(name):
+    return Path(LEASE_DIR).joinpath(f'{name}.json')
+
+
+class StorageLease:
+    """ストレージ上のファイルによる、期限付きの排他(ベストエフォート)
+
+    S3には条件付きの書き込みがないため、空いている(存在しない・期限切れの)リースに
+    自分のトークンを書き込み、settle秒待ってから読み直して自分のトークンが残っていれば取得とする。
+    同時に書き込んだ場合は後に書いた方だけが残るため、両方が取得したと判断することはほぼない。
+    プロセスが途中で停止した場合も、ttl秒が経過すれば他のプロセスが取得できる。
+
+    Args:
+        name (str): リースの名前(lease/<name>.json)
+        ttl (float, optional): 有効期間(秒)。保持する処理の最長の時間より長くする
+        settle (float, optional): 書き込んでから読み直すまでの待ち時間(秒)
+        retry_interval (float, optional): 取得できなかった場合に再試行する間隔(秒)
+    """
+
+    def __init__(self, name, ttl=900, settle=0.5, retry_interval=1.0):
+        self.name = name
+        self.p_path = lease_path(name)
+        self.ttl = ttl
+        self.settle = settle
+        self.retry_interval = retry_interval
+        self.token = os.urandom(16).hex()
+        self.held = False
+
+    def _read(self):
+        if not path_exists(self.p_path):
+            return None
+        try:
+            return read_json(self.p_path)
+        except (OSError, ValueError):
+            # 削除と同時に読み込んだ場合など
+            return None
+
+    def _try_acquire(self):
+        lease = self._read()
+        if lease is not None and lease['owner'] != self.token and lease['expires_at'] > clock.time():
+            return False
+        write_json(self.p_path, {'owner': self.token, 'expires_at': clock.time() + self.ttl})
+        clock.sleep(self.settle)
+        lease = self._read()
+        return lease is not None and lease['owner'] == self.token
+
+    def acquire(self, timeout=0):
+        """リースを取得する
+
+        Args:
+            timeout (float, optional): 取得できるまで待つ秒数
+
+        Returns:
+            bool: 取得できたかどうか
+        """
+        deadline = clock.time() + timeout
+        while True:
+            if self._try_acquire():
+                self.held = True
+                return True
+            if clock.time() + self.retry_interval > deadline:
+                logger.warning(f'[{self.name}] 他のプロセスが保持しているため、リースを取得できませんでした。')
+                return False
+            clock.sleep(self.retry_interval)
+
+    def release(self):
+        """保持している場合のみ削除する(期限切れの後に他のプロセスが取得したリースは消さない)"""
+        if not self.held:
+            return
+        self.held = False
+        lease = self._read()
+        if lease is not None and lease['owner'] == self.token:
+            rm_file(self.p_path)
@@ -0,0 +1,189 @@
+from bisect import bisect_left, bisect_right, insort
+from collections import defaultdict
+
+import pandas as pd
+
+# 集計時に計算する列(保存されていても読み込まない)
+DERIVED_COLUMNS = ['cumsum_profit']
+
+
+class OrderRecord:
+    """注文1件。判定に使う列は属性として、その他のAPIの列はextraに保持する"""
+
+    FIELDS = (
+        'side',
+        'child_order_state',
+        'child_order_cycle',
+        'related_child_order_acceptance_id',
+        'price',
+        'size',
+        'child_order_date',
+        'total_commission',
+        'total_commission_yen',
+        'profit',
+        'volume',
+    )
+
+    __slots__ = ('seq', 'child_order_acceptance_id', 'extra') + FIELDS
+
+    def __init__(self, seq, child_order_acceptance_id, values):
+        self.seq = seq
+        self.child_order_acceptance_id = child_order_acceptance_id
+        self.extra = {}
+        for field in self.FIELDS:
+            setattr(self, field, None)
+        self.update(values)
+
+    def update(self, values):
+        for key, value in values.items():
+            if key in self.FIELDS:
+                setattr(self, key, value)
+            elif key not in DERIVED_COLUMNS:
+                self.extra[key] = value
+
+    def to_dict(self):
+        values = dict(self.extra)
+        for field in self.FIELDS:
+            values[field] = getattr(self, field)
+        return values
+
+
+def _date_ns(value):
+    if value is None or pd.isna(value):
+        return None
+    return pd.Timestamp(value).value
+
+
+class OrderLedger:
+    """1つのterm(long, short, dca)の注文を保持し、条件ごとの注文をインデックスから取り出す
+
+    インデックス:
+        (side, child_order_state, child_order_cycle) -> 注文
+        related_child_order_acceptance_id -> 注文
+        child_order_date の昇順
+
+    取り出した注文は、DataFrameの行の順(追加順)に並べて返す。
+    """
+
+    def __init__(self, columns=()):
+        self.columns = [col for col in columns if col not in DERIVED_COLUMNS]
+        self._records = {}
+        self._by_key = defaultdict(dict)
+        self._by_related = defaultdict(dict)
+        # (child_order_dateのepoch ns, seq, child_order_acceptance_id)の昇順
+        self._dates = []
+        self._seq = 0
+
+    @classmethod
+    def from_frame(cls, df):
+        """indexがchild_order_acceptance_idのDataFrameから作成する"""
+        ledger = cls(columns=df.columns)
+        for child_order_acceptance_id, values in zip(df.index.tolist(), df.to_dict(orient='records')):
+            ledger.upsert(child_order_acceptance_id, values)
+        return ledger
+
+    def to_frame(self):
+        """保存用のDataFrame(従来のcsvと同じ列、cumsum_profitを含む)"""
+        if len(self._records) == 0:
+            return pd.DataFrame()
+        df = pd.DataFrame(
+            [record.to_dict() for record in self._records.values()],
+            index=pd.Index(list(self._records.keys()), name='child_order_acceptance_id'),
+        )
+        columns = self.columns + [col for col in df.columns if col not in self.columns]
+        df = df[columns]
+        df['cumsum_profit'] = df['profit'].cumsum()
+        return df
+
+    def __len__(self):
+        return len(self._records)
+
+    def __contains__(self, child_order_acceptance_id):
+        return child_order_acceptance_id in self._records
+
+    def __iter__(self):
+        return iter(self._records.values())
+
+    @property
+    def empty(self):
+        return len(self._records) == 0
+
+    def get(self, child_order_acceptance_id):
+        return self._records.get(child_order_acceptance_id)
+
+    def _key(self, record):
+        return (record.side, record.child_order_state, record.child_order_cycle)
+
+    def _unindex(self, record):
+        self._by_key[self._key(record)].pop(record.child_order_acceptance_id, None)
+        self._by_related[record.related_child_order_acceptance_id].pop(record.child_order_acceptance_id, None)
+        date_ns = _date_ns(record.child_order_date)
+        if date_ns is not None:
+            entry = (date_ns, record.seq, record.child_order_acceptance_id)
+            i = bisect_left(self._dates, entry)
+            if i < len(self._dates) and self._dates[i] == entry:
+                del self._dates[i]
+
+    def _index(self, record):
+        self._by_key[self._key(record)][record.child_order_acceptance_id] = record
+        self._by_related[record.related_child_order_acceptance_id][record.child_order_acceptance_id] = record
+        date_ns = _date_ns(record.child_order_date)
+        if date_ns is not None:
+            insort(self._dates, (date_ns, record.seq, record.child_order_acceptance_id))
+
+    def upsert(self, child_order_acceptance_id, values, seq=None):
+        """注文を追加、または指定した列を更新する
+
+        seqは追加順を表す番号で、保存済みの順序を復元する場合に指定する。
+        """
+        for key in values.keys():
+            if key not in self.columns and key not in DERIVED_COLUMNS:
+                self.columns.append(key)
+        record = self._records.get(child_order_acceptance_id)
+        if record is None:
+            self._seq = max(self._seq + 1, seq or 0)
+            record = OrderRecord(self._seq, child_order_acceptance_id, values)
+            self._records[child_order_acceptance_id] = record
+        else:
+            self._unindex(record)
+            record.update(values)
+        self._index(record)
+        return record
+
+    def delete(self, child_order_acceptance_id):
+        record = self._records.pop(child_order_acceptance_id)
+        self._unindex(record)
+        return record
+
+    def select(self, side=None, state=None, cycle=None, related=None):
+        """条件に一致する注文(Noneの条件は問わない)"""
+        if related is not None:
+            candidates = self._by_related.get(related, {}).values()
+            records = [
+                record for record in candidates
+                if (side is None or record.side == side)
+                and (state is None or record.child_order_state == state)
+                and (cycle is None or record.child_order_cycle == cycle)
+            ]
+        elif side is not None and state is not None and cycle is not None:
+            records = list(self._by_key.get((side, state, cycle), {}).values())
+        else:
+            records = []
+            for (key_side, key_state, key_cycle), bucket in self._by_key.items():
+                if (side is None or key_side == side) \
+                        and (state is None or key_state == state) \
+                        and (cycle is None or key_cycle == cycle):
+                    records.extend(bucket.values())
+        return sorted(records, key=lambda record: record.seq)
+
+    def since(self, target_datetime, side=None, state=None, cycle=None):
+        """child_order_dateがtarget_datetimeより後の注文"""
+        i = bisect_right(self._dates, (_date_ns(target_datetime), float('inf')))
+        records = []
+        for _, _, child_order_acceptance_id in self._dates[i:]:
+            record = self._records[child_order_acceptance_id]
+            if (side is None or record.side == side) \
+                    and (state is None or record.child_order_state == state) \
+                    and (cycle is None or record.child_order_cycle == cycle):
+                records.append(record)
+        return sorted(records, key=lambda record: record.seq)
@@ -1,4 +1,7 @@
 import os
+import queue
+import threading
+import time
 from logging import getLogger
 
 import requests
@@ -6,6 +9,10 @@ from manage import LOCAL
 
 logger = getLogger(__name__)
 
+# 1件のテキストメッセージの最大文字数と、1回のbroadcastで送れるメッセージ数
+MAX_TEXT_LENGTH = 5000
+MAX_MESSAGES_PER_REQUEST = 5
+
 if LOCAL:
     from dotenv import load_dotenv
     load_dotenv()
@@ -24,15 +31,19 @@ class LineMessagingAPIClient:
     def notify(self, message="message"):
         return self._broadcast(message)
 
+    def flush(self, timeout=None):
+        """同期的に送信するため、送信待ちの通知はない"""
+        return True
 
-    def _broadcast(self, message: str):
+    def _broadcast(self, message):
         """
         全ユーザーにテキストメッセージを送信（Broadcast）
-        :param message: 送信する文字列
+        :param message: 送信する文字列(またはそのリスト。最大5件)
         """
+        messages = [message] if isinstance(message, str) else message
         body = {
             "messages": [
-                {"type": "text", "text": message}
+                {"type": "text", "text": text} for text in messages
             ]
         }
         return self._post("broadcast", body)
@@ -52,3 +63,133 @@ class LineMessagingAPIClient:
         else:
             logger.warning(f"[LINE messaging] POST:{api_url} {response.status_code} {response.text}")
         return response
+
+
+def _split_text(text, max_length=MAX_TEXT_LENGTH):
+    """max_length以下のメッセージに分割する(なるべく改行で区切る)"""
+    chunks = []
+    while len(text) > max_length:
+        i = text.rfind('\n', 0, max_length)
+        if i <= 0:
+            i = max_length
+        chunks.append(text[:i])
+        text = text[i:].lstrip('\n')
+    if text:
+        chunks.append(text)
+    return chunks
+
+
+class NotificationDispatcher:
+    """通知をまとめて、バックグラウンドのスレッドでLINEに送信する
+
+    notifyはメッセージを溜めるだけで、通知サービスの応答を待たない(注文処理を遅らせない)。
+    flushで溜めたメッセージを1つのダイジェストにまとめて送信キューに入れ、
+    timeoutまでの間、送信の完了を待つ。キューが一杯の場合、ダイジェストは破棄する。
+    送信に失敗した場合(通信エラー, 429, 5xx)はretry_delaysの間隔で再送する。
+
+    Args:
+        client (LineMessagingAPIClient, optional): 送信に使うクライアント。省略した場合は最初の送信時に作成する
+        max_queue_size (int, optional): 送信待ちのダイジェストの最大数
+        retry_delays (tuple, optional): 再送までの待ち時間(秒)
+    """
+
+    def __init__(self, client=None, max_queue_size=20, retry_delays=(1, 2, 4)):
+        self._client = client
+        self.retry_delays = retry_delays
+        self._messages = []
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._pending_count = 0
+        self._done = threading.Condition()
+        self._thread = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = LineMessagingAPIClient()
+        return self._client
+
+    def notify(self, message="message"):
+        with self._lock:
+            self._messages.append(message.strip('\n'))
+
+    def _digest(self, messages):
+        if len(messages) == 1:
+            return messages[0]
+        return f"【{len(messages)}件の通知】\n" + "\n--------\n".join(messages)
+
+    def flush(self, timeout=3.0):
+        """溜めたメッセージを1つのダイジェストとして送信し、timeout秒まで送信の完了を待つ
+
+        timeout=0の場合は待たずに戻る(送信はバックグラウンドで続く)。
+
+        Returns:
+            bool: 送信待ちの通知がなくなった場合True
+        """
+        with self._lock:
+            messages, self._messages = self._messages, []
+        if len(messages) > 0:
+            with self._done:
+                self._pending_count += 1
+            try:
+                self._queue.put_nowait(self._digest(messages))
+            except queue.Full:
+                with self._done:
+                    self._pending_count -= 1
+                logger.warning(f"[LINE messaging] 送信待ちが多いため、{len(messages)}件の通知を破棄しました。")
+            self._start()
+
+        if timeout == 0:
+            with self._done:
+                return self._pending_count == 0
+
+        with self._done:
+            finished = self._done.wait_for(lambda: self._pending_count == 0, timeout=timeout)
+        if not finished:
+            logger.warning(f"[LINE messaging] {timeout}秒以内に送信が完了しませんでした。(残り{self._pending_count}件)")
+        return finished
+
+    def _start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='line-notification', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            digest = self._queue.get()
+            try:
+                self._send(digest)
+            finally:
+                with self._done:
+                    self._pending_count -= 1
+                    self._done.notify_all()
+
+    def _send(self, digest):
+        chunks = _split_text(digest)
+        for i in range(0, len(chunks), MAX_MESSAGES_PER_REQUEST):
+            messages = chunks[i:i + MAX_MESSAGES_PER_REQUEST]
+            for attempt in range(len(self.retry_delays) + 1):
+                try:
+                    response = self.client._broadcast(messages)
+                    if response.status_code == 200:
+                        break
+                    if response.status_code != 429 and response.status_code < 500:
+                        # 再送しても成功しない
+                        break
+                except requests.RequestException as e:
+                    logger.warning(f"[LINE messaging] 送信に失敗しました。({e!r})")
+                if attempt == len(self.retry_delays):
+                    logger.error(f"[LINE messaging] {attempt + 1}回送信に失敗したため、通知を破棄しました。")
+                    break
+                time.sleep(self.retry_delays[attempt])
+
+
+_default_dispatcher = None
+
+
+def default_dispatcher():
+    """プロセスで共有するNotificationDispatcher(最初の呼び出し時に作成する)"""
+    global _default_dispatcher
+    if _default_dispatcher is None:
+        _default_dispatcher = NotificationDispatcher()
+    return _default_dispatcher
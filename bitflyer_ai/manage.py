@@ -4,6 +4,57 @@ BUCKET_NAME = 'bitflyer-ai'
 
 CHILD_ORDERS_DIR = 'child_orders'
 BALANCE_LOG_DIR = 'balance_log'
+# 注文から更新する残高の台帳(一定間隔でget_balanceと照合する)
+BALANCE_DIR = 'balance'
+BALANCE_LEDGER_FILENAME = 'balance_ledger.json'
 EXECUTION_HISTORY_DIR = 'execute_history'
 PROFIT_DIR = 'profit'
 VOLUME_DIR = 'volume'
+# 保持期間を過ぎた生データの日ごとのアーカイブ(<YYYY>/<MM>/row_archive/<DD>.csv.gz)
+ROW_ARCHIVE_DIR = 'row_archive'
+# この日数以上前の日の生データはアーカイブにまとめる
+ROW_RETENTION_DAYS = 7
+# 日毎の約定履歴を固定長バイナリ(tape/trades.bin)でも保存する
+WRITE_TRADE_TAPE = True
+# 約定がなかった区間の行を保存しない(preprocess.densify_barsで復元できる)
+SPARSE_BARS = True
+TRADE_TAPE_FILENAME = 'trades.bin'
+# S3では当日分の追記をrow/all.csv・テープに結合せず、日ごとの小さなオブジェクト(row/appended/, tape/appended/)
+# として書き込む(読み込み時に結合し、compact_row_dataでまとめる)
+APPENDED_DIR = 'appended'
+
+# S3オブジェクトのローカルキャッシュ(Lambdaでは/tmpのみ書き込み可能)
+CACHE_DIR = '/tmp/bitflyer_ai_cache'
+CACHE_MAX_BYTES = 256 * 1024 ** 2
+# 期間の終了からこの日数が経過したパーティションは更新されないものとして扱う
+CACHE_SEALED_GRACE_DAYS = 10
+
+# 前回の実行以降の約定のみを取得して当日のデータを更新する
+TAIL_REFRESH = True
+# 前回の実行からこの時間以上経過している場合は日単位で取得し直す
+TAIL_REFRESH_MAX_GAP_HOURS = 24
+
+# 日・月・年ごとに保存する価格分布の分位点スケッチ
+SKETCH_FILENAME = 'sketch.json'
+# 分位点の推定値の相対誤差
+SKETCH_RELATIVE_ACCURACY = 0.001
+
+# preprocess.get_candlesの結果を保持する件数(LRU)
+CANDLE_CACHE_SIZE = 64
+
+# 日毎の1分足から作成した特徴量(1m/features.npz)
+FEATURE_FILENAME = 'features.npz'
+
+# 注文履歴をSQLite(child_orders/<product_code>/child_orders.sqlite3)で管理する
+# Falseの場合は従来通りtermごとのcsvを注文の更新のたびに書き込む
+# (有効にした最初の実行で既存のcsvから取り込む)
+USE_ORDER_STORE = False
+ORDER_STORE_FILENAME = 'child_orders.sqlite3'
+# S3では変更した注文のみを差分(child_orders/<product_code>/order_store_deltas/*.json)として書き込み、
+# 差分がこの件数以上たまったらデータベースのファイルにまとめる
+ORDER_STORE_DELTA_DIR = 'order_store_deltas'
+ORDER_STORE_FOLD_DELTAS = 24
+
+# 注文履歴・残高の台帳を更新するプロセス(定期実行とrealtime.OrderEventSubscriber)の排他に使うリース
+LEASE_DIR = 'lease'
+ORDERS_LEASE_NAME = 'orders'
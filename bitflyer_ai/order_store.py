@@ -0,0 +1,371 @@
+import argparse
+import hashlib
+import json
+import math
+import os
+import sqlite3
+import tempfile
+from logging import getLogger
+from pathlib import Path
+
+import pandas as pd
+
+import clock
+from ledger import OrderLedger, OrderRecord
+from manage import (CHILD_ORDERS_DIR, ORDER_STORE_DELTA_DIR,
+                    ORDER_STORE_FILENAME, ORDER_STORE_FOLD_DELTAS)
+from utils import (df_to_csv, list_files, path_exists, read_bytes, read_csv,
+                   read_json, rm_file, write_bytes, write_json,
+                   writes_in_place)
+
+logger = getLogger(__name__)
+
+TERM_FILENAMES = {
+    'long': 'long_term.csv',
+    'short': 'short_term.csv',
+    'dca': 'dca.csv',
+}
+
+# Lambda(Amazon Linux 2)のSQLite 3.7系でも使える構文のみを使う(UPSERT構文は使わない)
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS child_orders (
+        term TEXT NOT NULL,
+        child_order_acceptance_id TEXT NOT NULL,
+        position INTEGER NOT NULL,
+        side TEXT,
+        child_order_state TEXT,
+        child_order_cycle TEXT,
+        related_child_order_acceptance_id TEXT,
+        price REAL,
+        size REAL,
+        child_order_date TEXT,
+        total_commission REAL,
+        total_commission_yen REAL,
+        profit REAL,
+        volume REAL,
+        extra TEXT,
+        PRIMARY KEY (term, child_order_acceptance_id)
+    )
+    """,
+    'CREATE INDEX IF NOT EXISTS idx_child_orders_state ON child_orders (term, child_order_state)',
+    'CREATE INDEX IF NOT EXISTS idx_child_orders_cycle ON child_orders (term, child_order_cycle)',
+    'CREATE INDEX IF NOT EXISTS idx_child_orders_date ON child_orders (term, child_order_date)',
+    """
+    CREATE TABLE IF NOT EXISTS columns (
+        term TEXT NOT NULL PRIMARY KEY,
+        names TEXT NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS imported_csv (
+        filename TEXT NOT NULL PRIMARY KEY,
+        md5 TEXT NOT NULL
+    )
+    """,
+]
+
+ROW_FIELDS = ('child_order_acceptance_id', 'position') + OrderRecord.FIELDS + ('extra',)
+
+
+def _to_sql_value(value):
+    """numpyの型・Timestamp・NaNをSQLite(json)で扱える値にする"""
+    if value is None:
+        return None
+    if isinstance(value, pd.Timestamp):
+        return value.isoformat()
+    if hasattr(value, 'item'):
+        value = value.item()
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    return value
+
+
+def order_store_path(product_code):
+    return Path(CHILD_ORDERS_DIR).joinpath(product_code, ORDER_STORE_FILENAME)
+
+
+def order_store_delta_dir(product_code):
+    return Path(CHILD_ORDERS_DIR).joinpath(product_code, ORDER_STORE_DELTA_DIR)
+
+
+class ChildOrderStore:
+    """注文履歴を保持するSQLiteのファイル
+
+    注文の追加・更新・削除は行単位で反映し、commitでトランザクションを確定する。
+    ローカルではファイルを直接更新する。S3(またはstorage_overlay)の場合は
+    一時ファイルにコピーして更新し、commit時には、このインスタンスで変更した注文のみを
+    差分(order_store_delta_dir/*.json)として書き込む。差分は読み込み時に順に適用し、
+    ORDER_STORE_FOLD_DELTAS件以上たまったらデータベースのファイルにまとめる。
+    差分の書き込み・まとめは、呼び出し側がリース(manage.ORDERS_LEASE_NAME)を取得して行うこと。
+    既存のcsv(long_term.csvなど)は、取り込んだ時点から内容が変わっていれば取り込み直す。
+
+    Args:
+        product_code (str): プロダクト
+        region (str, optional): 読み込む注文日時のタイムゾーン
+    """
+
+    def __init__(self, product_code, region='Asia/Tokyo'):
+        self.product_code = product_code
+        self.region = region
+        self.p_path = order_store_path(product_code)
+        self.p_delta_dir = order_store_delta_dir(product_code)
+        self.in_place = writes_in_place()
+        self.modified = False
+
+        # 前回までの差分と、このインスタンスの差分(最初の書き込み時にキーを決める)
+        self.delta_paths = []
+        self.p_delta_path = None
+        self.fold_pending = False
+        self._reset_changes()
+
+        exists = path_exists(self.p_path)
+        if self.in_place:
+            self.p_path.parent.mkdir(parents=True, exist_ok=True)
+            self.p_db_path = self.p_path
+        else:
+            fd, db_path = tempfile.mkstemp(prefix='bitflyer_ai_orders_', suffix='.sqlite3')
+            os.close(fd)
+            self.p_db_path = Path(db_path)
+            if exists:
+                self.p_db_path.write_bytes(read_bytes(self.p_path))
+
+        self.connection = sqlite3.connect(str(self.p_db_path))
+        # csvの取り込みを記録する前に作成されたデータベースかどうか
+        legacy = exists and self.connection.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'imported_csv'").fetchone() is None
+        for statement in SCHEMA:
+            self.connection.execute(statement)
+
+        if not self.in_place:
+            self._apply_deltas()
+        self._import_csv(legacy)
+
+    def _reset_changes(self):
+        # (term, child_order_acceptance_id)の集合と、termごとの含み益の計算に使った価格・列の順序
+        self.changed = set()
+        self.deleted = set()
+        self.profit_prices = {}
+        self.changed_columns = {}
+        self.imported_changes = {}
+
+    def _apply_deltas(self):
+        """前回までに書き込まれた差分を、書き込まれた順にデータベースへ反映する"""
+        self.delta_paths = [Path(path) for path in list_files(self.p_delta_dir)]
+        for p_delta_path in self.delta_paths:
+            delta = read_json(p_delta_path)
+            for filename, md5 in delta['imported_csv'].items():
+                self.connection.execute(
+                    'INSERT OR REPLACE INTO imported_csv (filename, md5) VALUES (?, ?)', (filename, md5))
+            for term, names in delta['columns'].items():
+                self.connection.execute(
+                    'INSERT OR REPLACE INTO columns (term, names) VALUES (?, ?)', (term, json.dumps(names)))
+            for term, now_price in delta['profit'].items():
+                self._update_profit(term, now_price)
+            placeholders = ', '.join(['?'] * (len(ROW_FIELDS) + 1))
+            self.connection.executemany(
+                f'INSERT OR REPLACE INTO child_orders (term, {", ".join(ROW_FIELDS)}) VALUES ({placeholders})',
+                delta['rows']
+            )
+            self.connection.executemany(
+                'DELETE FROM child_orders WHERE term = ? AND child_order_acceptance_id = ?',
+                delta['deleted']
+            )
+        self.connection.commit()
+        if len(self.delta_paths) > 0:
+            logger.debug(f'[{self.product_code}] {len(self.delta_paths)}件の注文履歴の差分を反映しました。')
+
+    def _import_csv(self, legacy):
+        """既存のcsvから注文履歴を取り込む
+
+        取り込んだcsvのmd5を記録し、従来のcsvで運用していた間に更新された(md5が変わった)
+        termは、csvの内容で置き換える。
+        """
+        p_child_orders_dir = self.p_path.parent
+        imported = dict(self.connection.execute('SELECT filename, md5 FROM imported_csv').fetchall())
+        for term, filename in TERM_FILENAMES.items():
+            p_csv_path = p_child_orders_dir.joinpath(filename)
+            if not path_exists(p_csv_path):
+                continue
+            md5 = hashlib.md5(read_bytes(p_csv_path)).hexdigest()
+            if imported.get(filename) == md5:
+                continue
+            if legacy:
+                # 取り込みを記録していなかったデータベースは、既存のcsvから作成されたものとして扱う
+                self._record_csv(filename, md5)
+                continue
+            df = read_csv(str(p_csv_path)).set_index('child_order_acceptance_id', drop=True)
+            df['child_order_date'] = pd.to_datetime(df['child_order_date']).dt.tz_convert(self.region)
+            ledger = OrderLedger.from_frame(df)
+            self.connection.execute('DELETE FROM child_orders WHERE term = ?', (term,))
+            self.upsert(term, list(ledger), columns=ledger.columns)
+            self._record_csv(filename, md5)
+            # termの置き換えは差分で表せないため、次のcommitでデータベースのファイルを書き込む
+            self.fold_pending = True
+            logger.info(f'[{self.product_code} {term}] {len(ledger)}件の注文を{p_csv_path}から取り込みました。')
+
+    def _record_csv(self, filename, md5):
+        self.connection.execute('INSERT OR REPLACE INTO imported_csv (filename, md5) VALUES (?, ?)', (filename, md5))
+        self.imported_changes[filename] = md5
+        self.modified = True
+
+    def _row(self, term, record):
+        values = {field: _to_sql_value(getattr(record, field)) for field in OrderRecord.FIELDS}
+        extra = {key: _to_sql_value(value) for key, value in record.extra.items()}
+        return (
+            term,
+            record.child_order_acceptance_id,
+            record.seq,
+            *[values[field] for field in OrderRecord.FIELDS],
+            json.dumps(extra, ensure_ascii=False),
+        )
+
+    def upsert(self, term, records, columns=None):
+        """注文を追加、または置き換える(行単位)
+
+        Args:
+            term (str): long, short, dca
+            records (list): ledger.OrderRecordのリスト
+            columns (list, optional): csvに書き出す際の列の順序
+        """
+        placeholders = ', '.join(['?'] * (len(ROW_FIELDS) + 1))
+        self.connection.executemany(
+            f'INSERT OR REPLACE INTO child_orders (term, {", ".join(ROW_FIELDS)}) VALUES ({placeholders})',
+            [self._row(term, record) for record in records]
+        )
+        for record in records:
+            self.changed.add((term, record.child_order_acceptance_id))
+            self.deleted.discard((term, record.child_order_acceptance_id))
+        if columns is not None:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO columns (term, names) VALUES (?, ?)',
+                (term, json.dumps(list(columns)))
+            )
+            self.changed_columns[term] = list(columns)
+        self.modified = True
+
+    def delete(self, term, child_order_acceptance_ids):
+        self.connection.executemany(
+            'DELETE FROM child_orders WHERE term = ? AND child_order_acceptance_id = ?',
+            [(term, child_order_acceptance_id) for child_order_acceptance_id in child_order_acceptance_ids]
+        )
+        for child_order_acceptance_id in child_order_acceptance_ids:
+            self.deleted.add((term, child_order_acceptance_id))
+            self.changed.discard((term, child_order_acceptance_id))
+        self.modified = True
+
+    def update_unrealized_profit(self, term, now_price):
+        """AI.update_unrealized_profitと同じ式で、全ての注文の含み益を1回のUPDATEで更新する
+
+        差分には全ての注文ではなく価格のみを書き込む(読み込み時に同じUPDATEを実行する)。
+        """
+        self._update_profit(term, now_price)
+        self.profit_prices[term] = now_price
+        self.modified = True
+
+    def _update_profit(self, term, now_price):
+        self.connection.execute(
+            """
+            UPDATE child_orders
+            SET profit = CASE
+                WHEN child_order_state = 'ACTIVE' THEN 0
+                ELSE size * (? - price) - total_commission_yen
+            END
+            WHERE term = ?
+            """,
+            (now_price, term)
+        )
+
+    def load_ledger(self, term):
+        """termの注文を追加順に読み込む"""
+        row = self.connection.execute('SELECT names FROM columns WHERE term = ?', (term,)).fetchone()
+        ledger = OrderLedger(columns=json.loads(row[0]) if row is not None else ())
+        cursor = self.connection.execute(
+            f'SELECT {", ".join(ROW_FIELDS)} FROM child_orders WHERE term = ? ORDER BY position',
+            (term,)
+        )
+        for db_row in cursor:
+            values = dict(zip(ROW_FIELDS, db_row))
+            child_order_acceptance_id = values.pop('child_order_acceptance_id')
+            position = values.pop('position')
+            values.update(json.loads(values.pop('extra') or '{}'))
+            if values['child_order_date'] is not None:
+                values['child_order_date'] = pd.Timestamp(values['child_order_date']).tz_convert(self.region)
+            ledger.upsert(child_order_acceptance_id, values, seq=position)
+        return ledger
+
+    def commit(self):
+        """トランザクションを確定し、S3の場合は差分(またはまとめたファイル)を書き込む"""
+        self.connection.commit()
+        if self.modified and not self.in_place:
+            if self.fold_pending or len(self.delta_paths) >= ORDER_STORE_FOLD_DELTAS:
+                self._fold()
+            else:
+                if self.p_delta_path is None:
+                    self.p_delta_path = self.p_delta_dir.joinpath(
+                        f'{clock.now():%Y%m%d%H%M%S%f}_{os.urandom(4).hex()}.json')
+                write_json(self.p_delta_path, self._delta())
+        self.modified = False
+
+    def _delta(self):
+        """このインスタンスで変更した注文の現在の値"""
+        rows = []
+        for term, child_order_acceptance_id in sorted(self.changed):
+            rows.append(list(self.connection.execute(
+                f'SELECT term, {", ".join(ROW_FIELDS)} FROM child_orders '
+                + 'WHERE term = ? AND child_order_acceptance_id = ?',
+                (term, child_order_acceptance_id)
+            ).fetchone()))
+        return {
+            'imported_csv': self.imported_changes,
+            'columns': self.changed_columns,
+            'profit': self.profit_prices,
+            'rows': rows,
+            'deleted': [list(key) for key in sorted(self.deleted)],
+        }
+
+    def _fold(self):
+        """データベースのファイルを書き込み、反映済みの差分を削除する"""
+        write_bytes(self.p_path, self.p_db_path.read_bytes())
+        if self.p_delta_path is not None:
+            self.delta_paths.append(self.p_delta_path)
+        for p_delta_path in self.delta_paths:
+            if path_exists(p_delta_path):
+                rm_file(p_delta_path)
+        logger.info(f'[{self.product_code}] {len(self.delta_paths)}件の注文履歴の差分をデータベースにまとめました。')
+        self.delta_paths = []
+        self.p_delta_path = None
+        self.fold_pending = False
+        self._reset_changes()
+
+    def close(self):
+        self.connection.close()
+        if not self.in_place:
+            self.p_db_path.unlink()
+
+
+def export_csv(product_code, region='Asia/Tokyo'):
+    """データベースの注文履歴を従来のcsv(long_term.csvなど)に書き出す"""
+    store = ChildOrderStore(product_code, region=region)
+    try:
+        for term, filename in TERM_FILENAMES.items():
+            p_csv_path = Path(CHILD_ORDERS_DIR).joinpath(product_code, filename)
+            ledger = store.load_ledger(term)
+            if ledger.empty:
+                if path_exists(p_csv_path):
+                    rm_file(p_csv_path)
+                continue
+            df_to_csv(str(p_csv_path), ledger.to_frame(), index=True)
+            # 書き出したcsvを次回の読み込みで取り込み直さないよう記録する
+            store._record_csv(filename, hashlib.md5(read_bytes(p_csv_path)).hexdigest())
+            logger.info(f'[{product_code} {term}] {len(ledger)}件の注文を{p_csv_path}に書き出しました。')
+        store.commit()
+    finally:
+        store.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='注文履歴のデータベースをcsvに書き出す')
+    parser.add_argument('product_code')
+    args = parser.parse_args()
+    export_csv(args.product_code)
@@ -0,0 +1,165 @@
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from manage import EXECUTION_HISTORY_DIR
+from preprocess import BAR_FREQUENCIES
+from schema import BAR_PRICE_COLUMNS
+from utils import path_exists, read_csv
+
+logger = getLogger(__name__)
+
+# リサンプリング済みデータのディレクトリ名 -> 1本あたりの長さ(ns)
+BAR_STEPS = {
+    dirname: pd.tseries.frequencies.to_offset(freq).nanos
+    for dirname, freq in BAR_FREQUENCIES
+}
+
+
+class BarPanel:
+    """プロダクト × 時刻 × 列 の3次元配列
+
+    values[i_product, i_time, i_field] で参照する。
+    時刻は start から step ごとの等間隔で、timesはUTCのDatetimeIndex。
+    """
+
+    def __init__(self, values, product_codes, times, fields):
+        self.values = values
+        self.product_codes = list(product_codes)
+        self.times = times
+        self.fields = list(fields)
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    def __getitem__(self, field):
+        """列fieldの(プロダクト × 時刻)の2次元配列を返す(コピーしない)"""
+        return self.values[:, :, self.fields.index(field)]
+
+    def sel(self, product_code, field):
+        return self.values[self.product_codes.index(product_code), :, self.fields.index(field)]
+
+    def to_frame(self, field, region='Asia/Tokyo'):
+        """列fieldを、indexが時刻・列がプロダクトのDataFrameに変換する"""
+        df = pd.DataFrame(self[field].T, index=self.times, columns=self.product_codes)
+        if region is not None:
+            df = df.tz_convert(region)
+        return df
+
+
+def _bars_path(product_code, target_date, freq_dir, side):
+    return Path(EXECUTION_HISTORY_DIR).joinpath(
+        product_code,
+        target_date.strftime('%Y'),
+        target_date.strftime('%m'),
+        target_date.strftime('%d'),
+        freq_dir,
+        f'{side}.csv'
+    )
+
+
+def _read_day(p_path, fields):
+    """1日分のファイルから、時刻(epoch ns)と必要な列のみを読み込む"""
+    if not path_exists(p_path):
+        return None
+    df = read_csv(str(p_path), usecols=['exec_date'] + fields)
+    if df.empty:
+        return None
+    timestamps = pd.to_datetime(df['exec_date'], utc=True).values.astype('int64')
+    return timestamps, df[fields].values.astype('float64')
+
+
+def _forward_fill(values):
+    """時刻方向(axis=1)にNaNを直前の値で埋める"""
+    n_times = values.shape[1]
+    valid = ~np.isnan(values)
+    i_last_valid = np.where(valid, np.arange(n_times)[None, :], 0)
+    np.maximum.accumulate(i_last_valid, axis=1, out=i_last_valid)
+    return np.take_along_axis(values, i_last_valid, axis=1)
+
+
+def load_panel(
+        product_codes,
+        start,
+        end,
+        freq_dir='1m',
+        side='buy',
+        fields=('close_price', 'total_size'),
+        dense=True,
+        max_workers=16):
+    """複数プロダクトのリサンプリング済みデータを時刻を揃えて1つの配列に読み込む
+
+    日毎のファイルを並列に読み込み(S3の場合はキャッシュ経由)、必要な列のみを取り出す。
+    各行の格納位置は (時刻 - start) // step で求めるため、DataFrameの結合は行わない。
+
+    Args:
+        product_codes (list): プロダクトのリスト
+        start (datetime.datetime): 開始時刻(タイムゾーン付き、この時刻を含む)
+        end (datetime.datetime): 終了時刻(タイムゾーン付き、この時刻を含まない)
+        freq_dir (str, optional): 1m, 10m, 1h のいずれか
+        side (str, optional): buy or sell
+        fields (tuple, optional): 読み込む列
+        dense (bool, optional): Trueの場合、約定がなかった区間をdensify_barsと同様に
+            直前の終値とtotal_size=0で埋める。Falseの場合はNaNのままにする。
+        max_workers (int, optional): 並列に読み込むファイル数
+
+    Returns:
+        BarPanel: 読み込んだデータ
+    """
+    fields = list(fields)
+    step = BAR_STEPS[freq_dir]
+    start_ns = pd.Timestamp(start).floor(pd.Timedelta(step)).value
+    end_ns = pd.Timestamp(end).value
+    n_times = max(-(-(end_ns - start_ns) // step), 0)
+
+    # 空の区間を埋めるには終値が必要になる
+    read_fields = list(fields)
+    if dense and 'close_price' not in read_fields and any(f in BAR_PRICE_COLUMNS for f in fields):
+        read_fields.append('close_price')
+
+    values = np.full((len(product_codes), n_times, len(read_fields)), np.nan)
+
+    # 日毎のパーティションはAsia/Tokyoの日付で区切られている
+    start_date = pd.Timestamp(start_ns, tz='UTC').tz_convert('Asia/Tokyo').date()
+    end_date = pd.Timestamp(end_ns, tz='UTC').tz_convert('Asia/Tokyo').date()
+    tasks = []
+    for i_product, product_code in enumerate(product_codes):
+        target_date = start_date
+        while target_date <= end_date:
+            tasks.append((i_product, _bars_path(product_code, target_date, freq_dir, side)))
+            target_date += datetime.timedelta(days=1)
+
+    logger.debug(f'[{product_codes} {start} - {end}] {len(tasks)}ファイルを読み込み中...')
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = executor.map(lambda task: _read_day(task[1], read_fields), tasks)
+        for (i_product, _), result in zip(tasks, results):
+            if result is None:
+                continue
+            timestamps, day_values = result
+            in_range = (timestamps >= start_ns) & (timestamps < end_ns)
+            slots = (timestamps[in_range] - start_ns) // step
+            values[i_product, slots, :] = day_values[in_range]
+
+    if dense and n_times > 0:
+        if 'close_price' in read_fields:
+            i_close = read_fields.index('close_price')
+            close_price = _forward_fill(values[:, :, i_close])
+            for i_field, field in enumerate(read_fields):
+                if field in BAR_PRICE_COLUMNS:
+                    values[:, :, i_field] = np.where(
+                        np.isnan(values[:, :, i_field]), close_price, values[:, :, i_field])
+        if 'total_size' in read_fields:
+            i_size = read_fields.index('total_size')
+            np.nan_to_num(values[:, :, i_size], copy=False, nan=0.0)
+
+    if read_fields != fields:
+        values = np.ascontiguousarray(values[:, :, :len(fields)])
+
+    times = pd.to_datetime(start_ns + np.arange(n_times, dtype='int64') * step, utc=True)
+    logger.debug(f'[{product_codes} {start} - {end}] 読み込み完了 {values.shape}')
+    return BarPanel(values, product_codes, times, fields)
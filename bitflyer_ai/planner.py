@@ -0,0 +1,214 @@
+import numpy as np
+
+# (term, cycle) -> 買い注文の価格の基準にする集計期間
+BUY_WINDOWS = {
+    ('long', 'daily'): '1d',
+    ('long', 'weekly'): '1w',
+    ('long', 'monthly'): '1m',
+    ('short', 'hourly'): '12h',
+    ('short', 'daily'): '1d',
+    ('short', 'weekly'): '1w',
+}
+
+# 過去最高価格に対する直近の最安値の割引率がこれより大きい場合は、直近の最安値で注文する
+MAX_PRICE_RATE_TH = 1 / 2
+# 最大volumeで注文する際の過去最大価格に対する注文価格の割合
+MAX_VOLUME_RATE = 0.5
+# sizeの小数点以下の桁数
+SIZE_DIGITS = 3
+
+# 見送りの理由(0は注文する)
+ACCEPTED = 0
+TREND_DOWN = 1
+NEAR_ALL_TIME_HIGH = 2
+TOO_LOW = 3
+NEAR_LOCAL_HIGH = 4
+SMALL_LOCAL_GAP = 5
+INSUFFICIENT_JPY = 6
+ABOVE_START_PRICE = 7
+
+REJECT_MESSAGES = {
+    TREND_DOWN: '下降トレンド中のため、購入を見送ります。',
+    NEAR_ALL_TIME_HIGH: '過去最高価格に近いため、購入できません。',
+    TOO_LOW: '注文価格が低すぎるため、購入できません。',
+    NEAR_LOCAL_HIGH: '注文価格が直近の最高価格と近すぎるため、購入できません。',
+    SMALL_LOCAL_GAP: '直近の最高価格と最低価格のギャップが小さすぎるため、購入できません。',
+    INSUFFICIENT_JPY: 'JPYが不足しているため新規の買い注文ができません。',
+    ABOVE_START_PRICE: '注文価格が購入開始価格(過去最高価格 * st_buy_price_rate)以上であるため注文できません。',
+}
+
+
+class BuyPlan:
+    """候補となる買い注文の価格・量と、見送りの理由(reason)の配列
+
+    reasonは最初に該当した理由で、ACCEPTEDの候補のみ注文する。
+    """
+
+    def __init__(self, price, volume, size, reason):
+        self.price = price
+        self.volume = volume
+        self.size = size
+        self.reason = reason
+
+    def __len__(self):
+        return len(self.reason)
+
+    @property
+    def accepted(self):
+        return self.reason == ACCEPTED
+
+    def reject_message(self, i):
+        return REJECT_MESSAGES.get(int(self.reason[i]))
+
+
+def _floor_size(volume, price, min_size):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        size = np.floor(volume / price * 10 ** SIZE_DIGITS) / (10 ** SIZE_DIGITS)
+    return np.maximum(np.nan_to_num(size), min_size)
+
+
+def _first_reason(conditions):
+    """条件の配列を順に評価し、最初に該当した理由の配列にする"""
+    return np.select([condition for _, condition in conditions], [reason for reason, _ in conditions], ACCEPTED)
+
+
+def plan_buys(local_low,
+              local_high,
+              global_high,
+              now_price,
+              max_buy_price_rate,
+              min_volume,
+              max_volume,
+              min_size,
+              min_local_price_gap_rate,
+              available_jpy,
+              trend=None,
+              use_trend_filter=False,
+              buy_price_rate=None,
+              ret=None):
+    """long_term, short_termの買い注文を、全ての候補についてまとめて計算する(AI._buyと同じ式)
+
+    引数は候補の数の配列、またはスカラー(全ての候補で共通)。複数の(term, cycle)だけでなく、
+    パラメータや価格を変えた多数のシナリオもまとめて評価できる。
+    注文履歴(同じ注文の有無など)に依存する判定は含まない。
+
+    Args:
+        local_low, local_high (array): 集計期間の最安値・最高値
+        global_high (array): 過去最高価格
+        now_price (array): 現在価格
+        max_buy_price_rate (array): 過去最高価格に対する買値の上限の割合(MAX_BUY_PRICE_RATE_IN_*)
+        min_volume, max_volume (array): 注文金額の範囲
+        min_size (array): 最小注文数量
+        min_local_price_gap_rate (array): 直近の最高値と注文価格に必要な差の割合
+        available_jpy (array): 利用可能なJPY
+        trend (array, optional): 集計期間のトレンド('UP', 'DOWN')
+        use_trend_filter (bool, optional): 下降トレンド中は買わない
+        buy_price_rate (array, optional): 予測した買値の倍率(予測しない候補はNaN)
+        ret (array, optional): 予測したリターン(予測しない候補はNaN)。trendより優先する
+
+    Returns:
+        BuyPlan
+    """
+    # 全てスカラーの場合も候補が1件の配列として扱う(plan.price[0]のように参照できる)
+    local_low, local_high, global_high, now_price, max_buy_price_rate, min_volume, max_volume, \
+        min_size, min_local_price_gap_rate, available_jpy = np.broadcast_arrays(*[
+            np.atleast_1d(np.asarray(value, dtype='float64')) for value in [
+                local_low, local_high, global_high, now_price, max_buy_price_rate, min_volume, max_volume,
+                min_size, min_local_price_gap_rate, available_jpy,
+            ]
+        ])
+
+    trend_down = np.zeros(local_low.shape, dtype=bool)
+    if use_trend_filter:
+        if trend is not None:
+            trend_down = np.broadcast_to(np.asarray(trend) == 'DOWN', local_low.shape)
+        if ret is not None:
+            ret = np.broadcast_to(np.asarray(ret, dtype='float64'), local_low.shape)
+            trend_down = np.where(np.isnan(ret), trend_down, ret <= 0)
+
+    local_global_price_rate = local_low / global_high
+    price_rate = np.where(
+        1 - local_global_price_rate > MAX_PRICE_RATE_TH,
+        1.0,
+        -4 * (1 - max_buy_price_rate) * (MAX_PRICE_RATE_TH - local_global_price_rate) ** 2 + 1
+    )
+    if buy_price_rate is not None:
+        buy_price_rate = np.broadcast_to(np.asarray(buy_price_rate, dtype='float64'), local_low.shape)
+        # 予測値は従来の価格に対する倍率として扱い、極端な値は丸める
+        price_rate = price_rate * np.where(np.isnan(buy_price_rate), 1.0, np.clip(buy_price_rate, 0.9, 1.0))
+    price = np.trunc(local_low * price_rate)
+
+    global_price_rate = price / global_high
+    volume = np.where(
+        global_price_rate <= MAX_VOLUME_RATE,
+        max_volume,
+        -((max_volume - min_volume) / (max_buy_price_rate - MAX_VOLUME_RATE)) * (global_price_rate - MAX_VOLUME_RATE)
+        + max_volume
+    )
+    volume = np.where(volume > available_jpy, np.trunc(available_jpy), volume)
+    size = _floor_size(volume, price, min_size)
+
+    reason = _first_reason([
+        (TREND_DOWN, trend_down),
+        (NEAR_ALL_TIME_HIGH, price >= global_high * max_buy_price_rate),
+        (TOO_LOW, price <= now_price * 0.75),
+        (NEAR_LOCAL_HIGH, price > local_high * (1 - min_local_price_gap_rate)),
+        (SMALL_LOCAL_GAP, local_high / local_low < (1 + min_local_price_gap_rate)),
+        (INSUFFICIENT_JPY, size * price > available_jpy),
+    ])
+    return BuyPlan(price.astype('int64'), volume, size, reason)
+
+
+def plan_dca(now_price,
+             global_high,
+             min_volume,
+             max_volume,
+             min_size,
+             max_buy_price_rate,
+             available_jpy,
+             st_buy_price_rate=1,
+             price_rate=1):
+    """ドルコスト平均法の買い注文を、全ての候補についてまとめて計算する(AI.dcaと同じ式)
+
+    引数はplan_buysと同様に、候補の数の配列またはスカラー。
+
+    Returns:
+        BuyPlan
+    """
+    now_price, global_high, min_volume, max_volume, min_size, max_buy_price_rate, available_jpy, \
+        st_buy_price_rate, price_rate = np.broadcast_arrays(*[
+            np.atleast_1d(np.asarray(value, dtype='float64')) for value in [
+                now_price, global_high, min_volume, max_volume, min_size, max_buy_price_rate, available_jpy,
+                st_buy_price_rate, price_rate,
+            ]
+        ])
+    price = np.trunc(now_price * price_rate)
+
+    min_volume = np.where(min_volume < now_price * min_size, np.trunc(now_price * min_size), min_volume)
+    max_volume = np.maximum(max_volume, min_volume)
+    coef = (max_volume - min_volume) / (max_buy_price_rate - st_buy_price_rate) ** 2
+    volume = np.minimum(coef * (price / global_high - st_buy_price_rate) ** 2 + min_volume, max_volume)
+    size = _floor_size(volume, price, min_size)
+
+    reason = _first_reason([
+        (ABOVE_START_PRICE, price > global_high * st_buy_price_rate),
+        (INSUFFICIENT_JPY, size * price > available_jpy),
+    ])
+    return BuyPlan(price.astype('int64'), volume, size, reason)
+
+
+def buy_inputs(latest_summary, combinations, use_trend_filter=False):
+    """latest_summaryから、(term, cycle)ごとのplan_buysの価格の引数を作成する
+
+    trendは指標の更新を伴うため、use_trend_filter=Trueの場合のみ参照する。
+    """
+    windows = [BUY_WINDOWS[combination] for combination in combinations]
+    inputs = {
+        'local_low': np.array([latest_summary['BUY'][window]['price']['low'] for window in windows], dtype='float64'),
+        'local_high': np.array([latest_summary['BUY'][window]['price']['high'] for window in windows], dtype='float64'),
+        'global_high': latest_summary['BUY']['all']['price']['high'],
+        'now_price': latest_summary['BUY']['now']['price'],
+    }
+    if use_trend_filter:
+        inputs['trend'] = np.array([latest_summary['BUY'][window]['trend'] for window in windows], dtype=object)
+    return inputs
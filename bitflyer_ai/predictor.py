@@ -0,0 +1,155 @@
+import datetime
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from logging import getLogger
+from pathlib import Path
+
+import numpy as np
+
+from features import load_features
+from utils import local_path
+
+logger = getLogger(__name__)
+
+# 各サイクルの特徴量の窓で、何本(1分足)ごとに1行を取り出すか
+CYCLE_STRIDES = {
+    'hourly': 1,
+    'daily': 15,
+    'weekly': 60,
+    'monthly': 240,
+}
+
+# model_path -> (ファイルの更新時刻, モデル)。ウォームコンテナでは呼び出しをまたいで再利用される
+_models = {}
+
+# 推論は1件ずつ実行する(タイムアウト時もスレッドは止められないため、次の推論は待たされる)
+_executor = ThreadPoolExecutor(max_workers=1)
+
+
+class LinearModel:
+    """numpyのみで推論する線形モデル
+
+    モデルファイル(npz)には次の配列を保存する。
+        weights: (window * 特徴量の数, 出力の数)
+        bias: (出力の数,)
+        columns: 特徴量の列名
+        outputs: 出力名(ret, buy_price_rate, sell_price_rate など)
+        window: 1サンプルあたりの行数
+    """
+
+    def __init__(self, weights, bias, columns, outputs, window):
+        self.weights = weights
+        self.bias = bias
+        self.columns = list(columns)
+        self.outputs = list(outputs)
+        self.window = int(window)
+
+    @classmethod
+    def load(cls, p_path):
+        with np.load(p_path) as npz:
+            return cls(
+                weights=npz['weights'].astype('float32'),
+                bias=npz['bias'].astype('float32'),
+                columns=npz['columns'].tolist(),
+                outputs=npz['outputs'].tolist(),
+                window=npz['window'],
+            )
+
+    def predict(self, X):
+        """X: (サンプル数, window, 特徴量の数) -> (サンプル数, 出力の数)"""
+        X = np.nan_to_num(X.reshape(len(X), -1))
+        return X @ self.weights + self.bias
+
+
+def load_model(model_path):
+    """モデルを読み込む(ファイルが更新されていなければキャッシュしたモデルを返す)"""
+    p_local_path = Path(local_path(Path(model_path)))
+    mtime = p_local_path.stat().st_mtime
+    cached = _models.get(model_path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    start_time = time.time()
+    model = LinearModel.load(p_local_path)
+    _models[model_path] = (mtime, model)
+    logger.info(f'[{model_path}] モデルを読み込みました。({(time.time() - start_time) * 1000:.1f}ms)')
+    return model
+
+
+class InferenceHook:
+    """有効な全ての(term, cycle)の特徴量の窓をまとめて1回で推論する
+
+    モデルの読み込み・特徴量の作成・推論の全体がtimeout秒以内に終わらない、
+    または失敗した場合はNoneを返し、呼び出し元は従来のルールで注文する。
+    """
+
+    def __init__(self, model_path, timeout=2.0):
+        self.model_path = model_path
+        self.timeout = timeout
+        self.latency = {}
+
+    def _build_batch(self, model, product_code, combinations, current_datetime):
+        max_minutes = max(model.window * CYCLE_STRIDES[cycle] for _, cycle in combinations)
+        start_date = (current_datetime - datetime.timedelta(minutes=max_minutes + 1)).date()
+        df_features = load_features(
+            product_code, start_date, current_datetime.date(), columns=model.columns)
+        df_features = df_features[df_features.index <= current_datetime]
+
+        values = df_features.values.astype('float32')
+        X = np.full((len(combinations), model.window, len(model.columns)), np.nan, dtype='float32')
+        for i, (_, cycle) in enumerate(combinations):
+            stride = CYCLE_STRIDES[cycle]
+            # 最新の行から遡ってstride本ごとに取り出し、古い順に並べる
+            rows = np.arange(len(values) - 1, -1, -stride)[:model.window][::-1]
+            X[i, model.window - len(rows):] = values[rows]
+        return X
+
+    def _infer(self, product_code, combinations, current_datetime):
+        """モデルの読み込みから推論までを行う(_executorで実行する)"""
+        load_start_time = time.time()
+        model = load_model(self.model_path)
+        self.latency['load'] = time.time() - load_start_time
+
+        feature_start_time = time.time()
+        X = self._build_batch(model, product_code, combinations, current_datetime)
+        self.latency['features'] = time.time() - feature_start_time
+
+        predict_start_time = time.time()
+        Y = model.predict(X)
+        self.latency['predict'] = time.time() - predict_start_time
+        return model, Y
+
+    def run(self, product_code, combinations, current_datetime):
+        """
+        Args:
+            product_code (str): プロダクト
+            combinations (list): (term, cycle)のリスト
+            current_datetime (datetime.datetime): 現在時刻
+
+        Returns:
+            dict or None: (term, cycle) -> {出力名: 値}
+        """
+        if len(combinations) == 0:
+            return {}
+
+        start_time = time.time()
+        try:
+            model, Y = _executor.submit(
+                self._infer, product_code, combinations, current_datetime).result(timeout=self.timeout)
+        except FutureTimeoutError:
+            logger.warning(
+                f'[{product_code}] 推論が{self.timeout}秒以内に終わらなかったため、従来のルールで注文します。')
+            return None
+        except Exception as e:
+            logger.warning(f'[{product_code}] 推論に失敗したため、従来のルールで注文します。({e})')
+            return None
+        finally:
+            self.latency['total'] = time.time() - start_time
+
+        logger.info(
+            f'[{product_code}] {len(combinations)}件を推論しました。'
+            + ' '.join(f'{name}: {seconds * 1000:.1f}ms' for name, seconds in self.latency.items()))
+        return {
+            combination: dict(zip(model.outputs, Y[i].tolist()))
+            for i, combination in enumerate(combinations)
+        }
@@ -1,14 +1,28 @@
 import datetime
-import time
+import gzip
+from collections import OrderedDict
 from logging import getLogger
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
 from dateutil.relativedelta import relativedelta
 
+import clock
 from bitflyer_api import get_executions
-from manage import EXECUTION_HISTORY_DIR, REF_LOCAL
-from utils import df_to_csv, path_exists, read_csv
+from indicators import TREND_SPECS, IndicatorEngine
+from manage import (APPENDED_DIR, CACHE_SEALED_GRACE_DAYS, CANDLE_CACHE_SIZE, EXECUTION_HISTORY_DIR, REF_LOCAL,
+                    ROW_ARCHIVE_DIR, ROW_RETENTION_DAYS, SPARSE_BARS, TAIL_REFRESH, TAIL_REFRESH_MAX_GAP_HOURS,
+                    WRITE_TRADE_TAPE)
+from schema import (EXECUTION_COLUMNS, ORDER_ID_COLUMNS, compact_bars,
+                    compact_executions, to_region)
+from sketch import (load_all_sketch, load_window_sketch, make_day_sketches,
+                    merge_sketch_files)
+from tape import (append_tape, fold_tape_appended, tape_appended_dir,
+                  tape_path, write_tape_appended)
+from utils import (append_csv, df_to_csv, iter_csv, list_files, path_exists,
+                   read_csv, read_json, rm_dir, write_bytes, write_json,
+                   writes_in_place)
 
 logger = getLogger(__name__)
 
@@ -16,6 +30,14 @@ if not REF_LOCAL:
     from aws import S3
     s3 = S3()
 
+# 日毎に保存するリサンプリング済みデータのディレクトリ名と間隔
+BAR_FREQUENCIES = [('1h', 'H'), ('1m', 'T'), ('10m', '10T')]
+
+# 集計データ作成時に必要なリサンプリング済みデータの列
+SUMMARY_SOURCE_COLUMNS = [
+    'open_price', 'high_price', 'low_price', 'close_price', 'total_size'
+]
+
 
 def get_executions_history(
         product_code,
@@ -23,7 +45,8 @@ def get_executions_history(
         end_date,
         region='Asia/Tokyo',
         count=500,
-        return_df=False):
+        return_df=False,
+        drop_order_ids=False):
     logger.debug(
         f'[{start_date} - {end_date}] 取引履歴ダウンロード中...')
 
@@ -42,8 +65,10 @@ def get_executions_history(
         microsecond=0,
     )
 
-    loop_start_time = time.time()
+    loop_start_time = clock.time()
     day_count = 0
+    df_newest_day = pd.DataFrame()
+    coverages = {}
 
     if return_df:
         df_history = pd.DataFrame()
@@ -65,11 +90,7 @@ def get_executions_history(
         p_save_dir_1m = p_save_dir.joinpath('1m')
         p_save_dir_10m = p_save_dir.joinpath('10m')
 
-        p_save_path_row_all = p_save_dir_row.joinpath('all.csv')
-        p_save_path_row_buy = p_save_dir_row.joinpath('buy.csv')
-        p_save_path_row_sell = p_save_dir_row.joinpath('sell.csv')
-
-        if REF_LOCAL:
+        if writes_in_place():
             if not p_save_dir_row.exists():
                 p_save_dir_row.mkdir(parents=True)
             if not p_save_dir_1h.exists():
@@ -81,19 +102,16 @@ def get_executions_history(
 
         before = 0
         after = 0
-        if path_exists(p_save_path_row_all):
-            df = read_csv(str(p_save_path_row_all))
-            df['exec_date'] = pd.to_datetime(df['exec_date'])
-            df = df.set_index('exec_date')
-            df = df.tz_convert(region)
+        df = read_day_rows(p_save_dir_row)
+        if df is not None:
+            df['exec_date'] = pd.to_datetime(df['exec_date'], utc=True)
+            df = compact_executions(df.set_index('exec_date'))
             before = int(df.head(1)['id'])
             after = int(df.tail(1)['id'])
         else:
-            df = get_executions(product_code, count,
-                                before=before, region=region)
+            df = get_executions(product_code, count, before=before)
             if df.empty:
-                df = get_executions(product_code, count,
-                                    after=after, region=region)
+                df = get_executions(product_code, count, after=after)
             df = df.sort_index()
             before = int(df.head(1)['id'])
             after = int(df.tail(1)['id'])
@@ -102,120 +120,520 @@ def get_executions_history(
             df_new = get_executions(product_code, count, after=after)
             if df_new.empty:
                 break
-            df_new = df_new.tz_convert(region)
             df = pd.concat([df, df_new])
             df = df.sort_index()
             after = int(df.tail(1)['id'])
             if REF_LOCAL:
-                time.sleep(0.25)
+                clock.sleep(0.25)
 
         while target_date_start < df.head(1).index[0]:
             df_new = get_executions(product_code, count, before=before)
             if df_new.empty:
                 break
-            df_new = df_new.tz_convert(region)
             df = pd.concat([df, df_new])
             df = df.sort_index()
             before = int(df.head(1)['id'])
             if REF_LOCAL:
-                time.sleep(0.25)
+                clock.sleep(0.25)
 
         while df.tail(1).index[0] < target_date_end:
             df_new = get_executions(product_code, count, after=after)
             if df_new.empty:
                 break
-            df_new = df_new.tz_convert(region)
             df = pd.concat([df, df_new])
             df = df.sort_index()
             after = int(df.tail(1)['id'])
             if REF_LOCAL:
-                time.sleep(0.25)
+                clock.sleep(0.25)
 
         df = df.query('@target_date_start <= index < @target_date_end')
+        if df_newest_day.empty:
+            df_newest_day = df
 
         if return_df:
+            if drop_order_ids:
+                df_part = df.drop(columns=ORDER_ID_COLUMNS, errors='ignore')
+            else:
+                df_part = df.copy()
             if df_history.empty:
-                df_history = df.copy()
+                df_history = df_part
             else:
-                df_history = pd.concat([df_history, df])
+                df_history = pd.concat([df_history, df_part])
 
         if not df.empty:
-            df_buy = df.query('side == "BUY"')
-            df_sell = df.query('side == "SELL"')
-
-            # if REF_LOCAL:
-            #     df.to_csv(str(p_save_path_row_all))
-            #     df_buy.to_csv(str(p_save_path_row_buy))
-            #     df_sell.to_csv(str(p_save_path_row_sell))
-            # else:
-            logger.debug(f'[{target_date_start}] 取引履歴データ保存中...')
-            df_to_csv(str(p_save_path_row_all), df, index=True)
-            df_to_csv(str(p_save_path_row_buy), df_buy, index=True)
-            df_to_csv(str(p_save_path_row_sell), df_sell, index=True)
-            logger.debug(f'[{target_date_start}] 取引履歴データ保存完了')
-            # s3.to_csv(
-            #     str(p_save_path_row_all),
-            #     df=df
-            # )
-            # s3.to_csv(
-            #     str(p_save_path_row_buy),
-            #     df=df_buy
-            # )
-            # s3.to_csv(
-            #     str(p_save_path_row_sell),
-            #     df=df_sell
-            # )
-
-            p_save_dir_1h = p_save_dir.joinpath('1h')
-            p_save_dir_1m = p_save_dir.joinpath('1m')
-            p_save_dir_10m = p_save_dir.joinpath('10m')
-
-            df_buy_resample = df_buy[['price', 'size']]
-            df_sell_resample = df_sell[['price', 'size']]
-
-            logger.debug(f'[{target_date_start}] リサンプリング中...')
-
-            resampling(df_buy_resample, df_sell_resample,
-                       p_save_dir_1h, 'H')
-            resampling(df_buy_resample, df_sell_resample,
-                       p_save_dir_1m, 'T')
-            resampling(df_buy_resample, df_sell_resample,
-                       p_save_dir_10m, '10T')
-            logger.debug(f'[{target_date_start}] リサンプリング完了')
-
+            save_day_executions(product_code, target_date_start, df, region=region)
+            coverages[target_date_start.strftime('%Y-%m-%d')] = day_coverage(df)
             logger.debug(f'[{target_date_start}] 取引履歴ダウンロード完了')
         if day_count == 5:
             process_time = datetime.timedelta(
-                seconds=time.time() - loop_start_time)
+                seconds=clock.time() - loop_start_time)
             wait_time = datetime.timedelta(
                 minutes=5) - process_time
             logger.debug('waiting...')
             if wait_time.total_seconds() > 0:
-                time.sleep(wait_time.total_seconds())
+                clock.sleep(wait_time.total_seconds())
             day_count = 0
-            loop_start_time = time.time()
+            loop_start_time = clock.time()
 
         end_date_tmp -= datetime.timedelta(days=1)
 
+    register_coverage(product_code, coverages, source='api')
+    # 取得し直した日の範囲は記録済みのため、保留中の当日分の範囲は破棄する
+    update_checkpoint(product_code, df_newest_day, pending_coverages={})
     logger.debug(f'[{start_date} - {end_date}] 取引履歴ダウンロード完了')
 
     if return_df:
         return df_history
 
 
-def resampling(df_buy, df_sell, p_save_dir='', freq='T'):
+def save_day_executions(product_code, target_date, df, region='Asia/Tokyo', archive=False):
+    """1日分の約定履歴を生データ・テープ・リサンプリング済みデータとして保存する
+
+    archive=Trueの場合、生データはrow/ではなくcompact_row_dataと同じ圧縮アーカイブに直接保存する
+    (保持期間を過ぎた日を取り込む場合に、row/all.csvを書いてから圧縮し直さないため)。
+    """
+    p_save_dir = Path(EXECUTION_HISTORY_DIR).joinpath(
+        product_code,
+        target_date.strftime('%Y'),
+        target_date.strftime('%m'),
+        target_date.strftime('%d'))
+    if writes_in_place():
+        dirnames = [dirname for dirname, _ in BAR_FREQUENCIES]
+        if not archive:
+            dirnames.append('row')
+        for dirname in dirnames:
+            p_save_dir.joinpath(dirname).mkdir(parents=True, exist_ok=True)
+
+    df_buy = df.query('side == "BUY"')
+    df_sell = df.query('side == "SELL"')
+
+    p_save_dir_row = p_save_dir.joinpath('row')
+    logger.debug(f'[{target_date}] 取引履歴データ保存中...')
+    if archive:
+        write_row_archive(product_code, target_date, [to_region(df, region).reset_index()])
+        rm_dir(p_save_dir_row)
+    else:
+        df_to_csv(str(p_save_dir_row.joinpath('all.csv')), to_region(df, region), index=True)
+        df_to_csv(str(p_save_dir_row.joinpath('buy.csv')), to_region(df_buy, region), index=True)
+        df_to_csv(str(p_save_dir_row.joinpath('sell.csv')), to_region(df_sell, region), index=True)
+        # dfは追記分(read_day_rows)を含めた1日分のため、追記分は不要になる
+        rm_dir(p_save_dir_row.joinpath(APPENDED_DIR))
+    if WRITE_TRADE_TAPE:
+        p_tape_path = tape_path(product_code, target_date)
+        append_tape(p_tape_path, df)
+        rm_dir(tape_appended_dir(p_tape_path))
+    logger.debug(f'[{target_date}] 取引履歴データ保存完了')
+
+    df_buy_resample = df_buy[['price', 'size']]
+    df_sell_resample = df_sell[['price', 'size']]
+
+    logger.debug(f'[{target_date}] リサンプリング中...')
+    for dirname, freq in BAR_FREQUENCIES:
+        resampling(df_buy_resample, df_sell_resample,
+                   p_save_dir.joinpath(dirname), freq, region=region)
+    logger.debug(f'[{target_date}] リサンプリング完了')
+
+
+def read_day_rows(p_row_dir):
+    """row/all.csvと、S3で追記した約定(row/appended/)を合わせて読み込む
+
+    Returns:
+        pd.DataFrame or None: read_csvのままのDataFrame(exec_dateは列)。どちらも存在しない場合はNone
+    """
+    df_list = []
+    p_all_path = p_row_dir.joinpath('all.csv')
+    if path_exists(p_all_path):
+        df_list.append(read_csv(str(p_all_path)))
+    df_list += [read_csv(path) for path in list_files(p_row_dir.joinpath(APPENDED_DIR))]
+    if len(df_list) == 0:
+        return None
+    if len(df_list) == 1:
+        return df_list[0]
+    df = pd.concat(df_list, ignore_index=True)
+    return df[~df['id'].duplicated().values].reset_index(drop=True)
+
+
+def coverage_path(product_code):
+    return Path(EXECUTION_HISTORY_DIR).joinpath(product_code, 'coverage.csv')
+
+
+def read_coverage(product_code):
+    """日毎に保存済みの約定の範囲(idの最小・最大、件数、取得元)を読み込む"""
+    p_coverage_path = coverage_path(product_code)
+    if not path_exists(p_coverage_path):
+        return pd.DataFrame(columns=['first_id', 'last_id', 'rows', 'source'], index=pd.Index([], name='date'))
+    return read_csv(str(p_coverage_path)).set_index('date')
+
+
+def day_coverage(df):
+    """1日分の約定の範囲([idの最小, idの最大, 件数])"""
+    return [int(df['id'].min()), int(df['id'].max()), len(df)]
+
+
+def merge_coverage(coverage, other):
+    """同じ日に追記した約定の範囲を合わせる"""
+    return [min(coverage[0], other[0]), max(coverage[1], other[1]), coverage[2] + other[2]]
+
+
+def register_coverage(product_code, coverages, source, extend=False):
+    """日毎の保存済みの範囲をまとめて記録する(coverage.csvは1回だけ書き直す)
+
+    同じ日の記録は上書きする。extend=Trueの場合は、既存の記録に追記した約定として
+    merge_coverageで範囲を広げる。
+
+    Args:
+        coverages (dict): 日付('YYYY-MM-DD') -> day_coverageの結果
+    """
+    if len(coverages) == 0:
+        return
+    df_coverage = read_coverage(product_code)
+    for date_key, coverage in coverages.items():
+        if extend and date_key in df_coverage.index:
+            coverage = merge_coverage(
+                coverage, [int(df_coverage.loc[date_key, col_name]) for col_name in ['first_id', 'last_id', 'rows']])
+        df_coverage.loc[date_key] = list(coverage) + [source]
+    df_to_csv(str(coverage_path(product_code)), df_coverage.sort_index(), index=True)
+
+
+def checkpoint_path(product_code):
+    return Path(EXECUTION_HISTORY_DIR).joinpath(product_code, 'checkpoint.json')
+
+
+def read_checkpoint(product_code):
+    p_checkpoint_path = checkpoint_path(product_code)
+    if not path_exists(p_checkpoint_path):
+        return None
+    return read_json(p_checkpoint_path)
+
+
+def update_checkpoint(product_code, df, pending_coverages=None):
+    """保存済みの最新の約定idを記録する(既存の記録より古い場合は更新しない)
+
+    pending_coveragesには、まだcoverage.csvに記録していない当日分の範囲を保持する
+    (refresh_latest_executionsの毎回の実行でcoverage.csvを書き直さないため)。
+    省略した場合は既存の記録を引き継ぐ。
+    """
+    if df.empty:
+        return
+    last_id = int(df['id'].max())
+    checkpoint = read_checkpoint(product_code)
+    if checkpoint is not None and checkpoint['last_id'] >= last_id:
+        return
+    if pending_coverages is None:
+        pending_coverages = {} if checkpoint is None else checkpoint.get('pending_coverages', {})
+    last_exec_date = df.index[df['id'].values.argmax()]
+    write_json(checkpoint_path(product_code), {
+        'last_id': last_id,
+        'last_exec_date': pd.Timestamp(last_exec_date).isoformat(),
+        'pending_coverages': pending_coverages,
+    })
+
+
+def read_bars(p_path):
+    """保存済みのリサンプリング済みデータを読み込む"""
+    if not path_exists(p_path):
+        return pd.DataFrame()
+    df = read_csv(str(p_path))
+    df['exec_date'] = pd.to_datetime(df['exec_date'], utc=True)
+    return compact_bars(df.set_index('exec_date'))
+
+
+def merge_bars(df_old, df_new):
+    """同じ間隔でリサンプリングしたデータを結合する
+
+    同じ区間の行は、open/closeを古い方/新しい方から取り、
+    high/lowは最大/最小、total_sizeは合計とする。
+    """
+    if df_old.empty:
+        return df_new
+    if df_new.empty:
+        return df_old
+
+    overlap = df_old.index.intersection(df_new.index)
+    df_merged = pd.DataFrame({
+        'open_price': df_old.loc[overlap, 'open_price'],
+        'high_price': np.fmax(df_old.loc[overlap, 'high_price'], df_new.loc[overlap, 'high_price']),
+        'low_price': np.fmin(df_old.loc[overlap, 'low_price'], df_new.loc[overlap, 'low_price']),
+        'close_price': df_new.loc[overlap, 'close_price'].fillna(df_old.loc[overlap, 'close_price']),
+        'total_size': df_old.loc[overlap, 'total_size'] + df_new.loc[overlap, 'total_size'],
+    }, index=overlap)
+    df_merged['open_price'] = df_merged['open_price'].fillna(df_new.loc[overlap, 'open_price'])
+
+    df = pd.concat([
+        df_old.drop(index=overlap),
+        df_merged,
+        df_new.drop(index=overlap),
+    ])
+    return df.sort_index()
+
+
+def append_day_executions(product_code, target_date, df_day, region='Asia/Tokyo'):
+    """1日分の新しい約定を生データに追記し、影響のある区間のリサンプリング済みデータを更新する"""
+    p_save_dir = Path(EXECUTION_HISTORY_DIR).joinpath(
+        product_code,
+        target_date.strftime('%Y'),
+        target_date.strftime('%m'),
+        target_date.strftime('%d'))
+    if writes_in_place():
+        for dirname in ['row'] + [dirname for dirname, _ in BAR_FREQUENCIES]:
+            p_save_dir.joinpath(dirname).mkdir(parents=True, exist_ok=True)
+
+    df_day = df_day[[col_name for col_name in EXECUTION_COLUMNS if col_name in df_day.columns]]
+    df_buy = df_day.query('side == "BUY"')
+    df_sell = df_day.query('side == "SELL"')
+
+    p_save_dir_row = p_save_dir.joinpath('row')
+    if writes_in_place():
+        append_csv(p_save_dir_row.joinpath('all.csv'), to_region(df_day, region), index=True)
+        append_csv(p_save_dir_row.joinpath('buy.csv'), to_region(df_buy, region), index=True)
+        append_csv(p_save_dir_row.joinpath('sell.csv'), to_region(df_sell, region), index=True)
+        if WRITE_TRADE_TAPE:
+            append_tape(tape_path(product_code, target_date), df_day)
+    elif not df_day.empty:
+        # S3は追記に対応しておらず、既存のオブジェクト全体を書き直すことになるため、
+        # 新しい約定のみを小さなオブジェクトとして書き込む(read_day_rows, open_tapeで結合し、
+        # compact_row_dataでまとめる)。buy.csv, sell.csvはall.csvから作れるため追記しない
+        first_id = int(df_day['id'].min())
+        df_to_csv(
+            str(p_save_dir_row.joinpath(APPENDED_DIR, f'{first_id:020d}.csv')),
+            to_region(df_day, region), index=True)
+        if WRITE_TRADE_TAPE:
+            write_tape_appended(tape_path(product_code, target_date), df_day)
+
+    for dirname, freq in BAR_FREQUENCIES:
+        df_buy_new, df_sell_new = resampling(
+            df_buy[['price', 'size']], df_sell[['price', 'size']], freq=freq, sparse=True)
+        for side_name, df_bars_new in [('buy', df_buy_new), ('sell', df_sell_new)]:
+            p_bars_path = p_save_dir.joinpath(dirname, f'{side_name}.csv')
+            df_bars = merge_bars(read_bars(p_bars_path), df_bars_new)
+            if not df_bars.empty:
+                df_to_csv(str(p_bars_path), to_region(df_bars, region), index=True)
+
+
+def refresh_latest_executions(product_code, current_datetime, count=500, region='Asia/Tokyo'):
+    """前回保存した約定id以降の約定のみを取得し、当日分のデータを更新する
+
+    Returns:
+        pd.DataFrame or None: 新しく取得した約定。チェックポイントが存在しない、
+            または古すぎる場合はNoneを返すため、get_executions_historyで取得し直す。
+    """
+    checkpoint = read_checkpoint(product_code)
+    if checkpoint is None:
+        logger.debug(f'[{product_code}] チェックポイントが存在しません。')
+        return None
+    last_exec_date = pd.Timestamp(checkpoint['last_exec_date'])
+    if current_datetime - last_exec_date > datetime.timedelta(hours=TAIL_REFRESH_MAX_GAP_HOURS):
+        logger.debug(f'[{product_code} {last_exec_date}] チェックポイントが古すぎます。')
+        return None
+
+    last_id = int(checkpoint['last_id'])
+    logger.debug(f'[{product_code} {last_id}] 以降の約定を取得中...')
+
+    # afterのみを指定すると最新のcount件が返るため、beforeで遡って隙間を埋める
+    df_page_list = []
+    before = 0
+    while True:
+        df_page = get_executions(product_code, count, before=before, after=last_id)
+        if df_page.empty:
+            break
+        df_page_list.append(df_page)
+        if len(df_page) < count:
+            break
+        before = int(df_page['id'].min())
+        # Lambdaでも連続して呼び出すとAPIの呼び出し回数の制限にかかるため、常に間隔を空ける
+        clock.sleep(0.25)
+
+    if len(df_page_list) == 0:
+        logger.debug(f'[{product_code}] 新しい約定はありません。')
+        return pd.DataFrame()
+
+    df_new = pd.concat(df_page_list)
+    df_new = df_new[~df_new['id'].duplicated().values]
+    df_new = df_new[df_new['id'].values > last_id].sort_index()
+
+    # 当日分の範囲はチェックポイントに貯めておき、日が変わった際にまとめて記録する
+    pending_coverages = checkpoint.get('pending_coverages', {})
+    target_dates = to_region(df_new, region).index.date
+    for target_date in sorted(set(target_dates)):
+        df_day = df_new[target_dates == target_date]
+        append_day_executions(product_code, target_date, df_day, region=region)
+        date_key = target_date.strftime('%Y-%m-%d')
+        coverage = day_coverage(df_day)
+        if date_key in pending_coverages:
+            coverage = merge_coverage(pending_coverages[date_key], coverage)
+        pending_coverages[date_key] = coverage
+        gen_execution_summaries(
+            product_code=product_code,
+            year=target_date.year,
+            month=target_date.month,
+            day=target_date.day
+        )
+
+    latest_date_key = max(target_dates).strftime('%Y-%m-%d')
+    register_coverage(product_code, {
+        date_key: coverage for date_key, coverage in pending_coverages.items() if date_key < latest_date_key
+    }, source='api', extend=True)
+    update_checkpoint(product_code, df_new, pending_coverages={
+        date_key: coverage for date_key, coverage in pending_coverages.items() if date_key >= latest_date_key
+    })
+    logger.debug(f'[{product_code}] {len(df_new)}件の約定を追加しました。')
+    return df_new
+
+
+def load_recent_bars(product_code, start, end, freq_dir='1m'):
+    """start < 時刻 <= end の区間のリサンプリング済みデータを日毎のファイルから読み込む"""
+    df_buy_list = []
+    df_sell_list = []
+    target_date = pd.Timestamp(start).tz_convert('Asia/Tokyo').date()
+    end_date = pd.Timestamp(end).tz_convert('Asia/Tokyo').date()
+    while target_date <= end_date:
+        p_dir = Path(EXECUTION_HISTORY_DIR).joinpath(
+            product_code,
+            target_date.strftime('%Y'),
+            target_date.strftime('%m'),
+            target_date.strftime('%d'),
+            freq_dir)
+        df_buy_list.append(read_bars(p_dir.joinpath('buy.csv')))
+        df_sell_list.append(read_bars(p_dir.joinpath('sell.csv')))
+        target_date += datetime.timedelta(days=1)
+
+    df_buy = pd.concat(df_buy_list).sort_index()
+    df_sell = pd.concat(df_sell_list).sort_index()
+    df_buy = df_buy[(df_buy.index > start) & (df_buy.index <= end)]
+    df_sell = df_sell[(df_sell.index > start) & (df_sell.index <= end)]
+    return df_buy, df_sell
+
+
+# (product_code, side, start, end, freq) -> get_candlesの結果
+_candle_cache = OrderedDict()
+
+
+def _stored_bar_step(step):
+    """stepを割り切る保存済みの間隔のうち、最も粗いものを返す"""
+    candidates = [
+        (pd.tseries.frequencies.to_offset(freq).nanos, dirname)
+        for dirname, freq in BAR_FREQUENCIES
+    ]
+    for stored_step, dirname in sorted(candidates, reverse=True):
+        if step % stored_step == 0:
+            return stored_step, dirname
+    raise ValueError(f'保存済みの間隔で割り切れない間隔は指定できません。({pd.Timedelta(step)})')
+
+
+def aggregate_bars(df, step, origin):
+    """OHLCVをstep(ns)ごとにまとめる
+
+    各行の区間番号を (時刻 - origin) // step で求め、
+    区間の境目でnumpyのreduceatを使って集計する。約定がなかった区間の行は出力しない。
+    """
+    df = drop_empty_bars(df)
+    if df.empty:
+        return df
+    timestamps = df.index.asi8
+    buckets = (timestamps - origin) // step
+    i_starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+    i_ends = np.r_[i_starts[1:], len(buckets)] - 1
+
+    df_candles = pd.DataFrame({
+        'open_price': df['open_price'].values[i_starts],
+        'high_price': np.maximum.reduceat(df['high_price'].values, i_starts),
+        'low_price': np.minimum.reduceat(df['low_price'].values, i_starts),
+        'close_price': df['close_price'].values[i_ends],
+        'total_size': np.add.reduceat(df['total_size'].values.astype('float64'), i_starts),
+    }, index=pd.to_datetime(origin + buckets[i_starts] * step, utc=True))
+    df_candles.index.name = 'exec_date'
+    return compact_bars(df_candles)
+
+
+def get_candles(product_code, start, end, freq, side='BUY', sparse=SPARSE_BARS):
+    """任意の間隔のOHLCVを保存済みのリサンプリング済みデータから作成する
+
+    freqを割り切る保存済みの間隔(1h, 10m, 1m)のうち最も粗いものを、
+    必要な日のファイルのみ読み込んで集計する。
+    区間はstartを起点にfreqごとに区切る(日足の場合はstartを0時にする)。
+    封印済みの日のみの期間の結果は、ファイルが更新されないためLRUキャッシュに保持する。
+
+    Args:
+        product_code (str): プロダクト
+        start (datetime.datetime): 開始時刻(タイムゾーン付き、この時刻を含む)
+        end (datetime.datetime): 終了時刻(タイムゾーン付き、この時刻を含まない)
+        freq (str): 間隔。5min, 4H, 1D, 1W のようにpd.Timedeltaで解釈できる文字列
+        side (str, optional): BUY or SELL
+        sparse (bool, optional): Falseの場合、約定がなかった区間の行をdensify_barsで補完する
+
+    Returns:
+        pd.DataFrame: indexがUTCのOHLCV
+    """
+    step = pd.Timedelta(freq).value
+    stored_step, freq_dir = _stored_bar_step(step)
+    start_ns = pd.Timestamp(start).value
+    end_ns = pd.Timestamp(end).value
+
+    key = (product_code, side, start_ns, end_ns, step, sparse)
+    if key in _candle_cache:
+        _candle_cache.move_to_end(key)
+        return _candle_cache[key].copy()
+
+    df_list = []
+    target_date = pd.Timestamp(start_ns, tz='UTC').tz_convert('Asia/Tokyo').date()
+    end_date = pd.Timestamp(end_ns - 1, tz='UTC').tz_convert('Asia/Tokyo').date()
+    while target_date <= end_date:
+        p_bars_path = Path(EXECUTION_HISTORY_DIR).joinpath(
+            product_code,
+            target_date.strftime('%Y'),
+            target_date.strftime('%m'),
+            target_date.strftime('%d'),
+            freq_dir,
+            f'{side.lower()}.csv')
+        df_list.append(read_bars(p_bars_path))
+        target_date += datetime.timedelta(days=1)
+
+    df_list = [df for df in df_list if not df.empty]
+    if len(df_list) == 0:
+        df_candles = pd.DataFrame()
+    else:
+        df = pd.concat(df_list).sort_index()
+        df = df[(df.index.asi8 >= start_ns) & (df.index.asi8 < end_ns)]
+        df_candles = aggregate_bars(df, step, start_ns)
+        if not sparse:
+            full_index = pd.to_datetime(
+                np.arange(start_ns, end_ns, step, dtype='int64'), utc=True)
+            df_candles = fill_empty_bars(df_candles.reindex(full_index))
+            df_candles.index.name = 'exec_date'
+    logger.debug(
+        f'[{product_code} {side} {freq} {start} - {end}] {freq_dir}の足から{len(df_candles)}本を作成しました。')
+
+    # 遅れて届いた約定やインポートで直近の日のファイルは書き換えられるため、
+    # 全ての日が封印済み(utils.is_sealedと同じ猶予日数)の場合のみキャッシュする
+    sealed_date = clock.now().date() - datetime.timedelta(days=CACHE_SEALED_GRACE_DAYS)
+    if end_date < sealed_date:
+        _candle_cache[key] = df_candles
+        while len(_candle_cache) > CANDLE_CACHE_SIZE:
+            _candle_cache.popitem(last=False)
+        return df_candles.copy()
+    return df_candles
+
+
+def resampling(df_buy, df_sell, p_save_dir='', freq='T', region='Asia/Tokyo', sparse=SPARSE_BARS):
+    """約定履歴をOHLCVにリサンプリングする
+
+    indexがUTCのまま集計し、保存時のみregionのタイムゾーンに変換する。
+    (分・時間単位の区切りはAsia/Tokyoでも同じ)
+    sparse=Trueの場合、約定がなかった区間の行は出力しない。
+    全区間の行が必要な場合はdensify_barsで復元する。
+    """
 
     df_buy_price = df_buy[['price']]
     df_buy_size = df_buy[['size']]
     df_buy_price_ohlc = df_buy_price.resample(freq).ohlc()
     df_buy_price_ohlc.columns = [
         f'{col_name[1]}_{col_name[0]}' for col_name in df_buy_price_ohlc.columns.tolist()]
-    df_buy_price_ohlc.interpolate()
-    df_buy_price_ohlc.dropna(how='any')
 
     df_buy_size = df_buy_size.resample(freq).sum()
     df_buy_size.columns = ['total_size']
-    df_buy_resampled = pd.concat([df_buy_price_ohlc, df_buy_size], axis=1)
+    df_buy_resampled = compact_bars(pd.concat([df_buy_price_ohlc, df_buy_size], axis=1))
+    if sparse:
+        df_buy_resampled = drop_empty_bars(df_buy_resampled)
     if not p_save_dir == '':
         # if REF_LOCAL:
         #     df_buy_resampled.to_csv(str(p_save_dir.joinpath('buy.csv')))
@@ -224,7 +642,7 @@ def resampling(df_buy, df_sell, p_save_dir='', freq='T'):
         #     str(p_save_dir.joinpath('buy.csv')),
         #     df=df_buy_resampled
         # )
-        df_to_csv(str(p_save_dir.joinpath('buy.csv')), df_buy_resampled, index=True)
+        df_to_csv(str(p_save_dir.joinpath('buy.csv')), to_region(df_buy_resampled, region), index=True)
 
     df_sell_price = df_sell[['price']]
     df_sell_size = df_sell[['size']]
@@ -234,7 +652,9 @@ def resampling(df_buy, df_sell, p_save_dir='', freq='T'):
         f'{col_name[1]}_{col_name[0]}' for col_name in df_sell_price_ohlc.columns.tolist()]
     df_sell_size = df_sell_size.resample(freq).sum()
     df_sell_size.columns = ['total_size']
-    df_sell_resampled = pd.concat([df_sell_price_ohlc, df_sell_size], axis=1)
+    df_sell_resampled = compact_bars(pd.concat([df_sell_price_ohlc, df_sell_size], axis=1))
+    if sparse:
+        df_sell_resampled = drop_empty_bars(df_sell_resampled)
     if not p_save_dir == '':
         # if REF_LOCAL:
         #     df_sell_resampled.to_csv(str(p_save_dir.joinpath('sell.csv')))
@@ -243,10 +663,58 @@ def resampling(df_buy, df_sell, p_save_dir='', freq='T'):
         #         str(p_save_dir.joinpath('sell.csv')),
         #         df=df_sell_resampled
         #     )
-        df_to_csv(str(p_save_dir.joinpath('sell.csv')), df_sell_resampled, index=True)
+        df_to_csv(str(p_save_dir.joinpath('sell.csv')), to_region(df_sell_resampled, region), index=True)
     return df_buy_resampled, df_sell_resampled
 
 
+def drop_empty_bars(df):
+    """約定がなかった区間(open_priceがNaNの行)を除く"""
+    if df.empty:
+        return df
+    return df[df['open_price'].notna().values]
+
+
+def densify_bars(df, freq, start=None, end=None, prev_close=None):
+    """疎なOHLCVを全区間の行を持つOHLCVに戻す
+
+    約定がなかった区間は、直前の終値をopen/high/low/closeとし、
+    total_sizeを0とする(前方補完)。
+
+    Args:
+        df (pd.DataFrame): resamplingの出力
+        freq (str): リサンプリング間隔
+        start (datetime.datetime, optional): 最初の区間の開始時刻
+        end (datetime.datetime, optional): 最後の区間の開始時刻
+        prev_close (float, optional): startより前の終値。指定しない場合、
+            最初の約定より前の区間はNaNのままになる。
+    """
+    if df.empty and (start is None or end is None):
+        return df
+    if start is None:
+        start = df.index[0]
+    if end is None:
+        end = df.index[-1]
+    full_index = pd.date_range(
+        pd.Timestamp(start).floor(freq), pd.Timestamp(end).floor(freq), freq=freq)
+    if df.index.tz is not None and full_index.tz is not None:
+        full_index = full_index.tz_convert(df.index.tz)
+
+    return fill_empty_bars(df.reindex(full_index), prev_close=prev_close)
+
+
+def fill_empty_bars(df_dense, prev_close=None):
+    """全区間の行を持つOHLCVのうち、約定がなかった行を直前の終値で埋める"""
+    close_price = df_dense['close_price'].ffill()
+    if prev_close is not None:
+        close_price = close_price.fillna(prev_close)
+    empty = df_dense['open_price'].isna()
+    for col_name in ['open_price', 'high_price', 'low_price']:
+        df_dense.loc[empty, col_name] = close_price[empty]
+    df_dense['close_price'] = close_price
+    df_dense['total_size'] = df_dense['total_size'].fillna(0)
+    return df_dense
+
+
 def make_summary_from_scratch(p_dir):
     logger.debug(f'[{p_dir}] 集計データ作成中...')
     p_buy_path = p_dir.joinpath('buy.csv')
@@ -262,8 +730,12 @@ def make_summary_from_scratch(p_dir):
     #         df_sell = pd.read_csv(str(p_sell_path))
     # else:
     if path_exists(p_buy_path) and path_exists(p_sell_path):
-        df_buy = read_csv(str(p_buy_path))
-        df_sell = read_csv(str(p_sell_path))
+        df_buy = read_csv(str(p_buy_path), usecols=SUMMARY_SOURCE_COLUMNS)
+        df_sell = read_csv(str(p_sell_path), usecols=SUMMARY_SOURCE_COLUMNS)
+
+    # 密なファイル(旧形式)に含まれる約定のない行は集計に使わない
+    df_buy = drop_empty_bars(df_buy)
+    df_sell = drop_empty_bars(df_sell)
 
     if df_buy.empty or df_sell.empty:
         logger.debug(f'[{p_dir}] データが存在しなかったため集計データ作成を中断します。')
@@ -308,6 +780,7 @@ def make_summary_from_scratch(p_dir):
     #         index=False
     #     )
     df_to_csv(str(p_summary_path), df_summary, index=False)
+    make_day_sketches(p_dir.parent, df_buy, df_sell)
     logger.debug(f'[{p_dir}] 集計データ作成完了')
     return df_summary
 
@@ -451,365 +924,369 @@ def make_summary(product_code, p_dir, daily=False):
             summary_path_list=[],
             save=True
         )
+        merge_sketch_files(p_dir, list_child_dirs(p_dir))
     return not df_summary.empty
 
 
-# def estimate_trends(latest_summary):
-#     return latest_summary
-
+def list_child_dirs(p_dir):
+    """直下のディレクトリ(S3ではprefix)の一覧を返す"""
+    if REF_LOCAL:
+        return sorted(p for p in p_dir.glob('*') if p.is_dir())
+    else:
+        return [Path(child_dir) for child_dir in s3.listdir(str(p_dir))]
+
+
+def _price_from_bars(df_buy, df_sell, since, last_close):
+    """リサンプリング済みデータのsince以降の区間の価格を集計する
+
+    Args:
+        last_close (dict): BUY, SELL -> 直近の終値(区間に約定がなかった場合に使う)
+    """
+    window = {}
+    for side, df_bars in [('BUY', df_buy), ('SELL', df_sell)]:
+        df_window = df_bars[df_bars.index > since]
+        if df_window.empty:
+            # 約定がなかった場合は直近の終値で代用する
+            close_price = last_close[side]
+            price = {
+                'open': close_price,
+                'high': close_price,
+                'low': close_price,
+                'close': close_price,
+            }
+        else:
+            price = {
+                'open': df_window['open_price'].values[0],
+                'high': df_window['high_price'].max(),
+                'low': df_window['low_price'].min(),
+                'close': df_window['close_price'].values[-1],
+            }
+        window[side] = {
+            'price': price,
+            'trend': 'DOWN',
+        }
+    return window
 
-def obtain_latest_summary(product_code):
-    logger.debug(f'[{product_code}] AI用集計データ取得中...')
-    p_exe_history_dir = Path(EXECUTION_HISTORY_DIR)
-    p_all_summary_path = p_exe_history_dir.joinpath(
-        product_code, 'summary.csv')
-
-    # daily summary
-    current_datetime = datetime.datetime.now(
-        datetime.timezone(datetime.timedelta(hours=9)))
-
-    before_1d_datetime = current_datetime - datetime.timedelta(days=1)
-    before_32d_datetime = current_datetime - datetime.timedelta(days=32)
-    before_1m_datetime = current_datetime + relativedelta(months=-1)
-    before_1y_datetime = current_datetime + relativedelta(years=-1)
-
-    df = get_executions_history(
-        product_code=product_code,
-        start_date=before_1d_datetime,
-        end_date=current_datetime,
-        return_df=True
-    )
 
-    df_buy = df.query('side == "BUY"')
-    df_sell = df.query('side == "SELL"')
+def _price_from_summary(df_summary):
+    window = {}
+    for side in ['BUY', 'SELL']:
+        window[side] = {
+            'open': df_summary.at['open_price', side],
+            'high': df_summary.at['high_price', side],
+            'low': df_summary.at['low_price', side],
+            'close': df_summary.at['close_price', side],
+        }
+    return window
 
-    df_buy_resampled, df_sell_resampled = resampling(df_buy[['price', 'size']], df_sell[['price', 'size']], freq='S')
 
-    # before_1h_datetime = current_datetime - datetime.timedelta(hours=1)
-    # df_buy_1h = df_buy_resampled.query('index > @before_1h_datetime')
-    # df_sell_1h = df_sell_resampled.query('index > @before_1h_datetime')
+class LatestSummary:
+    """AI用の集計データ
 
-    before_6h_datetime = current_datetime - datetime.timedelta(hours=6)
-    df_buy_6h = df_buy_resampled.query('index > @before_6h_datetime')
-    df_sell_6h = df_sell_resampled.query('index > @before_6h_datetime')
+    latest_summary['BUY']['1w']['price'] のように辞書と同じ形でアクセスできる。
+    各期間の集計は最初にアクセスされた時点で作成してメモ化し、
+    アクセスされなかった期間のファイル読み込みや集計は行わない。
+    used_windowsには実際に使われた期間がアクセス順に記録される。
+    """
 
-    before_12h_datetime = current_datetime - datetime.timedelta(hours=12)
-    df_buy_12h = df_buy_resampled.query('index > @before_12h_datetime')
-    df_sell_12h = df_sell_resampled.query('index > @before_12h_datetime')
+    INTRADAY_WINDOWS = {
+        '6h': datetime.timedelta(hours=6),
+        '12h': datetime.timedelta(hours=12),
+        '1d': datetime.timedelta(days=1),
+    }
 
-    df_buy_1d = df_buy_resampled.query('index > @before_1d_datetime')
-    df_sell_1d = df_sell_resampled.query('index > @before_1d_datetime')
+    def __init__(self, product_code, current_datetime=None):
+        self.product_code = product_code
+        if current_datetime is None:
+            current_datetime = clock.now()
+        self.current_datetime = current_datetime
+        self.p_product_dir = Path(EXECUTION_HISTORY_DIR).joinpath(product_code)
+
+        self.used_windows = []
+        self._windows = {}
+        self._bars = None
+        self._summaries_generated = False
+        self._indicator_engine = None
+        self._sketches = {}
+
+        self._loaders = {
+            'now': self._load_now,
+            '6h': self._load_intraday,
+            '12h': self._load_intraday,
+            '1d': self._load_intraday,
+            '1w': self._load_weekly,
+            '1m': self._load_monthly,
+            '1y': self._load_yearly,
+            'all': self._load_all,
+            'yesterday': self._load_yesterday,
+            'last_month': self._load_last_month,
+            'last_year': self._load_last_year,
+        }
 
-    gen_execution_summaries(
-        product_code=product_code,
-        year=int(before_1d_datetime.strftime('%Y')),
-        month=int(before_1d_datetime.strftime('%m')),
-        day=int(before_1d_datetime.strftime('%d'))
-    )
+    def __getitem__(self, side):
+        if side not in ['BUY', 'SELL']:
+            raise KeyError(side)
+        return _LatestSummarySide(self, side)
+
+    def window(self, name):
+        """期間nameの集計を返す。データが存在しない期間はNoneを返す"""
+        if name not in self._loaders:
+            raise KeyError(name)
+        if name not in self._windows:
+            window = self._loaders[name](name)
+            if window is not None and name in TREND_SPECS:
+                # 指標の更新は重いため、trendを参照した場合のみ行う
+                for side in ['BUY', 'SELL']:
+                    window[side] = _WindowSide(self, side, name, window[side])
+            self._windows[name] = window
+            self.used_windows.append(name)
+        return self._windows[name]
+
+    def indicator_engine(self):
+        """最新の足まで更新した指標を返す(1回の実行につき1度だけ更新・保存する)"""
+        if self._indicator_engine is None:
+            # 指標は保存済みの足と日毎の集計から計算するため、先に更新しておく
+            self._ensure_summaries()
+            self._indicator_engine = IndicatorEngine(self.product_code)
+            self._indicator_engine.update(self.current_datetime)
+            self._indicator_engine.save()
+        return self._indicator_engine
+
+    def quantiles(self, side, qs, days=None):
+        """直近days日間(当日を含む)の価格の分位点を返す
+
+        日・月・年ごとに保存したスケッチを結合して求めるため、全期間の約定を読み込まない。
+
+        Args:
+            side (str): BUY or SELL
+            qs (list): 分位点(0以上1以下)のリスト
+            days (int, optional): 対象の日数。省略した場合は全期間
+        """
+        key = (side, days)
+        if key not in self._sketches:
+            self._ensure_summaries()
+            if days is None:
+                self._sketches[key] = load_all_sketch(self.product_code, side)
+            else:
+                end_date = self.current_datetime.date()
+                start_date = end_date - datetime.timedelta(days=days - 1)
+                self._sketches[key] = load_window_sketch(self.product_code, side, start_date, end_date)
+        return self._sketches[key].quantiles(qs)
+
+    def quantile(self, side, q, days=None):
+        return self.quantiles(side, [q], days=days)[0]
+
+    def to_dict(self):
+        """全ての期間を集計し、従来の辞書形式で返す"""
+        latest_summary = {'BUY': {}, 'SELL': {}}
+        for name in self._loaders.keys():
+            window = self.window(name)
+            if window is None:
+                continue
+            for side in ['BUY', 'SELL']:
+                latest_summary[side][name] = window[side]
+        return latest_summary
+
+    def _intraday_bars(self):
+        if self._bars is None and TAIL_REFRESH:
+            df_new = refresh_latest_executions(self.product_code, self.current_datetime)
+            if df_new is not None:
+                # 新しい約定があった日の集計はrefresh_latest_executionsで更新済み
+                self._summaries_generated = True
+                self._bars = load_recent_bars(
+                    self.product_code,
+                    self.current_datetime - datetime.timedelta(days=1),
+                    self.current_datetime,
+                    freq_dir='1m'
+                )
+        if self._bars is None:
+            before_1d_datetime = self.current_datetime - datetime.timedelta(days=1)
+            df = get_executions_history(
+                product_code=self.product_code,
+                start_date=before_1d_datetime,
+                end_date=self.current_datetime,
+                return_df=True,
+                drop_order_ids=True
+            )
 
-    gen_execution_summaries(
-        product_code=product_code,
-        year=int(current_datetime.strftime('%Y')),
-        month=int(current_datetime.strftime('%m')),
-        day=int(current_datetime.strftime('%d'))
-    )
+            df_buy = df.query('side == "BUY"')
+            df_sell = df.query('side == "SELL"')
 
-    # monthly summary
-    p_target_monthly_summary_path_list = [
-        p_exe_history_dir.joinpath(
-            product_code,
-            current_datetime.strftime('%Y'),
-            current_datetime.strftime('%m'),
-            'summary.csv'
-        ),
-        p_exe_history_dir.joinpath(
-            product_code,
-            before_32d_datetime.strftime('%Y'),
-            before_32d_datetime.strftime('%m'),
+            self._bars = resampling(df_buy[['price', 'size']], df_sell[['price', 'size']], freq='S', sparse=True)
+        return self._bars
+
+    def _ensure_summaries(self):
+        # 日毎の集計は当日のダウンロード結果から作成するため、先にダウンロードする
+        self._intraday_bars()
+        if not self._summaries_generated:
+            before_1d_datetime = self.current_datetime - datetime.timedelta(days=1)
+            for target_datetime in [before_1d_datetime, self.current_datetime]:
+                gen_execution_summaries(
+                    product_code=self.product_code,
+                    year=int(target_datetime.strftime('%Y')),
+                    month=int(target_datetime.strftime('%m')),
+                    day=int(target_datetime.strftime('%d'))
+                )
+            self._summaries_generated = True
+
+    def _summary_path(self, target_datetime, level):
+        date_format = {
+            'year': ['%Y'],
+            'month': ['%Y', '%m'],
+            'day': ['%Y', '%m', '%d'],
+        }[level]
+        return self.p_product_dir.joinpath(
+            *[target_datetime.strftime(fmt) for fmt in date_format],
             'summary.csv'
         )
-    ]
 
-    target_monthly_summary_path_list = []
-    for p_target_monthly_summary_path in p_target_monthly_summary_path_list:
-        if path_exists(p_target_monthly_summary_path):
-            target_monthly_summary_path_list.append(
-                str(p_target_monthly_summary_path)
-            )
-    df_monthly_summary = make_summary_from_csv(
-        product_code=product_code,
-        p_dir='',
-        summary_path_list=target_monthly_summary_path_list,
-        save=False
-    )
-
-    # weekly summary
-    target_weekly_summary_path_list = []
-    for i in range(8):
-        target_datetime = current_datetime - datetime.timedelta(days=i)
-        p_target_weekly_summary_path = p_exe_history_dir.joinpath(
-            product_code,
-            target_datetime.strftime('%Y'),
-            target_datetime.strftime('%m'),
-            target_datetime.strftime('%d'),
-            'summary.csv'
+    def _merge_summaries(self, p_summary_path_list):
+        summary_path_list = [
+            str(p_summary_path) for p_summary_path in p_summary_path_list
+            if path_exists(p_summary_path)
+        ]
+        return make_summary_from_csv(
+            product_code=self.product_code,
+            p_dir='',
+            summary_path_list=summary_path_list,
+            save=False
         )
-        if path_exists(p_target_weekly_summary_path):
-            target_weekly_summary_path_list.append(
-                str(p_target_weekly_summary_path)
-            )
-    df_weekly_summary = make_summary_from_csv(
-        product_code=product_code,
-        p_dir='',
-        summary_path_list=target_weekly_summary_path_list,
-        save=False
-    )
 
-    # yearly summary
-    target_yearly_summary_path_list = []
-    for i in range(13):
-        target_datetime = current_datetime + relativedelta(months=-i)
-        p_target_yearly_summary_path = p_exe_history_dir.joinpath(
-            product_code,
-            target_datetime.strftime('%Y'),
-            target_datetime.strftime('%m'),
-            'summary.csv'
-        )
-        if path_exists(p_target_yearly_summary_path):
-            target_yearly_summary_path_list.append(
-                str(p_target_yearly_summary_path)
-            )
+    def _read_summary(self, p_summary_path):
+        if not path_exists(p_summary_path):
+            return None
+        df_summary = read_csv(str(p_summary_path))
+        return df_summary.set_index('CATEGORY')
+
+    def _last_close(self):
+        """直近の終値。足が存在しない場合は、当日・前日の日毎の集計の終値で代用する"""
+        df_buy_resampled, df_sell_resampled = self._intraday_bars()
+        last_close = {}
+        for side, df_bars in [('BUY', df_buy_resampled), ('SELL', df_sell_resampled)]:
+            if not df_bars.empty:
+                last_close[side] = df_bars['close_price'].values[-1]
+                continue
+            for target_datetime in [self.current_datetime, self.current_datetime - datetime.timedelta(days=1)]:
+                df_summary = self._read_summary(self._summary_path(target_datetime, 'day'))
+                if df_summary is not None and not df_summary.empty:
+                    last_close[side] = df_summary.at['close_price', side]
+                    break
+            else:
+                raise ValueError(f'[{self.product_code} {side}] 直近の約定が存在しないため、価格を決められません。')
+            logger.info(f'[{self.product_code} {side}] 直近の約定がないため、日毎の集計の終値を使います。')
+        return last_close
+
+    def _load_now(self, name):
+        last_close = self._last_close()
+        return {
+            'BUY': {'price': last_close['BUY']},
+            'SELL': {'price': last_close['SELL']},
+        }
 
-    df_yearly_summary = make_summary_from_csv(
-        product_code=product_code,
-        p_dir='',
-        summary_path_list=target_yearly_summary_path_list,
-        save=False
-    )
+    def _load_intraday(self, name):
+        df_buy_resampled, df_sell_resampled = self._intraday_bars()
+        since = self.current_datetime - self.INTRADAY_WINDOWS[name]
+        return _price_from_bars(df_buy_resampled, df_sell_resampled, since, self._last_close())
+
+    def _load_range_summary(self, p_summary_path_list):
+        self._ensure_summaries()
+        df_summary = self._merge_summaries(p_summary_path_list)
+        window = _price_from_summary(df_summary)
+        return {
+            side: {'price': window[side], 'trend': 'DOWN'}
+            for side in ['BUY', 'SELL']
+        }
 
-    df_all_summary = read_csv(str(p_all_summary_path))
+    def _load_weekly(self, name):
+        return self._load_range_summary([
+            self._summary_path(self.current_datetime - datetime.timedelta(days=i), 'day')
+            for i in range(8)
+        ])
+
+    def _load_monthly(self, name):
+        before_32d_datetime = self.current_datetime - datetime.timedelta(days=32)
+        return self._load_range_summary([
+            self._summary_path(self.current_datetime, 'month'),
+            self._summary_path(before_32d_datetime, 'month'),
+        ])
+
+    def _load_yearly(self, name):
+        return self._load_range_summary([
+            self._summary_path(self.current_datetime + relativedelta(months=-i), 'month')
+            for i in range(13)
+        ])
+
+    def _load_all(self, name):
+        self._ensure_summaries()
+        df_all_summary = read_csv(str(self.p_product_dir.joinpath('summary.csv')))
+        df_all_summary = df_all_summary.set_index('CATEGORY', drop=True)
+        window = _price_from_summary(df_all_summary)
+        return {
+            side: {'price': window[side], 'trend': 'DOWN'}
+            for side in ['BUY', 'SELL']
+        }
 
-    df_all_summary = df_all_summary.set_index('CATEGORY', drop=True)
+    def _load_past_summary(self, p_summary_path):
+        self._ensure_summaries()
+        df_summary = self._read_summary(p_summary_path)
+        if df_summary is None or df_summary.empty:
+            return None
+        return _price_from_summary(df_summary)
 
-    latest_summary = {
-        'BUY': {
-            'now': {
-                'price': df_buy_1d['close_price'].values[-1],
-            },
-            '6h': {
-                'price': {
-                    'open': df_buy_6h['open_price'].values[0],
-                    'high': df_buy_6h['high_price'].max(),
-                    'low': df_buy_6h['low_price'].min(),
-                    'close': df_buy_6h['close_price'].values[-1],
-                },
-                'trend': 'DOWN',
-            },
-            '12h': {
-                'price': {
-                    'open': df_buy_12h['open_price'].values[0],
-                    'high': df_buy_12h['high_price'].max(),
-                    'low': df_buy_12h['low_price'].min(),
-                    'close': df_buy_12h['close_price'].values[-1],
-                },
-                'trend': 'DOWN',
-            },
-            '1d': {
-                'price': {
-                    'open': df_buy_1d['open_price'].values[0],
-                    'high': df_buy_1d['high_price'].max(),
-                    'low': df_buy_1d['low_price'].min(),
-                    'close': df_buy_1d['close_price'].values[-1],
-                },
-                'trend': 'DOWN',
-            },
-            '1w': {
-                'price': {
-                    'open': df_weekly_summary.at['open_price', 'BUY'],
-                    'high': df_weekly_summary.at['high_price', 'BUY'],
-                    'low': df_weekly_summary.at['low_price', 'BUY'],
-                    'close': df_weekly_summary.at['close_price', 'BUY'],
-                },
-                'trend': 'DOWN',
-            },
-            '1m': {
-                'price': {
-                    'open': df_monthly_summary.at['open_price', 'BUY'],
-                    'high': df_monthly_summary.at['high_price', 'BUY'],
-                    'low': df_monthly_summary.at['low_price', 'BUY'],
-                    'close': df_monthly_summary.at['close_price', 'BUY'],
-                },
-                'trend': 'DOWN',
-            },
-            '1y': {
-                'price': {
-                    'open': df_yearly_summary.at['open_price', 'BUY'],
-                    'high': df_yearly_summary.at['high_price', 'BUY'],
-                    'low': df_yearly_summary.at['low_price', 'BUY'],
-                    'close': df_yearly_summary.at['close_price', 'BUY'],
-                },
-                'trend': 'DOWN',
-            },
-            'all': {
-                'price': {
-                    'open': df_all_summary.at['open_price', 'BUY'],
-                    'high': df_all_summary.at['high_price', 'BUY'],
-                    'low': df_all_summary.at['low_price', 'BUY'],
-                    'close': df_all_summary.at['close_price', 'BUY'],
-                },
-                'trend': 'DOWN',
-            },
-        },
-        'SELL': {
-            'now': {
-                'price': df_sell_1d['close_price'].values[-1],
-            },
-            '6h': {
-                'price': {
-                    'open': df_sell_6h['open_price'].values[0],
-                    'high': df_sell_6h['high_price'].max(),
-                    'low': df_sell_6h['low_price'].min(),
-                    'close': df_sell_6h['close_price'].values[-1],
-                },
-                'trend': 'DOWN',
-            },
-            '12h': {
-                'price': {
-                    'open': df_sell_12h['open_price'].values[0],
-                    'high': df_sell_12h['high_price'].max(),
-                    'low': df_sell_12h['low_price'].min(),
-                    'close': df_sell_12h['close_price'].values[-1],
-                },
-                'trend': 'DOWN',
-            },
-            '1d': {
-                'price': {
-                    'open': df_sell_1d['open_price'].values[0],
-                    'high': df_sell_1d['high_price'].max(),
-                    'low': df_sell_1d['low_price'].min(),
-                    'close': df_sell_1d['close_price'].values[-1],
-                },
-                'trend': 'DOWN',
-            },
-            '1w': {
-                'price': {
-                    'open': df_weekly_summary.at['open_price', 'SELL'],
-                    'high': df_weekly_summary.at['high_price', 'SELL'],
-                    'low': df_weekly_summary.at['low_price', 'SELL'],
-                    'close': df_weekly_summary.at['close_price', 'SELL'],
-                },
-                'trend': 'DOWN',
-            },
-            '1m': {
-                'price': {
-                    'open': df_monthly_summary.at['open_price', 'SELL'],
-                    'high': df_monthly_summary.at['high_price', 'SELL'],
-                    'low': df_monthly_summary.at['low_price', 'SELL'],
-                    'close': df_monthly_summary.at['close_price', 'SELL'],
-                },
-                'trend': 'DOWN',
-            },
-            '1y': {
-                'price': {
-                    'open': df_yearly_summary.at['open_price', 'SELL'],
-                    'high': df_yearly_summary.at['high_price', 'SELL'],
-                    'low': df_yearly_summary.at['low_price', 'SELL'],
-                    'close': df_yearly_summary.at['close_price', 'SELL'],
-                },
-                'trend': 'DOWN',
-            },
-            'all': {
-                'price': {
-                    'open': df_all_summary.at['open_price', 'SELL'],
-                    'high': df_all_summary.at['high_price', 'SELL'],
-                    'low': df_all_summary.at['low_price', 'SELL'],
-                    'close': df_all_summary.at['close_price', 'SELL'],
-                },
-                'trend': 'DOWN',
-            },
-        }
-    }
+    def _load_yesterday(self, name):
+        before_1d_datetime = self.current_datetime - datetime.timedelta(days=1)
+        return self._load_past_summary(self._summary_path(before_1d_datetime, 'day'))
 
-    # load summaries
-    p_yesterday_summary_path = p_exe_history_dir.joinpath(
-        product_code,
-        before_1d_datetime.strftime('%Y'),
-        before_1d_datetime.strftime('%m'),
-        before_1d_datetime.strftime('%d'),
-        'summary.csv'
-    )
-    p_last_month_summary_path = p_exe_history_dir.joinpath(
-        product_code,
-        before_1m_datetime.strftime('%Y'),
-        before_1m_datetime.strftime('%m'),
-        'summary.csv'
-    )
-    p_last_year_summary_path = p_exe_history_dir.joinpath(
-        product_code,
-        before_1y_datetime.strftime('%Y'),
-        'summary.csv'
-    )
-    df_yesterday_summary = pd.DataFrame()
-    df_last_month_summary = pd.DataFrame()
-    df_last_year_summary = pd.DataFrame()
-
-    if path_exists(p_yesterday_summary_path):
-        df_yesterday_summary = read_csv(str(p_yesterday_summary_path))
-        df_yesterday_summary = df_yesterday_summary.set_index('CATEGORY')
-
-    if path_exists(p_last_month_summary_path):
-        df_last_month_summary = read_csv(str(p_last_month_summary_path))
-        df_last_month_summary = df_last_month_summary.set_index('CATEGORY')
-
-    if path_exists(p_last_year_summary_path):
-        df_last_year_summary = read_csv(str(p_last_year_summary_path))
-        df_last_year_summary = df_last_year_summary.set_index('CATEGORY')
-
-    if not df_yesterday_summary.empty:
-        latest_summary['BUY']['yesterday'] = {
-            'open': df_yesterday_summary.at['open_price', 'BUY'],
-            'high': df_yesterday_summary.at['high_price', 'BUY'],
-            'low': df_yesterday_summary.at['low_price', 'BUY'],
-            'close': df_yesterday_summary.at['close_price', 'BUY'],
-        }
-        latest_summary['SELL']['yesterday'] = {
-            'open': df_yesterday_summary.at['open_price', 'SELL'],
-            'high': df_yesterday_summary.at['high_price', 'SELL'],
-            'low': df_yesterday_summary.at['low_price', 'SELL'],
-            'close': df_yesterday_summary.at['close_price', 'SELL'],
-        }
+    def _load_last_month(self, name):
+        before_1m_datetime = self.current_datetime + relativedelta(months=-1)
+        return self._load_past_summary(self._summary_path(before_1m_datetime, 'month'))
 
-    if not df_last_month_summary.empty:
-        latest_summary['BUY']['last_month'] = {
-            'open': df_last_month_summary.at['open_price', 'BUY'],
-            'high': df_last_month_summary.at['high_price', 'BUY'],
-            'low': df_last_month_summary.at['low_price', 'BUY'],
-            'close': df_last_month_summary.at['close_price', 'BUY'],
-        }
-        latest_summary['SELL']['last_month'] = {
-            'open': df_last_month_summary.at['open_price', 'SELL'],
-            'high': df_last_month_summary.at['high_price', 'SELL'],
-            'low': df_last_month_summary.at['low_price', 'SELL'],
-            'close': df_last_month_summary.at['close_price', 'SELL'],
-        }
+    def _load_last_year(self, name):
+        before_1y_datetime = self.current_datetime + relativedelta(years=-1)
+        return self._load_past_summary(self._summary_path(before_1y_datetime, 'year'))
 
-    if not df_last_year_summary.empty:
-        latest_summary['BUY']['last_year'] = {
-            'open': df_last_year_summary.at['open_price', 'BUY'],
-            'high': df_last_year_summary.at['high_price', 'BUY'],
-            'low': df_last_year_summary.at['low_price', 'BUY'],
-            'close': df_last_year_summary.at['close_price', 'BUY'],
-        }
-        latest_summary['SELL']['last_year'] = {
-            'open': df_last_year_summary.at['open_price', 'SELL'],
-            'high': df_last_year_summary.at['high_price', 'SELL'],
-            'low': df_last_year_summary.at['low_price', 'SELL'],
-            'close': df_last_year_summary.at['close_price', 'SELL'],
-        }
 
-    logger.debug(f'[{product_code}] AI用集計データ取得完了')
+class _WindowSide(dict):
+    """期間の集計のうち売買の種類を指定したもの。trendは最初に参照した際に指標から求める"""
+
+    def __init__(self, latest_summary, side, name, values):
+        super().__init__((key, value) for key, value in values.items() if key != 'trend')
+        self.latest_summary = latest_summary
+        self.side = side
+        self.name = name
+
+    def __missing__(self, key):
+        if key != 'trend':
+            raise KeyError(key)
+        self['trend'] = self.latest_summary.indicator_engine().trend(self.side, self.name)
+        return self['trend']
+
+
+class _LatestSummarySide:
+    """LatestSummary['BUY'] のように売買の種類を指定したビュー"""
+
+    def __init__(self, latest_summary, side):
+        self.latest_summary = latest_summary
+        self.side = side
+
+    def __getitem__(self, name):
+        window = self.latest_summary.window(name)
+        if window is None:
+            raise KeyError(name)
+        return window[self.side]
+
+    def __contains__(self, name):
+        return self.latest_summary.window(name) is not None
+
+    def get(self, name, default=None):
+        if name in self:
+            return self[name]
+        return default
+
 
-    return latest_summary
+def obtain_latest_summary(product_code):
+    logger.debug(f'[{product_code}] AI用集計データ取得準備完了(各期間は参照時に集計されます)')
+    return LatestSummary(product_code)
 
 
 def gen_execution_summaries(product_code, year=2021, month=-1, day=-1):
@@ -907,22 +1384,128 @@ def gen_execution_summaries(product_code, year=2021, month=-1, day=-1):
     logger.debug(f'[{product_code} {year} {month} {day}] 集計データ作成終了')
 
 
-def delete_row_data(product_code, current_datetime, days):
-    before_7d_datetime = current_datetime - datetime.timedelta(days=days)
-    p_dir = Path(EXECUTION_HISTORY_DIR)
-    p_target_dir = p_dir.joinpath(
+def row_archive_part_path(product_code, target_date):
+    """1日分の生データのアーカイブ(<YYYY>/<MM>/row_archive/<DD>.csv.gz)"""
+    return Path(EXECUTION_HISTORY_DIR).joinpath(
         product_code,
-        before_7d_datetime.strftime('%Y'),
-        before_7d_datetime.strftime('%m'),
-        before_7d_datetime.strftime('%d'),
-        'row'
+        target_date.strftime('%Y'),
+        target_date.strftime('%m'),
+        ROW_ARCHIVE_DIR,
+        target_date.strftime('%d') + '.csv.gz'
     )
 
-    if REF_LOCAL:
-        if p_target_dir.is_dir():
-            for filename in ['all.csv', 'buy.csv', 'sell.csv']:
-                p_target_path = p_target_dir.joinpath(filename)
-                p_target_path.unlink()
-            p_target_dir.rmdir()
-    else:
-        s3.delete_dir(str(p_target_dir))
+
+def write_row_archive(product_code, target_date, df_chunks):
+    """1日分の生データをgzipで圧縮して保存する
+
+    チャンクごとにgzipのメンバーとして圧縮するため、1日分を一度に読み込む必要はない。
+    日ごとに別のオブジェクトにするため、月のアーカイブ全体を読み直さずに済み、
+    同じ日を再度処理しても上書きされるだけで重複しない。
+
+    Returns:
+        tuple: (行数, 圧縮後のバイト数)
+    """
+    archive_members = []
+    rows = 0
+    for df_chunk in df_chunks:
+        if df_chunk.empty:
+            continue
+        csv_body = df_chunk.to_csv(index=False, header=rows == 0).encode('utf-8')
+        archive_members.append(gzip.compress(csv_body, mtime=0))
+        rows += len(df_chunk)
+    if rows == 0:
+        return 0, 0
+    archive_body = b''.join(archive_members)
+    write_bytes(row_archive_part_path(product_code, target_date), archive_body)
+    return rows, len(archive_body)
+
+
+def _iter_day_rows(p_row_dir):
+    """row/all.csvをチャンクごとに読み込み、続けてS3で追記した約定(row/appended/)を返す"""
+    p_all_path = p_row_dir.joinpath('all.csv')
+    if path_exists(p_all_path):
+        yield from iter_csv(p_all_path)
+    for path in list_files(p_row_dir.joinpath(APPENDED_DIR)):
+        yield read_csv(path)
+
+
+def compact_row_data(product_code, current_datetime, days=ROW_RETENTION_DAYS, scan_days=62):
+    """保持期間を過ぎた生データを日ごとの圧縮アーカイブにまとめ、元データを削除する
+
+    current_datetimeからdays日以上前の日のうち、scan_days日前までの範囲に
+    row/all.csv(またはS3で追記した約定)が残っている日を全て対象とするため、
+    実行されなかった日があっても次回の実行でまとめて処理される。
+    アーカイブは1日ごとのgzip(row_archive_part_path)で、
+    load_row_archiveで月内の日を結合したDataFrameとして読み込める。
+
+    Returns:
+        dict: 処理結果
+    """
+    cutoff_date = (current_datetime - datetime.timedelta(days=days)).date()
+    scan_start_date = cutoff_date - datetime.timedelta(days=scan_days)
+
+    p_product_dir = Path(EXECUTION_HISTORY_DIR).joinpath(product_code)
+
+    # 対象となる月のファイル一覧から、生データが残っている日を探す
+    target_dates = []
+    target_month = scan_start_date.replace(day=1)
+    while target_month <= cutoff_date:
+        p_month_dir = p_product_dir.joinpath(
+            target_month.strftime('%Y'), target_month.strftime('%m'))
+        for file_path in list_files(p_month_dir):
+            # row/all.csv、またはS3で追記した約定(row/appended/)
+            relative_parts = Path(file_path).relative_to(p_month_dir).parts
+            if len(relative_parts) < 3 or relative_parts[1] != 'row':
+                continue
+            target_date = target_month.replace(day=int(relative_parts[0]))
+            if scan_start_date <= target_date <= cutoff_date:
+                target_dates.append(target_date)
+        target_month += relativedelta(months=+1)
+    target_dates = sorted(set(target_dates))
+
+    report = {
+        'days': len(target_dates),
+        'rows': 0,
+        'archived_bytes': 0,
+        'deleted_files': 0,
+    }
+    if len(target_dates) == 0:
+        logger.debug(f'[{product_code}] 圧縮対象の生データは存在しません。')
+        return report
+
+    for i, target_date in enumerate(target_dates):
+        p_row_dir = p_product_dir.joinpath(
+            target_date.strftime('%Y'),
+            target_date.strftime('%m'),
+            target_date.strftime('%d'),
+            'row'
+        )
+        rows, archived_bytes = write_row_archive(product_code, target_date, _iter_day_rows(p_row_dir))
+        report['rows'] += rows
+        report['archived_bytes'] += archived_bytes
+
+        report['deleted_files'] += rm_dir(p_row_dir)
+        if WRITE_TRADE_TAPE:
+            fold_tape_appended(tape_path(product_code, target_date))
+
+        logger.info(
+            f'[{product_code} {target_date}] 生データを圧縮しました。'
+            + f'({i + 1}/{len(target_dates)}日 {report["rows"]}行 {report["deleted_files"]}ファイル削除)'
+        )
+
+    return report
+
+
+def load_row_archive(product_code, year, month):
+    """compact_row_dataで作成した日ごとのアーカイブを、1か月分まとめて読み込む"""
+    p_archive_dir = Path(EXECUTION_HISTORY_DIR).joinpath(
+        product_code, str(year), format(int(month), '02'), ROW_ARCHIVE_DIR)
+    p_archive_paths = [Path(path) for path in list_files(p_archive_dir)]
+    if len(p_archive_paths) == 0:
+        return pd.DataFrame()
+
+    df = pd.concat([read_csv(str(p_path), compression='gzip') for p_path in p_archive_paths], ignore_index=True)
+    df = df.drop_duplicates(subset='id').sort_values('id')
+    df['exec_date'] = pd.to_datetime(df['exec_date'], utc=True)
+    df = compact_executions(df.set_index('exec_date'))
+    return df
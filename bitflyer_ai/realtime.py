@@ -0,0 +1,617 @@
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import os
+import socket
+import socketserver
+import ssl
+import struct
+import threading
+import time
+import urllib.parse
+from logging import getLogger
+
+from bitflyer_api import credentials
+from lease import StorageLease
+from manage import ORDERS_LEASE_NAME
+
+logger = getLogger(__name__)
+
+REALTIME_URL = 'wss://ws.lightstream.bitflyer.com/json-rpc'
+CHILD_ORDER_CHANNEL = 'child_order_events'
+
+# 注文の状態が変わるイベント(ORDER, ORDER_FAILED, CANCEL_FAILEDでは状態は変わらない)
+REFRESH_EVENT_TYPES = ['EXECUTION', 'CANCEL', 'EXPIRE']
+
+TERMS = ['long', 'short', 'dca']
+
+WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+OPCODE_CONTINUATION = 0x0
+OPCODE_TEXT = 0x1
+OPCODE_BINARY = 0x2
+OPCODE_CLOSE = 0x8
+OPCODE_PING = 0x9
+OPCODE_PONG = 0xA
+
+
+class ConnectionClosed(ConnectionError):
+    pass
+
+
+def _accept_key(key):
+    return base64.b64encode(hashlib.sha1((key + WEBSOCKET_GUID).encode('ascii')).digest()).decode('ascii')
+
+
+def _apply_mask(payload, mask_key):
+    n = len(payload)
+    if n == 0:
+        return payload
+    mask = (mask_key * (n // 4 + 1))[:n]
+    return (int.from_bytes(payload, 'big') ^ int.from_bytes(mask, 'big')).to_bytes(n, 'big')
+
+
+class WebSocket:
+    """RFC 6455のWebSocket(テキストフレームのみ)
+
+    クライアントはmask=True、サーバーはmask=Falseで送信する。
+
+    Args:
+        sock (socket.socket): ハンドシェイク済みのソケット
+        mask (bool): 送信するフレームをマスクするか
+        buffer (bytes, optional): ハンドシェイクの後に受信済みのデータ
+    """
+
+    def __init__(self, sock, mask, buffer=b''):
+        self.sock = sock
+        self.mask = mask
+        self._buffer = buffer
+        # 受信途中のメッセージの分割されたフレーム
+        self._fragments = []
+        self._send_lock = threading.Lock()
+
+    @classmethod
+    def connect(cls, url, timeout=10):
+        parsed = urllib.parse.urlsplit(url)
+        secure = parsed.scheme == 'wss'
+        port = parsed.port or (443 if secure else 80)
+        sock = socket.create_connection((parsed.hostname, port), timeout=timeout)
+        if secure:
+            sock = ssl.create_default_context().wrap_socket(sock, server_hostname=parsed.hostname)
+
+        key = base64.b64encode(os.urandom(16)).decode('ascii')
+        path = parsed.path or '/'
+        if parsed.query:
+            path += '?' + parsed.query
+        sock.sendall((
+            f'GET {path} HTTP/1.1\r\n'
+            + f'Host: {parsed.netloc}\r\n'
+            + 'Upgrade: websocket\r\n'
+            + 'Connection: Upgrade\r\n'
+            + f'Sec-WebSocket-Key: {key}\r\n'
+            + 'Sec-WebSocket-Version: 13\r\n'
+            + '\r\n'
+        ).encode('ascii'))
+
+        status_line, headers, buffer = _read_http_header(sock)
+        if status_line.split(' ')[1:2] != ['101']:
+            sock.close()
+            raise ConnectionError(f'WebSocketに接続できませんでした。({status_line})')
+        if headers.get('sec-websocket-accept') != _accept_key(key):
+            sock.close()
+            raise ConnectionError('Sec-WebSocket-Acceptが一致しません。')
+        return cls(sock, mask=True, buffer=buffer)
+
+    @classmethod
+    def accept(cls, sock):
+        """サーバー側のハンドシェイク"""
+        _, headers, buffer = _read_http_header(sock)
+        sock.sendall((
+            'HTTP/1.1 101 Switching Protocols\r\n'
+            + 'Upgrade: websocket\r\n'
+            + 'Connection: Upgrade\r\n'
+            + f'Sec-WebSocket-Accept: {_accept_key(headers["sec-websocket-key"])}\r\n'
+            + '\r\n'
+        ).encode('ascii'))
+        return cls(sock, mask=False, buffer=buffer)
+
+    def settimeout(self, timeout):
+        self.sock.settimeout(timeout)
+
+    def _fill(self, n):
+        """_bufferがnバイト以上になるまで受信する(socket.timeoutの場合も受信済みのデータは残る)"""
+        while len(self._buffer) < n:
+            chunk = self.sock.recv(max(n - len(self._buffer), 4096))
+            if not chunk:
+                raise ConnectionClosed('接続が切断されました。')
+            self._buffer += chunk
+
+    def _send_frame(self, opcode, payload):
+        header = bytearray([0x80 | opcode])
+        mask_bit = 0x80 if self.mask else 0
+        n = len(payload)
+        if n < 126:
+            header.append(mask_bit | n)
+        elif n < 65536:
+            header.append(mask_bit | 126)
+            header += struct.pack('!H', n)
+        else:
+            header.append(mask_bit | 127)
+            header += struct.pack('!Q', n)
+        if self.mask:
+            mask_key = os.urandom(4)
+            header += mask_key
+            payload = _apply_mask(payload, mask_key)
+        with self._send_lock:
+            self.sock.sendall(bytes(header) + payload)
+
+    def _recv_frame(self):
+        # フレームの途中でsocket.timeoutになっても続きから読めるよう、全体が揃うまで_bufferから取り出さない
+        self._fill(2)
+        first, second = self._buffer[0], self._buffer[1]
+        fin = bool(first & 0x80)
+        opcode = first & 0x0F
+        n = second & 0x7F
+        offset = 2
+        if n == 126:
+            self._fill(4)
+            n = struct.unpack_from('!H', self._buffer, 2)[0]
+            offset = 4
+        elif n == 127:
+            self._fill(10)
+            n = struct.unpack_from('!Q', self._buffer, 2)[0]
+            offset = 10
+        mask_key = None
+        if second & 0x80:
+            self._fill(offset + 4)
+            mask_key = self._buffer[offset:offset + 4]
+            offset += 4
+        self._fill(offset + n)
+        payload, self._buffer = self._buffer[offset:offset + n], self._buffer[offset + n:]
+        if mask_key is not None:
+            payload = _apply_mask(payload, mask_key)
+        return fin, opcode, payload
+
+    def send(self, text):
+        self._send_frame(OPCODE_TEXT, text.encode('utf-8'))
+
+    def recv(self):
+        """テキストメッセージを1件受信する(ping, 分割されたフレームはここで処理する)"""
+        while True:
+            fin, opcode, payload = self._recv_frame()
+            if opcode == OPCODE_PING:
+                self._send_frame(OPCODE_PONG, payload)
+                continue
+            if opcode == OPCODE_PONG:
+                continue
+            if opcode == OPCODE_CLOSE:
+                try:
+                    self._send_frame(OPCODE_CLOSE, payload[:2])
+                except OSError:
+                    pass
+                raise ConnectionClosed('接続が切断されました。')
+            if opcode in (OPCODE_TEXT, OPCODE_BINARY, OPCODE_CONTINUATION):
+                self._fragments.append(payload)
+                if fin:
+                    message, self._fragments = b''.join(self._fragments), []
+                    return message.decode('utf-8')
+
+    def close(self):
+        try:
+            self._send_frame(OPCODE_CLOSE, struct.pack('!H', 1000))
+        except OSError:
+            pass
+        self.sock.close()
+
+
+def _read_http_header(sock):
+    buffer = b''
+    while b'\r\n\r\n' not in buffer:
+        chunk = sock.recv(4096)
+        if not chunk:
+            raise ConnectionClosed('ハンドシェイク中に接続が切断されました。')
+        buffer += chunk
+    header, buffer = buffer.split(b'\r\n\r\n', 1)
+    lines = header.decode('latin-1').split('\r\n')
+    headers = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+    return lines[0], headers, buffer
+
+
+class OrderEventSubscriber:
+    """bitFlyerのRealtime API(プライベートチャンネル)で注文イベントを受け取り、約定をすぐに反映する
+
+    EXECUTION, CANCEL, EXPIREを受け取ると、その注文をREST APIで取得し直して注文履歴を更新する。
+    short_termの買い注文が約定した場合は、次の定期実行を待たずにAI.sell_filledで売り注文を出す。
+
+    Realtime APIのイベントには連番がないため、取りこぼしは検知できない。
+    接続(再接続)のたびと、receive_timeoutの間イベントがない場合に、
+    全ての未約定の注文をREST APIで確認し直す(reconcile)ことで取りこぼしを補う。
+
+    注文履歴・残高の台帳は定期実行(lambda_function.trading)も更新するため、
+    AIの作成(読み込み)から確定までの間はリース(lease.StorageLease)を保持する。
+    取得できなかったイベントは反映せず、次のメッセージを受け取った時点でreconcileして補う。
+    集計データはイベントごとには作らず、summary_ttl秒の間は使い回す。
+
+    Args:
+        product_code (str): プロダクト
+        ai_factory (callable): 集計データを引数にAIを作成する関数(イベントごとに呼び出す)
+        summary_factory (callable): 集計データを作成する関数(引数なし)
+        url (str, optional): Realtime APIのurl
+        api_key (str, optional): 省略した場合は環境変数から読み込む
+        api_secret (str, optional): 省略した場合は環境変数から読み込む
+        receive_timeout (float, optional): イベントがない場合にreconcileする間隔(秒)
+        reconnect_delays (list, optional): 再接続までの待ち時間(秒)。失敗が続くほど長くする
+        summary_ttl (float, optional): 集計データを使い回す秒数
+        lease_timeout (float, optional): リースを取得できるまで待つ秒数
+    """
+
+    def __init__(self,
+                 product_code,
+                 ai_factory,
+                 summary_factory,
+                 url=REALTIME_URL,
+                 api_key=None,
+                 api_secret=None,
+                 receive_timeout=60,
+                 reconnect_delays=(1, 2, 5, 10, 30),
+                 summary_ttl=300,
+                 lease_timeout=10):
+        self.product_code = product_code
+        self.ai_factory = ai_factory
+        self.summary_factory = summary_factory
+        self.url = url
+        if api_key is None or api_secret is None:
+            api_key, api_secret = credentials()
+        self.api_key = api_key
+        self.api_secret = api_secret
+        self.receive_timeout = receive_timeout
+        self.reconnect_delays = reconnect_delays
+        self.summary_ttl = summary_ttl
+        self.lease_timeout = lease_timeout
+        self._request_id = 0
+        self._pending_messages = []
+        self._latest_summary = None
+        self._summary_created_at = None
+        # リースを取得できずに反映しなかったイベントがある(次のメッセージの受信時にreconcileする)
+        self._reconcile_pending = False
+
+    def _rpc(self, ws, method, params):
+        """JSON-RPCのリクエストを送り、応答を待つ(その間に届いたイベントは後で処理する)"""
+        self._request_id += 1
+        request_id = self._request_id
+        ws.send(json.dumps({'jsonrpc': '2.0', 'method': method, 'params': params, 'id': request_id}))
+        while True:
+            message = json.loads(ws.recv())
+            if message.get('id') == request_id:
+                if 'error' in message:
+                    raise ConnectionError(f'{method}に失敗しました。({message["error"]})')
+                return message.get('result')
+            self._pending_messages.append(message)
+
+    def _auth(self, ws):
+        timestamp = int(time.time() * 1000)
+        nonce = os.urandom(16).hex()
+        signature = hmac.new(
+            self.api_secret.encode('utf-8'),
+            f'{timestamp}{nonce}'.encode('utf-8'),
+            hashlib.sha256
+        ).hexdigest()
+        result = self._rpc(ws, 'auth', {
+            'api_key': self.api_key,
+            'timestamp': timestamp,
+            'nonce': nonce,
+            'signature': signature,
+        })
+        if not result:
+            raise ConnectionError('認証に失敗しました。')
+
+    def connect(self):
+        ws = WebSocket.connect(self.url)
+        try:
+            self._auth(ws)
+            self._rpc(ws, 'subscribe', {'channel': CHILD_ORDER_CHANNEL})
+        except Exception:
+            ws.close()
+            raise
+        logger.info(f'[{self.product_code}] {CHILD_ORDER_CHANNEL}を購読しました。')
+        return ws
+
+    def latest_summary(self):
+        """summary_ttl秒以内に作成した集計データを使い回す"""
+        if self._latest_summary is None or time.time() - self._summary_created_at > self.summary_ttl:
+            self._latest_summary = self.summary_factory()
+            self._summary_created_at = time.time()
+        return self._latest_summary
+
+    def _with_ai(self, action):
+        """リースを保持している間にAIを作成してactionを実行し、変更を確定する
+
+        Returns:
+            tuple: (リースを取得できたかどうか, actionの戻り値)
+        """
+        lease = StorageLease(ORDERS_LEASE_NAME, ttl=120)
+        if not lease.acquire(timeout=self.lease_timeout):
+            return False, None
+        ai = None
+        try:
+            ai = self.ai_factory(self.latest_summary())
+            result = action(ai)
+            ai.commit()
+            return True, result
+        finally:
+            if ai is not None:
+                ai.close()
+            lease.release()
+            if ai is not None:
+                # 待たずに送信する(常駐するため、送信はバックグラウンドで完了する)
+                ai.line_notify.flush(timeout=0)
+
+    def reconcile(self):
+        """全ての未約定の注文をREST APIで確認し、約定済みのshort_termの買い注文に売り注文を出す"""
+        def action(ai):
+            for term in TERMS:
+                ai.update_child_orders(term=term)
+            cycles = {
+                record.child_order_cycle
+                for record in ai.ledgers['short'].select(side='BUY', state='COMPLETED', related='no_id')
+            }
+            for child_order_cycle in sorted(cycles):
+                ai.sell_filled(child_order_cycle)
+
+        acquired, _ = self._with_ai(action)
+        self._reconcile_pending = not acquired
+        if not acquired:
+            logger.info(f'[{self.product_code}] 注文履歴を更新中のプロセスがあるため、次回確認し直します。')
+
+    def handle_events(self, events):
+        """child_order_eventsの1メッセージ分のイベントを反映する
+
+        Returns:
+            int: 更新した注文の数
+        """
+        child_order_acceptance_ids = []
+        for event in events:
+            if event.get('product_code') != self.product_code:
+                continue
+            if event.get('event_type') not in REFRESH_EVENT_TYPES:
+                continue
+            if event['child_order_acceptance_id'] not in child_order_acceptance_ids:
+                child_order_acceptance_ids.append(event['child_order_acceptance_id'])
+        if len(child_order_acceptance_ids) == 0:
+            return 0
+
+        def action(ai):
+            updated_count = 0
+            sell_cycles = []
+            for child_order_acceptance_id in child_order_acceptance_ids:
+                for term in TERMS:
+                    record = ai.ledgers[term].get(child_order_acceptance_id)
+                    if record is None:
+                        continue
+                    ai.load_latest_child_orders(
+                        term=term,
+                        child_order_cycle=record.child_order_cycle,
+                        child_order_acceptance_id=child_order_acceptance_id,
+                        related_child_order_acceptance_id=record.related_child_order_acceptance_id
+                    )
+                    updated_count += 1
+                    record = ai.ledgers[term].get(child_order_acceptance_id)
+                    if term == 'short' \
+                            and record is not None \
+                            and record.side == 'BUY' \
+                            and record.child_order_state == 'COMPLETED' \
+                            and record.related_child_order_acceptance_id == 'no_id' \
+                            and record.child_order_cycle not in sell_cycles:
+                        sell_cycles.append(record.child_order_cycle)
+                    break
+            for child_order_cycle in sell_cycles:
+                ai.sell_filled(child_order_cycle)
+            return updated_count
+
+        acquired, updated_count = self._with_ai(action)
+        if not acquired:
+            self._reconcile_pending = True
+            logger.info(
+                f'[{self.product_code}] 注文履歴を更新中のプロセスがあるため、'
+                + f'{len(child_order_acceptance_ids)}件のイベントは次のreconcileで反映します。')
+            return 0
+        return updated_count
+
+    def _dispatch(self, message):
+        if message.get('method') != 'channelMessage':
+            return
+        params = message.get('params', {})
+        if params.get('channel') != CHILD_ORDER_CHANNEL:
+            return
+        start_time = time.time()
+        updated_count = self.handle_events(params.get('message', []))
+        if updated_count > 0:
+            logger.info(
+                f'[{self.product_code}] {updated_count}件の注文を更新しました。({time.time() - start_time:.3f}s)')
+
+    def _safe_reconcile(self):
+        try:
+            self.reconcile()
+        except Exception:
+            logger.exception(f'[{self.product_code}] 注文の確認に失敗しました。')
+
+    def run(self, stop_event=None):
+        """stop_eventがセットされるまで、イベントを受け取り続ける(切断された場合は再接続する)"""
+        stop_event = stop_event or threading.Event()
+        failure_count = 0
+        while not stop_event.is_set():
+            ws = None
+            try:
+                self._pending_messages = []
+                ws = self.connect()
+                # 接続していなかった間のイベントを補う
+                self._safe_reconcile()
+                failure_count = 0
+                ws.settimeout(self.receive_timeout)
+                while not stop_event.is_set():
+                    while len(self._pending_messages) > 0:
+                        message = self._pending_messages.pop(0)
+                        try:
+                            self._dispatch(message)
+                        except Exception:
+                            # 1件の反映に失敗しても購読は続け、次のreconcileで補う
+                            logger.exception(f'[{self.product_code}] イベントの反映に失敗しました。')
+                    try:
+                        self._pending_messages.append(json.loads(ws.recv()))
+                        if self._reconcile_pending:
+                            # 反映しなかったイベントを、このメッセージの前に補う
+                            self._safe_reconcile()
+                    except socket.timeout:
+                        logger.info(f'[{self.product_code}] {self.receive_timeout}秒間イベントがないため、注文を確認し直します。')
+                        self._safe_reconcile()
+            except (OSError, ValueError) as e:
+                delay = self.reconnect_delays[min(failure_count, len(self.reconnect_delays) - 1)]
+                failure_count += 1
+                logger.warning(f'[{self.product_code}] 接続が切断されました。{delay}秒後に再接続します。({e!r})')
+                stop_event.wait(delay)
+            finally:
+                if ws is not None:
+                    ws.close()
+
+
+def make_order_event(product_code, child_order_acceptance_id, event_type, side='BUY', price=0, size=0, **kwargs):
+    """child_order_eventsと同じ形式のイベント(LocalOrderEventServerで送るイベントの作成用)"""
+    event = {
+        'product_code': product_code,
+        'child_order_id': kwargs.pop('child_order_id', child_order_acceptance_id.replace('JRF', 'JOR')),
+        'child_order_acceptance_id': child_order_acceptance_id,
+        'event_date': kwargs.pop('event_date', time.strftime('%Y-%m-%dT%H:%M:%S.0000000Z', time.gmtime())),
+        'event_type': event_type,
+    }
+    if event_type == 'ORDER':
+        event.update({'child_order_type': 'LIMIT', 'side': side, 'price': price, 'size': size})
+    elif event_type == 'EXECUTION':
+        event.update({'exec_id': 0, 'side': side, 'price': price, 'size': size, 'commission': 0, 'sfd': 0})
+    event.update(kwargs)
+    return event
+
+
+class LocalOrderEventServer:
+    """Realtime APIの代わりに、注文イベントを送るローカルのWebSocketサーバー(動作確認用)
+
+    authとsubscribeには常に成功し、emitしたイベントを購読中の全ての接続に送る。
+    drop_connectionsで接続を切断すると、OrderEventSubscriberの再接続とreconcileを確認できる。
+
+    使い方:
+        server = LocalOrderEventServer().start()
+        subscriber = OrderEventSubscriber(..., url=server.url, api_key='key', api_secret='secret')
+        ...
+        server.emit([make_order_event('BTC_JPY', 'JRF...', 'EXECUTION', ...)])
+        server.stop()
+    """
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self._clients = []
+        self._lock = threading.Lock()
+        self._subscribed = threading.Condition(self._lock)
+        self.auth_requests = []
+        server = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                server._serve(self.request)
+
+        self._server = socketserver.ThreadingTCPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return f'ws://{host}:{port}/json-rpc'
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.drop_connections()
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _serve(self, sock):
+        ws = WebSocket.accept(sock)
+        authenticated = False
+        try:
+            while True:
+                request = json.loads(ws.recv())
+                response = {'jsonrpc': '2.0', 'id': request.get('id')}
+                if request.get('method') == 'auth':
+                    self.auth_requests.append(request['params'])
+                    authenticated = True
+                    response['result'] = True
+                elif request.get('method') == 'subscribe':
+                    if not authenticated:
+                        response['error'] = {'code': -32000, 'message': 'Unauthorized'}
+                    else:
+                        response['result'] = True
+                else:
+                    response['error'] = {'code': -32601, 'message': 'Method not found'}
+                ws.send(json.dumps(response))
+                if 'result' in response and request.get('method') == 'subscribe':
+                    with self._subscribed:
+                        self._clients.append(ws)
+                        self._subscribed.notify_all()
+        except (OSError, ValueError):
+            pass
+        finally:
+            with self._lock:
+                if ws in self._clients:
+                    self._clients.remove(ws)
+            sock.close()
+
+    def wait_subscribed(self, count=1, timeout=10):
+        """count件の接続が購読するまで待つ"""
+        with self._subscribed:
+            return self._subscribed.wait_for(lambda: len(self._clients) >= count, timeout=timeout)
+
+    def emit(self, events, channel=CHILD_ORDER_CHANNEL):
+        message = json.dumps({
+            'jsonrpc': '2.0',
+            'method': 'channelMessage',
+            'params': {'channel': channel, 'message': events},
+        })
+        with self._lock:
+            clients = list(self._clients)
+        for ws in clients:
+            ws.send(message)
+        return len(clients)
+
+    def drop_connections(self):
+        with self._lock:
+            clients, self._clients = self._clients, []
+        for ws in clients:
+            try:
+                ws.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+if __name__ == '__main__':
+    import lambda_function
+    from preprocess import obtain_latest_summary
+
+    parser = argparse.ArgumentParser(description='注文イベントを受け取り、約定をすぐに反映する')
+    parser.add_argument('product_code')
+    parser.add_argument('--url', default=REALTIME_URL)
+    parser.add_argument('--receive-timeout', type=float, default=60)
+    args = parser.parse_args()
+
+    OrderEventSubscriber(
+        args.product_code,
+        lambda latest_summary: lambda_function.create_ai(args.product_code, latest_summary),
+        lambda: obtain_latest_summary(args.product_code),
+        url=args.url,
+        receive_timeout=args.receive_timeout,
+    ).run()
@@ -0,0 +1,112 @@
+import numpy as np
+import pandas as pd
+
+# row/all.csvの列順(exec_dateはindex)
+EXECUTION_COLUMNS = [
+    'id',
+    'side',
+    'price',
+    'size',
+    'buy_child_order_acceptance_id',
+    'sell_child_order_acceptance_id',
+]
+
+# 約定履歴のうち、注文IDの列(文字列のため1行あたりのメモリ使用量が大きい)
+ORDER_ID_COLUMNS = [
+    'buy_child_order_acceptance_id',
+    'sell_child_order_acceptance_id',
+]
+
+# itayose中の約定はsideが空文字になる
+SIDE_DTYPE = pd.CategoricalDtype(categories=['BUY', 'SELL', ''])
+
+BAR_PRICE_COLUMNS = ['open_price', 'high_price', 'low_price', 'close_price']
+
+
+def _narrow_float(values):
+    """float32で正確に表現できる場合のみfloat32に変換する
+
+    float32の仮数部は24bitのため、約1677万円を超える価格などは
+    丸められてしまう。その場合はfloat64のままにする。
+    """
+    values = np.asarray(values, dtype='float64')
+    values_32 = values.astype('float32')
+    if np.array_equal(values_32.astype('float64'), values, equal_nan=True):
+        return values_32
+    return values
+
+
+def to_utc_index(df, column=None):
+    """indexをUTCのDatetimeIndex(内部表現はint64のepoch ns)にする
+
+    Args:
+        df (pd.DataFrame): 対象のデータ
+        column (str, optional): 指定した場合、その列をindexにする
+    """
+    if column is not None:
+        df = df.set_index(column)
+    index = df.index
+    if not isinstance(index, pd.DatetimeIndex):
+        index = pd.to_datetime(index, utc=True)
+    elif index.tz is None:
+        index = index.tz_localize('UTC')
+    else:
+        index = index.tz_convert('UTC')
+    df.index = index
+    return df
+
+
+def compact_executions(df, drop_order_ids=False):
+    """約定履歴を省メモリな型に変換する
+
+    - index: UTCのDatetimeIndex
+    - id: int64
+    - side: category
+    - price: float32で正確に表現できる場合はfloat32
+    - size: float64(合計値の精度を保つため)
+
+    Args:
+        df (pd.DataFrame): 約定履歴
+        drop_order_ids (bool, optional): Trueの場合、注文IDの列を削除する
+    """
+    if df.empty:
+        return df
+
+    df = to_utc_index(df)
+    if drop_order_ids:
+        df = df.drop(columns=[col for col in ORDER_ID_COLUMNS if col in df.columns])
+
+    if 'id' in df.columns:
+        df['id'] = df['id'].astype('int64')
+    if 'side' in df.columns:
+        df['side'] = df['side'].fillna('').astype(SIDE_DTYPE)
+    if 'price' in df.columns:
+        df['price'] = _narrow_float(df['price'].values)
+    if 'size' in df.columns:
+        df['size'] = df['size'].astype('float64')
+    return df
+
+
+def compact_bars(df):
+    """リサンプリング済みのデータ(OHLCV)を省メモリな型に変換する"""
+    if df.empty:
+        return df
+
+    df = to_utc_index(df)
+    for col_name in BAR_PRICE_COLUMNS:
+        if col_name in df.columns:
+            df[col_name] = _narrow_float(df[col_name].values)
+    if 'total_size' in df.columns:
+        df['total_size'] = df['total_size'].astype('float64')
+    return df
+
+
+def to_region(df, region='Asia/Tokyo'):
+    """表示・保存用にindexのタイムゾーンを変換する
+
+    DatetimeIndexのタイムゾーン変換はデータをコピーしないため、
+    保存やログ出力の直前にのみ呼び出す。
+    """
+    if df.empty:
+        return df
+    return df.tz_convert(region)
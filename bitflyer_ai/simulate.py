@@ -0,0 +1,136 @@
+import argparse
+import datetime
+from logging import getLogger
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import clock
+import lambda_function
+from backtest import (MINUTE_NS, BacktestSummary, SimulatedExchange,
+                      load_series, override_environ)
+from balance import balance_ledger_path
+from manage import CHILD_ORDERS_DIR, PROFIT_DIR, VOLUME_DIR
+from order_store import order_store_delta_dir, order_store_path
+from utils import path_exists, read_csv, rm_dir, storage_overlay
+
+logger = getLogger(__name__)
+
+PROFIT_FILENAMES = ['daily_profit.csv', 'monthly_profit.csv', 'yearly_profit.csv']
+VOLUME_FILENAMES = ['daily_volume.csv', 'monthly_volume.csv', 'yearly_volume.csv']
+
+
+def run_schedule(product_code, start, end,
+                 interval=datetime.timedelta(hours=1),
+                 initial_jpy=1000000,
+                 initial_coin=0.0,
+                 commission_rate=0.0015,
+                 warmup_days=400,
+                 event=None,
+                 env=None):
+    """lambda_handlerを、シミュレーションの時刻で定期実行した場合と同じ順に呼び出す
+
+    時刻はclock.SimulatedClock、取引所はbacktest.SimulatedExchange、集計データは
+    保存済みの1分足から作るbacktest.BacktestSummary、書き込みはutils.storage_overlayに
+    置き換えるため、実際の時間・注文・ストレージや約定履歴のAPIは使わない。
+    呼び出しの間の1分足で注文の約定を判定する。
+    月・年をまたぐ期間を指定すると、利益・取引量のファイルの切り替わりも確認できる。
+
+    Args:
+        product_code (str): プロダクト(lambda_handlerの対象に含まれていること)
+        start (datetime.datetime): 最初の呼び出し時刻(タイムゾーン付き)
+        end (datetime.datetime): この時刻より前まで呼び出す
+        interval (datetime.timedelta, optional): 呼び出し間隔
+        initial_jpy (float, optional): 初期のJPY残高
+        initial_coin (float, optional): 初期の暗号資産残高
+        commission_rate (float, optional): 取引手数料率
+        warmup_days (int, optional): 開始時刻より前に読み込む日数。1y, allの集計に使う
+        event (dict, optional): lambda_handlerに渡すevent
+        env (dict, optional): 実行中に設定する環境変数
+
+    Returns:
+        dict: ファイル名 -> 実行後の利益・取引量(daily_profit.csvなど)のDataFrame
+    """
+    series = load_series(product_code, start, end, warmup_days=warmup_days)
+    times = series['BUY'].times
+    lows = np.fmin(series['BUY'].lows, series['SELL'].lows)
+    highs = np.fmax(series['BUY'].highs, series['SELL'].highs)
+
+    def obtain_simulated_summary(product_code):
+        # 呼び出し時刻より前に確定した1分足のみで集計する(約定履歴のAPIを呼び出さない)
+        current_datetime = clock.now()
+        i_now = int(np.searchsorted(times, pd.Timestamp(current_datetime).value - MINUTE_NS, side='right'))
+        return BacktestSummary(series, i_now, current_datetime)
+
+    exchange = SimulatedExchange(product_code, initial_jpy, initial_coin, commission_rate)
+    simulated_clock = clock.SimulatedClock(start)
+    previous_exchange = lambda_function.exchange
+    previous_obtain_latest_summary = lambda_function.obtain_latest_summary
+    lambda_function.exchange = exchange
+    lambda_function.obtain_latest_summary = obtain_simulated_summary
+
+    results = {}
+    invocation_count = 0
+    i_matched = int(np.searchsorted(times, pd.Timestamp(start).value, side='left'))
+    try:
+        with storage_overlay() as overlay, clock.use_clock(simulated_clock), override_environ(env or {}):
+            # 本番の注文履歴・利益・取引量を読み込まないよう、空の状態から始める
+            for filename in ['long_term.csv', 'short_term.csv', 'dca.csv']:
+                overlay.delete(Path(CHILD_ORDERS_DIR).joinpath(product_code, filename))
+            overlay.delete(order_store_path(product_code))
+            rm_dir(order_store_delta_dir(product_code))
+            overlay.delete(balance_ledger_path())
+            for filename in PROFIT_FILENAMES:
+                overlay.delete(Path(PROFIT_DIR).joinpath(filename))
+            for filename in VOLUME_FILENAMES:
+                overlay.delete(Path(VOLUME_DIR).joinpath(filename))
+
+            invocation_datetime = start
+            while invocation_datetime < end:
+                simulated_clock.set(invocation_datetime)
+                # 呼び出し時刻より前に確定した1分足で約定を判定する
+                i_now = int(np.searchsorted(times, pd.Timestamp(invocation_datetime).value - MINUTE_NS, side='right'))
+                exchange.match(times, lows, highs, i_matched, i_now)
+                i_matched = max(i_matched, i_now)
+                exchange.current_datetime = clock.now()
+
+                lambda_function.lambda_handler(event or {}, None)
+                invocation_count += 1
+                invocation_datetime += interval
+
+            for filename in PROFIT_FILENAMES:
+                p_path = Path(PROFIT_DIR).joinpath(filename)
+                if path_exists(p_path):
+                    results[filename] = read_csv(str(p_path)).set_index('date')
+            for filename in VOLUME_FILENAMES:
+                p_path = Path(VOLUME_DIR).joinpath(filename)
+                if path_exists(p_path):
+                    results[filename] = read_csv(str(p_path)).set_index('date')
+    finally:
+        lambda_function.exchange = previous_exchange
+        lambda_function.obtain_latest_summary = previous_obtain_latest_summary
+
+    logger.info(
+        f'[{product_code} {start} - {end}] {invocation_count}回の呼び出しが完了しました。'
+        + f'({len(exchange.orders)}注文 残高: {exchange.balances})')
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='lambda_handlerをシミュレーションの時刻で定期実行する')
+    parser.add_argument('product_code')
+    parser.add_argument('start', help='YYYY-MM-DD (Asia/Tokyo)')
+    parser.add_argument('end', help='YYYY-MM-DD (Asia/Tokyo)')
+    parser.add_argument('--interval-minutes', type=int, default=60)
+    args = parser.parse_args()
+
+    results = run_schedule(
+        args.product_code,
+        datetime.datetime.fromisoformat(args.start).replace(tzinfo=clock.JST),
+        datetime.datetime.fromisoformat(args.end).replace(tzinfo=clock.JST),
+        interval=datetime.timedelta(minutes=args.interval_minutes),
+    )
+    for filename, df in results.items():
+        print(filename)
+        print(df)
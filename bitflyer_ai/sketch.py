@@ -0,0 +1,230 @@
+import datetime
+import math
+from logging import getLogger
+from pathlib import Path
+
+import numpy as np
+
+from manage import (EXECUTION_HISTORY_DIR, SKETCH_FILENAME,
+                    SKETCH_RELATIVE_ACCURACY)
+from utils import path_exists, read_json, write_json
+
+logger = getLogger(__name__)
+
+
+class QuantileSketch:
+    """相対誤差を保証する対数バケットの分位点スケッチ(DDSketch方式)
+
+    値xを ceil(log_gamma(x)) のバケットに数え上げるため、
+    分位点の推定値は真の値に対して相対誤差relative_accuracy以内に収まる。
+    バケットごとの重みを足し合わせるだけで結合できるため、
+    日毎のスケッチから任意の期間のスケッチを作成できる。
+    """
+
+    def __init__(self, relative_accuracy=SKETCH_RELATIVE_ACCURACY, bins=None,
+                 count=0.0, min_value=None, max_value=None):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.bins = dict(bins or {})
+        self.count = count
+        self.min_value = min_value
+        self.max_value = max_value
+
+    def __len__(self):
+        return len(self.bins)
+
+    @property
+    def empty(self):
+        return self.count <= 0
+
+    def add(self, values, weights=None):
+        """値(価格など正の値のみ)を追加する
+
+        Args:
+            values (array-like): 追加する値
+            weights (array-like, optional): 各値の重み。省略した場合は1
+        """
+        values = np.asarray(values, dtype='float64')
+        if weights is None:
+            weights = np.ones(len(values))
+        else:
+            weights = np.asarray(weights, dtype='float64')
+        valid = (values > 0) & (weights > 0)
+        values = values[valid]
+        weights = weights[valid]
+        if len(values) == 0:
+            return self
+
+        keys = np.ceil(np.log(values) / self.log_gamma).astype('int64')
+        unique_keys, inverse = np.unique(keys, return_inverse=True)
+        key_weights = np.bincount(inverse, weights=weights)
+        for key, weight in zip(unique_keys.tolist(), key_weights.tolist()):
+            self.bins[key] = self.bins.get(key, 0.0) + weight
+
+        self.count += float(weights.sum())
+        min_value = float(values.min())
+        max_value = float(values.max())
+        self.min_value = min_value if self.min_value is None else min(self.min_value, min_value)
+        self.max_value = max_value if self.max_value is None else max(self.max_value, max_value)
+        return self
+
+    def merge(self, other):
+        if other.empty:
+            return self
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError(
+                f'相対誤差の異なるスケッチは結合できません。({self.relative_accuracy} != {other.relative_accuracy})')
+        for key, weight in other.bins.items():
+            self.bins[key] = self.bins.get(key, 0.0) + weight
+        self.count += other.count
+        self.min_value = other.min_value if self.min_value is None else min(self.min_value, other.min_value)
+        self.max_value = other.max_value if self.max_value is None else max(self.max_value, other.max_value)
+        return self
+
+    def quantile(self, q):
+        """q分位点(0 <= q <= 1)の推定値を返す。データがない場合はNoneを返す"""
+        return self.quantiles([q])[0]
+
+    def quantiles(self, qs):
+        if self.empty:
+            return [None for _ in qs]
+        keys = np.array(sorted(self.bins.keys()), dtype='int64')
+        cumulative_weights = np.cumsum([self.bins[key] for key in keys.tolist()])
+        results = []
+        for q in qs:
+            if not 0 <= q <= 1:
+                raise ValueError(f'分位点は0以上1以下で指定してください。({q})')
+            if q == 0:
+                results.append(self.min_value)
+                continue
+            if q == 1:
+                results.append(self.max_value)
+                continue
+            i = int(np.searchsorted(cumulative_weights, q * self.count, side='left'))
+            i = min(i, len(keys) - 1)
+            # バケット(gamma^(k-1), gamma^k]の代表値
+            value = 2 * self.gamma ** int(keys[i]) / (self.gamma + 1)
+            results.append(min(max(value, self.min_value), self.max_value))
+        return results
+
+    def to_dict(self):
+        return {
+            'relative_accuracy': self.relative_accuracy,
+            'bins': {str(key): weight for key, weight in sorted(self.bins.items())},
+            'count': self.count,
+            'min_value': self.min_value,
+            'max_value': self.max_value,
+        }
+
+    @classmethod
+    def from_dict(cls, obj):
+        return cls(
+            relative_accuracy=obj['relative_accuracy'],
+            bins={int(key): weight for key, weight in obj['bins'].items()},
+            count=obj['count'],
+            min_value=obj['min_value'],
+            max_value=obj['max_value'],
+        )
+
+
+def sketch_path(p_dir):
+    """日・月・年・全期間のディレクトリに対応するスケッチのパス"""
+    return Path(p_dir).joinpath(SKETCH_FILENAME)
+
+
+def read_sketches(p_path):
+    """売買の種類ごとのスケッチを読み込む。存在しない場合はNoneを返す"""
+    if not path_exists(p_path):
+        return None
+    obj = read_json(p_path)
+    return {side: QuantileSketch.from_dict(obj[side]) for side in ['BUY', 'SELL']}
+
+
+def write_sketches(p_path, sketches):
+    write_json(p_path, {side: sketches[side].to_dict() for side in ['BUY', 'SELL']})
+
+
+def make_day_sketches(p_day_dir, df_buy, df_sell):
+    """1分足の終値を出来高で重み付けし、1日分のスケッチを作成・保存する"""
+    sketches = {}
+    for side, df_bars in [('BUY', df_buy), ('SELL', df_sell)]:
+        sketches[side] = QuantileSketch().add(
+            df_bars['close_price'].values, df_bars['total_size'].values)
+    write_sketches(sketch_path(p_day_dir), sketches)
+    return sketches
+
+
+def merge_sketch_files(p_dir, p_child_dir_list):
+    """子ディレクトリ(日・月・年)のスケッチを全て結合して親のスケッチを作成・保存する
+
+    スケッチは加算はできても減算はできないため、更新のたびに全ての子から作り直す。
+    子は高々31個のため、読み込むファイル数は少ない。
+    """
+    sketches = {side: QuantileSketch() for side in ['BUY', 'SELL']}
+    for p_child_dir in p_child_dir_list:
+        child_sketches = read_sketches(sketch_path(p_child_dir))
+        if child_sketches is None:
+            continue
+        for side in ['BUY', 'SELL']:
+            sketches[side].merge(child_sketches[side])
+    if sketches['BUY'].empty and sketches['SELL'].empty:
+        return None
+    write_sketches(sketch_path(p_dir), sketches)
+    return sketches
+
+
+def _is_month_end(target_date):
+    return (target_date + datetime.timedelta(days=1)).day == 1
+
+
+def window_sketch_paths(product_code, start_date, end_date):
+    """start_dateからend_dateまで(両端を含む)を覆う最小限のスケッチのパス
+
+    期間に完全に含まれる年・月はまとめたスケッチを使い、端数の日のみ日毎のスケッチを使う。
+    1年間の期間でも読み込むファイルは高々70個程度になる。
+    """
+    p_product_dir = Path(EXECUTION_HISTORY_DIR).joinpath(product_code)
+    p_path_list = []
+    target_date = start_date
+    while target_date <= end_date:
+        year_end = datetime.date(target_date.year, 12, 31)
+        if target_date.month == 1 and target_date.day == 1 and year_end <= end_date:
+            p_path_list.append(sketch_path(p_product_dir.joinpath(target_date.strftime('%Y'))))
+            target_date = year_end + datetime.timedelta(days=1)
+            continue
+
+        if target_date.day == 1:
+            month_end = target_date
+            while not _is_month_end(month_end):
+                month_end += datetime.timedelta(days=1)
+            if month_end <= end_date:
+                p_path_list.append(sketch_path(p_product_dir.joinpath(
+                    target_date.strftime('%Y'), target_date.strftime('%m'))))
+                target_date = month_end + datetime.timedelta(days=1)
+                continue
+
+        p_path_list.append(sketch_path(p_product_dir.joinpath(
+            target_date.strftime('%Y'), target_date.strftime('%m'), target_date.strftime('%d'))))
+        target_date += datetime.timedelta(days=1)
+    return p_path_list
+
+
+def load_window_sketch(product_code, side, start_date, end_date):
+    """任意の期間のスケッチを、年・月・日のスケッチを結合して作成する"""
+    sketch = QuantileSketch()
+    for p_path in window_sketch_paths(product_code, start_date, end_date):
+        sketches = read_sketches(p_path)
+        if sketches is None:
+            continue
+        sketch.merge(sketches[side])
+    logger.debug(f'[{product_code} {side} {start_date} - {end_date}] 分位点スケッチ作成完了')
+    return sketch
+
+
+def load_all_sketch(product_code, side):
+    """全期間のスケッチを返す"""
+    sketches = read_sketches(sketch_path(Path(EXECUTION_HISTORY_DIR).joinpath(product_code)))
+    if sketches is None:
+        return QuantileSketch()
+    return sketches[side]
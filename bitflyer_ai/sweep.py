@@ -0,0 +1,294 @@
+import argparse
+import csv
+import datetime
+import hashlib
+import itertools
+import json
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from logging import getLogger
+from multiprocessing import shared_memory
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from backtest import DEFAULT_MIN_SIZE, Backtest, BarSeries, load_series
+
+logger = getLogger(__name__)
+
+# 探索するパラメータ -> (Backtestへの渡し方, 名前)
+PARAMETERS = {
+    'MIN_REWARD_RATE': ('ai_kwargs', 'min_reward_rate'),
+    'MIN_LOCAL_PRICE_GAP_RATE': ('ai_kwargs', 'min_local_price_gap_rate'),
+    'SHORT_MIN_VOLUME': ('ai_kwargs', 'min_volume_short'),
+    'SHORT_MAX_VOLUME': ('ai_kwargs', 'max_volume_short'),
+    'LONG_MIN_VOLUME': ('ai_kwargs', 'min_volume_long'),
+    'LONG_MAX_VOLUME': ('ai_kwargs', 'max_volume_long'),
+    'MAX_BUY_PRICE_RATE_IN_LONG': ('env', 'MAX_BUY_PRICE_RATE_IN_LONG'),
+    'MAX_BUY_PRICE_RATE_IN_SHORT': ('env', 'MAX_BUY_PRICE_RATE_IN_SHORT'),
+    'MAX_BUY_PRICE_RATE_IN_DCA': ('env', 'MAX_BUY_PRICE_RATE_IN_DCA'),
+    'DCA_ST_BUY_PRICE_RATE': ('dca', 'st_buy_price_rate'),
+}
+
+RESULT_COLUMNS = [
+    'combination_id',
+    'total_profit',
+    'realized_profit',
+    'unrealized_profit',
+    'total_volume',
+    'buy_volume',
+    'sell_volume',
+    'order_count',
+    'jpy',
+    'coin',
+    'elapsed',
+    'error',
+]
+
+SERIES_FIELDS = ['opens', 'highs', 'lows', 'closes']
+
+# ワーカープロセスごとに共有メモリから復元した1分足
+_worker_series = None
+_worker_shared_memories = []
+
+
+def grid(space):
+    """全ての組み合わせ
+
+    Args:
+        space (dict): パラメータ名 -> 値のリスト
+    """
+    names = list(space.keys())
+    return [dict(zip(names, values)) for values in itertools.product(*[space[name] for name in names])]
+
+
+def random_search(space, n_samples, seed=0):
+    """ランダムな組み合わせ
+
+    Args:
+        space (dict): パラメータ名 -> 値のリスト(から選ぶ) or (下限, 上限)(の一様分布)
+        n_samples (int): 組み合わせの数
+    """
+    rng = random.Random(seed)
+    combinations = []
+    for _ in range(n_samples):
+        params = {}
+        for name, values in space.items():
+            if isinstance(values, tuple):
+                params[name] = round(rng.uniform(*values), 6)
+            else:
+                params[name] = rng.choice(values)
+        combinations.append(params)
+    return combinations
+
+
+def combination_id(settings, params):
+    """設定とパラメータから組み合わせを一意に識別するid(再開時の判定に使う)"""
+    body = json.dumps({'settings': settings, 'params': params}, sort_keys=True, default=str)
+    return hashlib.md5(body.encode('utf-8')).hexdigest()[:16]
+
+
+def _share_series(series):
+    """1分足を共有メモリに配置し、ワーカーが復元するための情報を返す"""
+    times = series['BUY'].times
+    shm_times = shared_memory.SharedMemory(create=True, size=times.nbytes)
+    np.ndarray(times.shape, dtype=times.dtype, buffer=shm_times.buf)[:] = times
+
+    shape = (2, len(SERIES_FIELDS), len(times))
+    shm_values = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)) * 8)
+    values = np.ndarray(shape, dtype='float64', buffer=shm_values.buf)
+    for i_side, side in enumerate(['BUY', 'SELL']):
+        for i_field, field in enumerate(SERIES_FIELDS):
+            values[i_side, i_field] = getattr(series[side], field)
+    spec = {
+        'times': (shm_times.name, times.shape, str(times.dtype)),
+        'values': (shm_values.name, shape, 'float64'),
+    }
+    return [shm_times, shm_values], spec
+
+
+def _init_worker(spec):
+    global _worker_series
+    arrays = {}
+    for key, (name, shape, dtype) in spec.items():
+        shm = shared_memory.SharedMemory(name=name)
+        # 参照を保持しないと共有メモリが閉じられる
+        _worker_shared_memories.append(shm)
+        arrays[key] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    _worker_series = {
+        side: BarSeries(arrays['times'], *arrays['values'][i_side])
+        for i_side, side in enumerate(['BUY', 'SELL'])
+    }
+
+
+def _backtest_kwargs(settings, params):
+    kwargs = {
+        'ai_kwargs': dict(settings.get('ai_kwargs', {})),
+        'env': dict(settings.get('env', {})),
+        'dca': [dict(dca_kwargs) for dca_kwargs in settings.get('dca', [])],
+    }
+    for name, value in params.items():
+        target, key = PARAMETERS[name]
+        if target == 'dca':
+            for dca_kwargs in kwargs['dca']:
+                dca_kwargs[key] = value
+        else:
+            kwargs[target][key] = value
+    return kwargs
+
+
+def _evaluate(settings, params, cid):
+    start_time = time.time()
+    row = {'combination_id': cid, **params}
+    try:
+        backtest = Backtest(
+            settings['product_code'],
+            settings['start'],
+            settings['end'],
+            initial_jpy=settings.get('initial_jpy', 1000000),
+            interval_minutes=settings.get('interval_minutes', 60),
+            warmup_days=settings.get('warmup_days', 400),
+            long_term=settings.get('long_term', True),
+            short_term=settings.get('short_term', True),
+            min_size=settings.get('min_size', DEFAULT_MIN_SIZE),
+            **_backtest_kwargs(settings, params)
+        )
+        result = backtest.run(series=_worker_series)
+        profit = result.daily_profit.sum()
+        volume = result.daily_volume.sum()
+        row.update({
+            'total_profit': profit['total_profit'],
+            'realized_profit': profit['realized_profit'],
+            'unrealized_profit': profit['unrealized_profit'],
+            'total_volume': volume['total_volume'],
+            'buy_volume': volume['buy_volume'],
+            'sell_volume': volume['sell_volume'],
+            'order_count': sum(len(df) for df in result.child_orders.values()),
+            'jpy': result.df_balance['JPY'].iloc[-1],
+            'coin': result.df_balance[settings['product_code'].split('_')[0]].iloc[-1],
+            'error': '',
+        })
+    except Exception as e:
+        row['error'] = repr(e)
+    row['elapsed'] = round(time.time() - start_time, 3)
+    return row
+
+
+def read_results(result_path):
+    """保存済みの結果を読み込む(失敗後に再実行した組み合わせは最後の結果のみ残す)"""
+    p_result_path = Path(result_path)
+    if not p_result_path.exists():
+        return pd.DataFrame(columns=RESULT_COLUMNS)
+    df_results = pd.read_csv(p_result_path, dtype={'combination_id': str})
+    return df_results.drop_duplicates(subset='combination_id', keep='last').reset_index(drop=True)
+
+
+def run_sweep(product_code, start, end, combinations, result_path, processes=None, **settings):
+    """パラメータの組み合わせごとにバックテストを並列に実行し、結果を1つのcsvに追記する
+
+    1分足は親プロセスで1回だけ読み込んで共有メモリに配置し、各ワーカーはコピーせずに参照する。
+    結果は1件終わるごとにresult_pathに追記するため、中断しても
+    同じresult_pathで再実行すれば、終わっていない組み合わせのみを実行する。
+
+    Args:
+        product_code (str): プロダクト
+        start (datetime.datetime): 開始時刻(タイムゾーン付き)
+        end (datetime.datetime): 終了時刻(タイムゾーン付き)
+        combinations (list): grid, random_searchで作成したパラメータのリスト
+        result_path (str): 結果を保存するcsv(ローカル)
+        processes (int, optional): 並列数。省略した場合はCPU数
+        **settings: 全組み合わせに共通のBacktestの設定
+            (initial_jpy, interval_minutes, warmup_days, long_term, short_term, dca, min_size, ai_kwargs, env)
+
+    Returns:
+        pd.DataFrame: これまでの全ての結果
+    """
+    settings = {'product_code': product_code, 'start': start, 'end': end, **settings}
+    param_names = sorted({name for params in combinations for name in params})
+    unknown_names = [name for name in param_names if name not in PARAMETERS]
+    if len(unknown_names) > 0:
+        raise ValueError(f'探索できないパラメータです。({unknown_names})')
+
+    p_result_path = Path(result_path)
+    # 失敗した組み合わせ(errorが空でない)は実行済みとせず、再実行する
+    df_results = read_results(p_result_path)
+    succeeded = df_results['error'].fillna('').astype(str) == ''
+    done_ids = set(df_results.loc[succeeded, 'combination_id'].astype(str).tolist())
+    pending = {}
+    for params in combinations:
+        cid = combination_id(settings, params)
+        if cid not in done_ids:
+            pending[cid] = params
+    logger.info(
+        f'[{product_code} {start} - {end}] {len(combinations)}件中{len(combinations) - len(pending)}件は実行済みです。'
+        + f'残り{len(pending)}件を実行します。')
+    if len(pending) == 0:
+        return read_results(p_result_path)
+
+    series = load_series(product_code, start, end, settings.get('warmup_days', 400))
+    shared_memories, spec = _share_series(series)
+    del series
+
+    fieldnames = ['combination_id'] + param_names + RESULT_COLUMNS[1:]
+    write_header = not p_result_path.exists()
+    start_time = time.time()
+    try:
+        with open(p_result_path, 'a', newline='') as f, \
+                ProcessPoolExecutor(max_workers=processes, initializer=_init_worker, initargs=(spec,)) as executor:
+            writer = csv.DictWriter(f, fieldnames=fieldnames, extrasaction='ignore')
+            if write_header:
+                writer.writeheader()
+            futures = [executor.submit(_evaluate, settings, params, cid) for cid, params in pending.items()]
+            for i, future in enumerate(as_completed(futures)):
+                row = future.result()
+                writer.writerow(row)
+                f.flush()
+                logger.info(
+                    f'[{product_code} {i + 1}/{len(futures)} {time.time() - start_time:.0f}s] '
+                    + f'{row["combination_id"]} total_profit: {row.get("total_profit")} {row["error"]}')
+    finally:
+        for shm in shared_memories:
+            shm.close()
+            shm.unlink()
+
+    return read_results(p_result_path)
+
+
+def _parse_space(space):
+    """jsonの値: リストはそのまま、{"low": x, "high": y} は一様分布の範囲"""
+    return {
+        name: (values['low'], values['high']) if isinstance(values, dict) else values
+        for name, values in space.items()
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='戦略のパラメータを過去の期間で探索する')
+    parser.add_argument('product_code')
+    parser.add_argument('start', help='YYYY-MM-DD (Asia/Tokyo)')
+    parser.add_argument('end', help='YYYY-MM-DD (Asia/Tokyo)')
+    parser.add_argument('config', help='{"space": {...}, "settings": {...}} のjsonファイル')
+    parser.add_argument('result_path')
+    parser.add_argument('--random', type=int, default=0, help='ランダムに探索する件数(0の場合はグリッド)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--processes', type=int, default=None)
+    args = parser.parse_args()
+
+    tz = datetime.timezone(datetime.timedelta(hours=9))
+    config = json.loads(Path(args.config).read_text())
+    space = _parse_space(config['space'])
+    if args.random > 0:
+        combinations = random_search(space, args.random, seed=args.seed)
+    else:
+        combinations = grid(space)
+    run_sweep(
+        args.product_code,
+        datetime.datetime.fromisoformat(args.start).replace(tzinfo=tz),
+        datetime.datetime.fromisoformat(args.end).replace(tzinfo=tz),
+        combinations,
+        args.result_path,
+        processes=args.processes,
+        **config.get('settings', {})
+    )
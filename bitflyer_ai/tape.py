@@ -0,0 +1,241 @@
+import datetime
+from logging import getLogger
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from manage import APPENDED_DIR, EXECUTION_HISTORY_DIR, TRADE_TAPE_FILENAME
+from schema import SIDE_DTYPE
+from utils import (append_bytes, list_files, local_path, path_exists,
+                   read_bytes, rm_dir, write_bytes)
+
+logger = getLogger(__name__)
+
+# 1約定あたり33byteの固定長レコード(パディングなし)
+TAPE_DTYPE = np.dtype([
+    ('id', '<i8'),
+    ('ts', '<i8'),  # UTCのepoch ns
+    ('price', '<f8'),
+    ('size', '<f8'),
+    ('side', 'i1'),
+])
+
+SIDE_CODES = {'BUY': 1, 'SELL': -1, '': 0}
+# side(-1, 0, 1) + 1 -> SIDE_DTYPEのカテゴリ番号
+SIDE_CATEGORY_CODES = np.array([
+    SIDE_DTYPE.categories.get_loc('SELL'),
+    SIDE_DTYPE.categories.get_loc(''),
+    SIDE_DTYPE.categories.get_loc('BUY'),
+], dtype='int8')
+
+
+def tape_path(product_code, target_date):
+    return Path(EXECUTION_HISTORY_DIR).joinpath(
+        product_code,
+        target_date.strftime('%Y'),
+        target_date.strftime('%m'),
+        target_date.strftime('%d'),
+        'tape',
+        TRADE_TAPE_FILENAME
+    )
+
+
+def tape_appended_dir(p_path):
+    return Path(p_path).parent.joinpath(APPENDED_DIR)
+
+
+def to_records(df):
+    """schema.compact_executionsの形式の約定履歴をレコード配列に変換する"""
+    records = np.empty(len(df), dtype=TAPE_DTYPE)
+    if len(df) == 0:
+        return records
+    records['id'] = df['id'].values
+    records['ts'] = df.index.asi8
+    records['price'] = df['price'].values
+    records['size'] = df['size'].values
+    records['side'] = df['side'].astype(str).map(SIDE_CODES).fillna(0).values
+    return records
+
+
+def _last_id(p_path):
+    if not path_exists(p_path):
+        return None
+    with open(local_path(p_path), 'rb') as f:
+        f.seek(0, 2)
+        file_size = f.tell()
+        if file_size < TAPE_DTYPE.itemsize:
+            return None
+        f.seek(file_size - TAPE_DTYPE.itemsize)
+        last_record = np.frombuffer(f.read(TAPE_DTYPE.itemsize), dtype=TAPE_DTYPE)
+    return int(last_record['id'][0])
+
+
+def _merge_records(record_list):
+    """レコード配列をid順に結合する(同じidは先に並べた配列のレコードを使う)"""
+    merged = np.concatenate(record_list)
+    _, i_unique = np.unique(merged['id'], return_index=True)
+    return merged[i_unique]
+
+
+def _read_appended(p_path):
+    return [
+        np.frombuffer(read_bytes(Path(path)), dtype=TAPE_DTYPE)
+        for path in list_files(tape_appended_dir(p_path))
+    ]
+
+
+def append_tape(p_path, df):
+    """約定をid順を保ったままテープに追加する
+
+    保存済みの最後のidより新しい約定のみの場合は末尾に追記する。
+    それ以前のid(後から取り込んだ日や、順序が前後した約定)を含む場合は、
+    既存のレコードとidでマージしてテープ全体を書き直す(同じidは新しい内容で置き換える)。
+
+    Returns:
+        int: 新たに追加したレコード数
+    """
+    if df.empty:
+        return 0
+
+    records = np.sort(to_records(df), order='id')
+    last_id = _last_id(p_path)
+    if last_id is None or records['id'][0] > last_id:
+        append_bytes(p_path, records.tobytes())
+        logger.debug(f'[{p_path}] {len(records)}件の約定をテープに追記しました。')
+        return len(records)
+
+    existing = np.fromfile(local_path(p_path), dtype=TAPE_DTYPE)
+    merged = _merge_records([records, existing])
+    added_count = len(merged) - len(existing)
+    write_bytes(p_path, merged.tobytes())
+    logger.info(
+        f'[{p_path}] 保存済みの最後のid({last_id})以前の約定を含むため、テープをマージしました。'
+        + f'({len(records)}件中{added_count}件を追加)'
+    )
+    return added_count
+
+
+def write_tape_appended(p_path, df):
+    """約定をテープに結合せず、小さなオブジェクト(tape/appended/<最初のid>.bin)として書き込む
+
+    S3は追記に対応しておらず、append_tapeではテープ全体を書き直すことになるため、S3での追記に使う。
+    open_tapeでテープと結合して読み込み、fold_tape_appendedでテープにまとめる。
+
+    Returns:
+        int: 書き込んだレコード数
+    """
+    if df.empty:
+        return 0
+    records = np.sort(to_records(df), order='id')
+    write_bytes(tape_appended_dir(p_path).joinpath(f'{int(records["id"][0]):020d}.bin'), records.tobytes())
+    return len(records)
+
+
+def fold_tape_appended(p_path):
+    """write_tape_appendedで書き込んだ約定をテープにまとめる
+
+    Returns:
+        int: まとめたオブジェクト数
+    """
+    record_list = _read_appended(p_path)
+    if len(record_list) == 0:
+        return 0
+    if path_exists(p_path):
+        record_list.append(np.frombuffer(read_bytes(p_path), dtype=TAPE_DTYPE))
+    write_bytes(p_path, _merge_records(record_list).tobytes())
+    rm_dir(tape_appended_dir(p_path))
+    logger.debug(f'[{p_path}] {len(record_list)}個の追記分をテープにまとめました。')
+    return len(record_list)
+
+
+class TradeTape:
+    """1日分のテープをnumpy.memmapで読み込む
+
+    レコードはid順(≒時刻順)に並んでいるため、
+    searchsortedで時刻・idの範囲を二分探索で切り出せる。
+    appended_recordsを指定した場合は、テープに結合してから読み込む(メモリ上にコピーする)。
+    """
+
+    def __init__(self, p_path, appended_records=()):
+        self.p_path = None if p_path is None else Path(p_path)
+        if self.p_path is None or self.p_path.stat().st_size < TAPE_DTYPE.itemsize:
+            self.records = np.empty(0, dtype=TAPE_DTYPE)
+        else:
+            self.records = np.memmap(self.p_path, dtype=TAPE_DTYPE, mode='r')
+        if len(appended_records) > 0:
+            self.records = _merge_records([self.records, *appended_records])
+
+    def __len__(self):
+        return len(self.records)
+
+    def slice_time(self, start=None, end=None):
+        """start <= 約定時刻 < end のレコードを返す(コピーしない)"""
+        timestamps = self.records['ts']
+        i_start = 0 if start is None else np.searchsorted(timestamps, pd.Timestamp(start).value, side='left')
+        i_end = len(timestamps) if end is None else np.searchsorted(timestamps, pd.Timestamp(end).value, side='left')
+        return self.records[i_start:i_end]
+
+    def slice_id(self, start_id=None, end_id=None):
+        """start_id <= id < end_id のレコードを返す(コピーしない)"""
+        ids = self.records['id']
+        i_start = 0 if start_id is None else np.searchsorted(ids, start_id, side='left')
+        i_end = len(ids) if end_id is None else np.searchsorted(ids, end_id, side='left')
+        return self.records[i_start:i_end]
+
+
+def records_to_frame(records, region='Asia/Tokyo'):
+    """レコード配列をget_executionsと同じ列名のDataFrameに変換する"""
+    df = pd.DataFrame({
+        'id': records['id'],
+        'side': pd.Categorical.from_codes(
+            SIDE_CATEGORY_CODES[records['side'].astype('int64') + 1],
+            dtype=SIDE_DTYPE
+        ),
+        'price': records['price'],
+        'size': records['size'],
+    }, index=pd.to_datetime(records['ts'], utc=True))
+    df.index.name = 'exec_date'
+    if region is not None:
+        df = df.tz_convert(region)
+    return df
+
+
+def open_tape(product_code, target_date):
+    """1日分のテープを、まとめていない追記分(write_tape_appended)と合わせて読み込む"""
+    p_path = tape_path(product_code, target_date)
+    appended_records = _read_appended(p_path)
+    exists = path_exists(p_path)
+    if not exists and len(appended_records) == 0:
+        return None
+    return TradeTape(local_path(p_path) if exists else None, appended_records)
+
+
+def iter_tapes(product_code, start_date, end_date):
+    """start_dateからend_dateまで(両端を含む)の日毎のテープを返すジェネレータ"""
+    target_date = start_date
+    while target_date <= end_date:
+        trade_tape = open_tape(product_code, target_date)
+        if trade_tape is not None:
+            yield target_date, trade_tape
+        target_date += datetime.timedelta(days=1)
+
+
+def load_tape_range(product_code, start, end):
+    """start <= 約定時刻 < end の約定を1つのレコード配列として返す
+
+    Args:
+        product_code (str): プロダクト
+        start (datetime.datetime): 開始時刻(タイムゾーン付き)
+        end (datetime.datetime): 終了時刻(タイムゾーン付き)
+    """
+    # 日毎のパーティションはAsia/Tokyoの日付で区切られている
+    start_date = pd.Timestamp(start).tz_convert('Asia/Tokyo').date()
+    end_date = pd.Timestamp(end).tz_convert('Asia/Tokyo').date()
+    chunks = [
+        trade_tape.slice_time(start, end)
+        for _, trade_tape in iter_tapes(product_code, start_date, end_date)
+    ]
+    if len(chunks) == 0:
+        return np.empty(0, dtype=TAPE_DTYPE)
+    return np.concatenate(chunks)
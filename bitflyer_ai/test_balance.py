@@ -0,0 +1,132 @@
+import datetime
+
+import pandas as pd
+import pytest
+
+from balance import BalanceLedger
+from ledger import OrderRecord
+
+PRICE = 4000000
+SIZE = 0.01
+
+
+def _record(side, state, executed_size=0.0, commission=0.0):
+    return OrderRecord(0, 'JRF1', {
+        'side': side,
+        'child_order_state': state,
+        'price': PRICE,
+        'size': SIZE,
+        'total_commission': commission,
+        'executed_size': executed_size,
+    })
+
+
+def _ledger(balances):
+    ledger = BalanceLedger(reconcile_interval=datetime.timedelta(hours=1))
+    ledger.balances = {
+        currency_code: {'amount': amount, 'available': available}
+        for currency_code, (amount, available) in balances.items()
+    }
+    ledger.reconciled_at = datetime.datetime(2026, 1, 5, tzinfo=datetime.timezone.utc)
+    ledger.stale = False
+    return ledger
+
+
+def _assert_balances(actual, expected):
+    assert set(actual) == set(expected)
+    for currency_code, values in expected.items():
+        assert actual[currency_code] == pytest.approx(values), currency_code
+
+
+# side, state, executed_size, commission -> {currency_code: [amountの増減, availableの増減]}
+ORDER_EFFECT_CASES = [
+    ('BUY', 'ACTIVE', 0.0, 0.0, {'JPY': [0, -40000], 'BTC': [0, 0]}),
+    ('BUY', 'ACTIVE', 0.004, 0.000006, {'JPY': [-16000, -40000], 'BTC': [0.003994, 0.003994]}),
+    ('BUY', 'COMPLETED', 0.0, 0.000015, {'JPY': [-40000, -40000], 'BTC': [0.009985, 0.009985]}),
+    ('BUY', 'CANCELED', 0.0, 0.0, {'JPY': [0, 0], 'BTC': [0, 0]}),
+    ('BUY', 'CANCELED', 0.004, 0.000006, {'JPY': [-16000, -16000], 'BTC': [0.003994, 0.003994]}),
+    ('SELL', 'ACTIVE', 0.0, 0.0, {'JPY': [0, 0], 'BTC': [0, -0.01]}),
+    ('SELL', 'ACTIVE', 0.004, 0.000006, {'JPY': [16000, 16000], 'BTC': [-0.004006, -0.010006]}),
+    ('SELL', 'COMPLETED', 0.0, 0.000015, {'JPY': [40000, 40000], 'BTC': [-0.010015, -0.010015]}),
+    ('SELL', 'CANCELED', 0.0, 0.0, {'JPY': [0, 0], 'BTC': [0, 0]}),
+    ('SELL', 'CANCELED', 0.004, 0.000006, {'JPY': [16000, 16000], 'BTC': [-0.004006, -0.004006]}),
+]
+
+
+@pytest.mark.parametrize('side, state, executed_size, commission, expected', ORDER_EFFECT_CASES)
+def test_order_effect(side, state, executed_size, commission, expected):
+    effect = BalanceLedger.order_effect('BTC', _record(side, state, executed_size, commission))
+    _assert_balances(effect, expected)
+
+
+def test_order_effect_with_state_override():
+    record = _record('BUY', 'ACTIVE')
+    assert BalanceLedger.order_effect('BTC', record, state='COMPLETED')['JPY'] == pytest.approx([-40000, -40000])
+    assert BalanceLedger.order_effect('BTC', None) == {}
+
+
+# 注文の送信(ACTIVE)から、約定・キャンセルまでの残高({currency_code: [amount, available]})
+APPLY_CASES = [
+    ('BUY', 'ACTIVE', 0.004, 0.000006,
+     {'JPY': [84000, 60000], 'BTC': [0.003994, 0.003994]}),
+    ('BUY', 'COMPLETED', 0.0, 0.000015,
+     {'JPY': [60000, 60000], 'BTC': [0.009985, 0.009985]}),
+    ('BUY', 'CANCELED', 0.0, 0.0,
+     {'JPY': [100000, 100000], 'BTC': [0, 0]}),
+    ('BUY', 'CANCELED', 0.004, 0.000006,
+     {'JPY': [84000, 84000], 'BTC': [0.003994, 0.003994]}),
+    ('SELL', 'ACTIVE', 0.004, 0.000006,
+     {'JPY': [116000, 116000], 'BTC': [0.015994, 0.009994]}),
+    ('SELL', 'COMPLETED', 0.0, 0.000015,
+     {'JPY': [140000, 140000], 'BTC': [0.009985, 0.009985]}),
+    ('SELL', 'CANCELED', 0.0, 0.0,
+     {'JPY': [100000, 100000], 'BTC': [0.02, 0.02]}),
+    ('SELL', 'CANCELED', 0.004, 0.000006,
+     {'JPY': [116000, 116000], 'BTC': [0.015994, 0.015994]}),
+]
+
+
+@pytest.mark.parametrize('side, state, executed_size, commission, expected', APPLY_CASES)
+def test_apply_order_state_change(local_storage, side, state, executed_size, commission, expected):
+    ledger = _ledger({'JPY': (100000, 100000), 'BTC': (0.02, 0.02)} if side == 'SELL' else {'JPY': (100000, 100000)})
+    if side == 'BUY':
+        expected = {'BTC': [0, 0], **expected}
+
+    placed = BalanceLedger.order_effect('BTC', _record(side, 'ACTIVE'))
+    ledger.apply({}, placed)
+    ledger.apply(placed, BalanceLedger.order_effect('BTC', _record(side, state, executed_size, commission)))
+
+    _assert_balances(
+        {currency_code: [balance['amount'], balance['available']] for currency_code, balance in ledger.balances.items()},
+        expected)
+    assert not ledger.stale
+
+
+def test_apply_invalidates_when_available_becomes_negative(local_storage):
+    ledger = _ledger({'JPY': (10000, 10000)})
+
+    ledger.apply({}, BalanceLedger.order_effect('BTC', _record('BUY', 'ACTIVE')))
+
+    assert ledger.stale
+    assert ledger.needs_reconcile(ledger.reconciled_at)
+
+
+def test_reconcile_replaces_balances(local_storage):
+    ledger = _ledger({'JPY': (100000, 60000), 'BTC': (0.01, 0.01), 'ETH': (1.0, 1.0)})
+    ledger.invalidate('テスト')
+    current_datetime = datetime.datetime(2026, 1, 5, tzinfo=datetime.timezone.utc)
+
+    ledger.reconcile(pd.DataFrame([
+        {'currency_code': 'JPY', 'amount': 90000, 'available': 50000},
+        {'currency_code': 'BTC', 'amount': 0.02, 'available': 0.015},
+    ]), current_datetime)
+
+    assert ledger.balances == {
+        'JPY': {'amount': 90000.0, 'available': 50000.0},
+        'BTC': {'amount': 0.02, 'available': 0.015},
+    }
+    assert ledger.available('ETH') == 0.0
+    assert ledger.reconciled_at == current_datetime
+    assert not ledger.stale
+    assert not ledger.needs_reconcile(current_datetime + datetime.timedelta(minutes=59))
+    assert ledger.needs_reconcile(current_datetime + datetime.timedelta(hours=1))
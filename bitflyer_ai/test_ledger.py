@@ -0,0 +1,138 @@
+import datetime
+import itertools
+
+import pandas as pd
+import pytest
+
+from clock import JST
+from ledger import OrderLedger
+from utils import read_csv
+
+REGION = 'Asia/Tokyo'
+TARGET_DATETIME = datetime.datetime(2026, 1, 5, 9, tzinfo=JST)
+
+# child_order_acceptance_id, side, child_order_state, child_order_cycle, related_child_order_acceptance_id,
+# price, size, child_order_date
+CHILD_ORDERS = [
+    ('JRF01', 'BUY', 'COMPLETED', 'daily', 'JRF02', 4000000, 0.01, '2026-01-04T08:00:00+09:00'),
+    ('JRF02', 'SELL', 'COMPLETED', 'daily', 'JRF01', 4100000, 0.01, '2026-01-04T10:00:00+09:00'),
+    ('JRF03', 'BUY', 'COMPLETED', 'daily', 'no_id', 4050000, 0.01, '2026-01-05T09:00:00+09:00'),
+    ('JRF04', 'BUY', 'ACTIVE', 'daily', 'no_id', 4000000, 0.01, '2026-01-05T09:00:00.5+09:00'),
+    ('JRF05', 'BUY', 'ACTIVE', 'weekly', 'no_id', 4000000, 0.01, '2026-01-05T00:00:00Z'),
+    ('JRF06', 'BUY', 'CANCELED', 'daily', 'no_id', 3900000, 0.01, '2026-01-05T12:00:00+09:00'),
+    ('JRF07', 'SELL', 'ACTIVE', 'daily', 'JRF08', 4200000, 0.01, '2026-01-05T13:00:00+09:00'),
+    ('JRF08', 'BUY', 'COMPLETED', 'daily', 'JRF07', 4000000, 0.02, '2026-01-03T13:00:00+09:00'),
+    ('JRF09', 'BUY', 'COMPLETED', 'weekly', 'no_id', 3950000, 0.01, '2026-01-05T15:00:00+09:00'),
+    ('JRF10', 'SELL', 'ACTIVE', 'weekly', 'JRF11', 4150000, 0.01, '2026-01-02T15:00:00+09:00'),
+    ('JRF11', 'BUY', 'COMPLETED', 'weekly', 'JRF10', 3900000, 0.01, '2026-01-01T15:00:00+09:00'),
+    ('JRF12', 'BUY', 'ACTIVE', 'daily', 'no_id', 4000000, 0.02, '2026-01-06T09:00:00+09:00'),
+]
+
+
+@pytest.fixture
+def df_child_orders(local_storage):
+    """従来のcsvを、AIと同じ手順で読み込んだDataFrame"""
+    df = pd.DataFrame(CHILD_ORDERS, columns=[
+        'child_order_acceptance_id',
+        'side',
+        'child_order_state',
+        'child_order_cycle',
+        'related_child_order_acceptance_id',
+        'price',
+        'size',
+        'child_order_date',
+    ])
+    df['child_order_date'] = pd.to_datetime(df['child_order_date'], utc=True).dt.tz_convert(REGION)
+    df['total_commission'] = 0.0
+    df['total_commission_yen'] = 0.0
+    df['profit'] = 0.0
+    df['volume'] = df['price'] * df['size']
+    df['executed_size'] = df['size']
+    df.to_csv('long_term.csv', index=False)
+
+    df = read_csv('long_term.csv').set_index('child_order_acceptance_id', drop=True)
+    df['child_order_date'] = pd.to_datetime(df['child_order_date'])
+    df['child_order_date'] = df['child_order_date'].dt.tz_convert(REGION)
+    return df
+
+
+def _ids(records):
+    return [record.child_order_acceptance_id for record in records]
+
+
+@pytest.mark.parametrize('child_order_cycle', ['daily', 'weekly'])
+@pytest.mark.parametrize('price, size', [(4000000, 0.01), (4000000, 0.02), (3900000, 0.01)])
+def test_buy_conditions_match_frame_query(df_child_orders, child_order_cycle, price, size):
+    ledger = OrderLedger.from_frame(df_child_orders)
+    target_datetime = TARGET_DATETIME
+
+    buy_active_same_price = [
+        record for record in ledger.select(side='BUY', state='ACTIVE')
+        if record.price == price and record.size == size
+    ]
+    assert _ids(buy_active_same_price) == df_child_orders.query(
+        'side == "BUY" and child_order_state == "ACTIVE" and price == @price and size == @size'
+    ).index.tolist()
+    assert _ids(ledger.select(side='BUY', state='COMPLETED', related='no_id')) == df_child_orders.query(
+        'side == "BUY" and child_order_state == "COMPLETED" and related_child_order_acceptance_id == "no_id"'
+    ).index.tolist()
+
+    target_buy_history = df_child_orders.query(
+        'side == "BUY" and child_order_date > @target_datetime and child_order_cycle == @child_order_cycle'
+    )
+    records = ledger.since(target_datetime, side='BUY', cycle=child_order_cycle)
+    assert _ids(records) == target_buy_history.index.tolist()
+    for state in ['ACTIVE', 'COMPLETED']:
+        assert [record.child_order_acceptance_id for record in records if record.child_order_state == state] \
+            == target_buy_history.query('child_order_state == @state').index.tolist()
+
+    for side in ['BUY', 'SELL']:
+        assert _ids(ledger.select(side=side, state='ACTIVE', cycle=child_order_cycle)) == df_child_orders.query(
+            'side == @side and child_order_state == "ACTIVE" and child_order_cycle == @child_order_cycle'
+        ).index.tolist()
+    assert _ids(ledger.select(side='BUY', state='COMPLETED', cycle=child_order_cycle, related='no_id')) \
+        == df_child_orders.query(
+            'side=="BUY" and child_order_state == "COMPLETED" and child_order_cycle == @child_order_cycle '
+            'and related_child_order_acceptance_id == "no_id"'
+        ).index.tolist()
+
+
+@pytest.mark.parametrize('target_date', [
+    datetime.datetime(2026, 1, 1, tzinfo=JST),
+    TARGET_DATETIME,
+    datetime.datetime(2026, 1, 5, 0, tzinfo=datetime.timezone.utc),
+    datetime.datetime(2026, 1, 7, tzinfo=JST),
+])
+def test_since_matches_frame_query(df_child_orders, target_date):
+    ledger = OrderLedger.from_frame(df_child_orders)
+
+    assert _ids(ledger.since(target_date)) == df_child_orders.query('child_order_date > @target_date').index.tolist()
+
+
+def test_select_matches_frame_query_after_updates(df_child_orders):
+    ledger = OrderLedger.from_frame(df_child_orders)
+    # 約定・売り注文の紐付け・新規の注文で、条件に使う列が変わる
+    ledger.upsert('JRF04', {'child_order_state': 'COMPLETED'})
+    ledger.upsert('JRF03', {'related_child_order_acceptance_id': 'JRF13'})
+    ledger.upsert('JRF13', {
+        'side': 'SELL',
+        'child_order_state': 'ACTIVE',
+        'child_order_cycle': 'daily',
+        'related_child_order_acceptance_id': 'JRF03',
+        'price': 4150000,
+        'size': 0.01,
+        'child_order_date': pd.Timestamp('2026-01-05T16:00:00+09:00').tz_convert(REGION),
+    })
+    df = ledger.to_frame()
+
+    for side, state, cycle in itertools.product(['BUY', 'SELL'], ['ACTIVE', 'COMPLETED', 'CANCELED'],
+                                                ['daily', 'weekly']):
+        assert _ids(ledger.select(side=side, state=state, cycle=cycle)) == df.query(
+            'side == @side and child_order_state == @state and child_order_cycle == @cycle'
+        ).index.tolist()
+        assert _ids(ledger.select(side=side, state=state, related='no_id')) == df.query(
+            'side == @side and child_order_state == @state and related_child_order_acceptance_id == "no_id"'
+        ).index.tolist()
+    assert _ids(ledger.since(TARGET_DATETIME, side='BUY', cycle='daily')) == df.query(
+        'side == "BUY" and child_order_date > @TARGET_DATETIME and child_order_cycle == "daily"'
+    ).index.tolist()
@@ -0,0 +1,100 @@
+import pandas as pd
+import pytest
+
+import order_store
+from ledger import OrderLedger
+from order_store import ChildOrderStore, order_store_delta_dir, order_store_path
+from utils import list_files
+
+
+def _frame(ids):
+    return pd.DataFrame({
+        'side': 'BUY',
+        'child_order_state': 'COMPLETED',
+        'child_order_cycle': 'daily',
+        'related_child_order_acceptance_id': 'no_id',
+        'price': 4000000.0,
+        'size': 0.01,
+        'child_order_date': pd.Timestamp('2026-01-05 09:00', tz='Asia/Tokyo'),
+        'total_commission': 0.0,
+        'total_commission_yen': 0.0,
+        'profit': 0.0,
+        'volume': 40000.0,
+    }, index=pd.Index(ids, name='child_order_acceptance_id'))
+
+
+@pytest.fixture
+def remote_store(local_storage, monkeypatch):
+    """S3と同じく、一時ファイルを更新して差分を書き込むChildOrderStore"""
+    monkeypatch.setattr(order_store, 'writes_in_place', lambda: False)
+    return local_storage
+
+
+def _load(term='long'):
+    store = ChildOrderStore('BTC_JPY')
+    try:
+        return store.load_ledger(term)
+    finally:
+        store.close()
+
+
+def test_commit_writes_changed_orders_as_delta(remote_store):
+    ledger = OrderLedger.from_frame(_frame(['A', 'B', 'C']))
+    store = ChildOrderStore('BTC_JPY')
+    store.upsert('long', list(ledger), columns=ledger.columns)
+    store.commit()
+    store.close()
+
+    assert not order_store_path('BTC_JPY').exists()
+    assert len(list_files(order_store_delta_dir('BTC_JPY'))) == 1
+
+    store = ChildOrderStore('BTC_JPY')
+    ledger = store.load_ledger('long')
+    ledger.get('A').child_order_state = 'ACTIVE'
+    store.upsert('long', [ledger.get('A')])
+    store.delete('long', ['B'])
+    store.update_unrealized_profit('long', 4100000)
+    store.commit()
+    store.close()
+
+    ledger = _load()
+    assert [record.child_order_acceptance_id for record in ledger] == ['A', 'C']
+    assert ledger.get('A').child_order_state == 'ACTIVE'
+    assert ledger.get('A').profit == 0
+    assert ledger.get('C').profit == pytest.approx(1000)
+
+
+def test_deltas_are_folded_into_database(remote_store, monkeypatch):
+    monkeypatch.setattr(order_store, 'ORDER_STORE_FOLD_DELTAS', 2)
+    for child_order_acceptance_id in ['A', 'B', 'C']:
+        ledger = OrderLedger.from_frame(_frame([child_order_acceptance_id]))
+        store = ChildOrderStore('BTC_JPY')
+        store.upsert('long', list(ledger), columns=ledger.columns)
+        store.commit()
+        store.close()
+
+    assert order_store_path('BTC_JPY').exists()
+    assert list_files(order_store_delta_dir('BTC_JPY')) == []
+    assert sorted(record.child_order_acceptance_id for record in _load()) == ['A', 'B', 'C']
+
+
+def test_csv_updated_after_import_is_imported_again(remote_store):
+    p_csv_path = remote_store.joinpath('child_orders', 'BTC_JPY', 'long_term.csv')
+    p_csv_path.parent.mkdir(parents=True)
+    _frame(['A']).to_csv(p_csv_path)
+
+    store = ChildOrderStore('BTC_JPY')
+    assert [record.child_order_acceptance_id for record in store.load_ledger('long')] == ['A']
+    store.commit()
+    store.close()
+
+    # 従来のcsvで運用している間に注文が追加された
+    _frame(['A', 'B']).to_csv(p_csv_path)
+    store = ChildOrderStore('BTC_JPY')
+    assert [record.child_order_acceptance_id for record in store.load_ledger('long')] == ['A', 'B']
+    store.delete('long', ['A'])
+    store.commit()
+    store.close()
+
+    # 取り込み済みのcsvは取り込み直さない
+    assert [record.child_order_acceptance_id for record in _load()] == ['B']
@@ -0,0 +1,56 @@
+import numpy as np
+
+from planner import ACCEPTED, INSUFFICIENT_JPY, plan_buys, plan_dca
+
+
+def test_plan_buys_with_scalar_inputs():
+    plan = plan_buys(
+        local_low=4000000,
+        local_high=4500000,
+        global_high=8000000,
+        now_price=4200000,
+        max_buy_price_rate=0.8,
+        min_volume=10000,
+        max_volume=30000,
+        min_size=0.001,
+        min_local_price_gap_rate=0.03,
+        available_jpy=100000,
+    )
+
+    assert len(plan) == 1
+    assert plan.price.shape == (1,)
+    assert plan.reason[0] == ACCEPTED
+    assert int(plan.price[0]) == 4000000
+    assert float(plan.size[0]) == 0.007
+
+
+def test_plan_dca_with_scalar_inputs():
+    plan = plan_dca(
+        now_price=4000000,
+        global_high=8000000,
+        min_volume=10000,
+        max_volume=30000,
+        min_size=0.001,
+        max_buy_price_rate=0.8,
+        available_jpy=100000,
+    )
+
+    assert len(plan) == 1
+    assert plan.price.shape == (1,)
+    assert plan.reason[0] == ACCEPTED
+    assert int(plan.price[0]) == 4000000
+    assert np.isclose(float(plan.volume[0]), 30000)
+
+
+def test_plan_dca_rejects_when_jpy_is_insufficient():
+    plan = plan_dca(
+        now_price=4000000,
+        global_high=8000000,
+        min_volume=10000,
+        max_volume=30000,
+        min_size=0.001,
+        max_buy_price_rate=0.8,
+        available_jpy=1000,
+    )
+
+    assert plan.reason[0] == INSUFFICIENT_JPY
@@ -0,0 +1,68 @@
+import datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from clock import JST
+from manage import APPENDED_DIR
+from preprocess import (LatestSummary, append_day_executions, compact_row_data,
+                        load_row_archive, read_day_rows, save_day_executions)
+from schema import BAR_PRICE_COLUMNS
+from tape import TAPE_DTYPE, open_tape, tape_appended_dir, tape_path
+from utils import list_files, read_bytes, storage_overlay
+
+
+def _executions(first_id, start, count):
+    times = pd.date_range(pd.Timestamp(start).tz_convert('UTC'), periods=count, freq='min')
+    return pd.DataFrame({
+        'id': np.arange(first_id, first_id + count),
+        'side': ['BUY', 'SELL'] * (count // 2),
+        'price': 5000000.0 + np.arange(count),
+        'size': 0.01,
+        'buy_child_order_acceptance_id': 'JRF_BUY',
+        'sell_child_order_acceptance_id': 'JRF_SELL',
+    }, index=pd.Index(times, name='exec_date'))
+
+
+def test_appended_executions_are_read_and_compacted(local_storage):
+    target_date = datetime.date(2026, 1, 5)
+    start = datetime.datetime(2026, 1, 5, tzinfo=JST)
+    save_day_executions('BTC_JPY', target_date, _executions(1, start, 10))
+    p_row_dir = Path('execute_history', 'BTC_JPY', '2026', '01', '05', 'row')
+    p_tape_path = tape_path('BTC_JPY', target_date)
+
+    # S3と同じく、ファイルを直接更新できない場合は追記分を小さなファイルとして書き込む
+    with storage_overlay() as overlay:
+        append_day_executions('BTC_JPY', target_date, _executions(11, start + datetime.timedelta(minutes=10), 4))
+        append_day_executions('BTC_JPY', target_date, _executions(15, start + datetime.timedelta(minutes=14), 4))
+
+        assert str(p_row_dir.joinpath('all.csv')) not in overlay
+        assert len(list_files(p_row_dir.joinpath(APPENDED_DIR))) == 2
+        assert read_day_rows(p_row_dir)['id'].tolist() == list(range(1, 19))
+        assert open_tape('BTC_JPY', target_date).records['id'].tolist() == list(range(1, 19))
+
+        report = compact_row_data('BTC_JPY', datetime.datetime(2026, 1, 20, tzinfo=JST))
+
+        assert report['rows'] == 18
+        assert list_files(p_row_dir) == []
+        assert list_files(tape_appended_dir(p_tape_path)) == []
+        assert np.frombuffer(read_bytes(p_tape_path), dtype=TAPE_DTYPE)['id'].tolist() == list(range(1, 19))
+        assert sorted(load_row_archive('BTC_JPY', 2026, 1)['id']) == list(range(1, 19))
+
+
+def test_now_price_falls_back_to_day_summary_without_bars(local_storage):
+    current_datetime = datetime.datetime(2026, 1, 5, 12, tzinfo=JST)
+    p_summary_path = local_storage.joinpath('execute_history', 'BTC_JPY', '2026', '01', '04', 'summary.csv')
+    p_summary_path.parent.mkdir(parents=True)
+    pd.DataFrame(
+        {'BUY': [4000000.0, 4100000.0, 3900000.0, 4050000.0], 'SELL': [4000000.0, 4100000.0, 3900000.0, 4040000.0]},
+        index=pd.Index(BAR_PRICE_COLUMNS, name='CATEGORY'),
+    ).to_csv(p_summary_path)
+
+    latest_summary = LatestSummary('BTC_JPY', current_datetime)
+    df_empty = pd.DataFrame(columns=BAR_PRICE_COLUMNS, index=pd.DatetimeIndex([], tz='UTC'))
+    latest_summary._bars = (df_empty, df_empty)
+
+    assert latest_summary['BUY']['now']['price'] == 4050000
+    assert latest_summary['SELL']['6h']['price']['close'] == 4040000
@@ -0,0 +1,203 @@
+import hashlib
+import hmac
+import json
+import socket
+import threading
+import time
+
+import pytest
+
+from backtest import NullNotifier
+from lease import StorageLease
+from ledger import OrderLedger
+from manage import ORDERS_LEASE_NAME
+from realtime import (OPCODE_TEXT, LocalOrderEventServer, OrderEventSubscriber,
+                      WebSocket, make_order_event)
+
+
+class FakeBook:
+    """保存済みの注文履歴と取引所の注文の状態(AIの作成をまたいで保持する)"""
+
+    def __init__(self):
+        self.ledgers = {term: OrderLedger() for term in ['long', 'short', 'dca']}
+        self.states = {}
+        self.calls = []
+
+    def add_order(self, term, child_order_acceptance_id, side='BUY', cycle='daily'):
+        self.ledgers[term].upsert(child_order_acceptance_id, {
+            'side': side,
+            'child_order_state': 'ACTIVE',
+            'child_order_cycle': cycle,
+            'related_child_order_acceptance_id': 'no_id',
+        })
+        self.states[child_order_acceptance_id] = 'ACTIVE'
+
+
+class FakeAI:
+    def __init__(self, book):
+        self.book = book
+        self.ledgers = book.ledgers
+        self.line_notify = NullNotifier()
+
+    def load_latest_child_orders(self, term, child_order_cycle, child_order_acceptance_id,
+                                 related_child_order_acceptance_id='no_id'):
+        self.book.calls.append(('load', child_order_acceptance_id))
+        self.ledgers[term].upsert(child_order_acceptance_id, {
+            'child_order_state': self.book.states[child_order_acceptance_id],
+        })
+
+    def update_child_orders(self, term):
+        self.book.calls.append(('update', term))
+        for record in self.ledgers[term].select(state='ACTIVE'):
+            self.ledgers[term].upsert(record.child_order_acceptance_id, {
+                'child_order_state': self.book.states[record.child_order_acceptance_id],
+            })
+
+    def sell_filled(self, child_order_cycle):
+        self.book.calls.append(('sell_filled', child_order_cycle))
+        for record in self.ledgers['short'].select(side='BUY', state='COMPLETED', cycle=child_order_cycle):
+            self.ledgers['short'].upsert(record.child_order_acceptance_id, {
+                'related_child_order_acceptance_id': 'JRF_SELL',
+            })
+
+    def commit(self):
+        self.book.calls.append(('commit',))
+
+    def close(self):
+        pass
+
+
+def _wait_for(condition, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+@pytest.fixture
+def server():
+    server = LocalOrderEventServer().start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def book():
+    return FakeBook()
+
+
+@pytest.fixture
+def run_subscriber(local_storage, server, book):
+    """OrderEventSubscriberを別スレッドで実行する(テストの終了時に停止する)"""
+    stop_event = threading.Event()
+    threads = []
+
+    def run(**kwargs):
+        subscriber = OrderEventSubscriber(
+            'BTC_JPY',
+            lambda latest_summary: FakeAI(book),
+            lambda: {},
+            url=server.url,
+            api_key='key',
+            api_secret='secret',
+            **{'receive_timeout': 30, 'reconnect_delays': (0,), **kwargs}
+        )
+        thread = threading.Thread(target=subscriber.run, args=(stop_event,), daemon=True)
+        thread.start()
+        threads.append(thread)
+        assert server.wait_subscribed()
+        # 接続直後のreconcileが終わるまで待つ
+        assert _wait_for(lambda: ('commit',) in book.calls)
+        return subscriber
+
+    yield run
+    stop_event.set()
+    server.drop_connections()
+    for thread in threads:
+        thread.join(timeout=10)
+
+
+def test_subscriber_authenticates_and_subscribes(run_subscriber, server):
+    run_subscriber()
+
+    assert len(server.auth_requests) == 1
+    params = server.auth_requests[0]
+    assert params['api_key'] == 'key'
+    expected = hmac.new(b'secret', f'{params["timestamp"]}{params["nonce"]}'.encode('utf-8'), hashlib.sha256)
+    assert params['signature'] == expected.hexdigest()
+
+
+def test_execution_event_refreshes_order_and_sells(run_subscriber, server, book):
+    book.add_order('short', 'JRF1')
+    run_subscriber()
+
+    book.states['JRF1'] = 'COMPLETED'
+    server.emit([make_order_event('BTC_JPY', 'JRF1', 'EXECUTION', price=4000000, size=0.01)])
+
+    assert _wait_for(lambda: ('sell_filled', 'daily') in book.calls)
+    assert ('load', 'JRF1') in book.calls
+    assert book.ledgers['short'].get('JRF1').child_order_state == 'COMPLETED'
+
+
+def test_reconnects_and_reconciles_after_disconnect(run_subscriber, server, book):
+    book.add_order('short', 'JRF1')
+    run_subscriber()
+    assert book.calls.count(('update', 'short')) == 1
+
+    # 切断されている間に約定した
+    book.states['JRF1'] = 'COMPLETED'
+    server.drop_connections()
+
+    assert _wait_for(lambda: len(server.auth_requests) == 2)
+    assert _wait_for(lambda: ('sell_filled', 'daily') in book.calls)
+    assert book.calls.count(('update', 'short')) == 2
+
+
+def test_events_skipped_while_leased_are_reconciled_on_next_message(run_subscriber, server, book):
+    book.add_order('short', 'JRF1')
+    run_subscriber(lease_timeout=0.1)
+
+    lease = StorageLease(ORDERS_LEASE_NAME, settle=0)
+    assert lease.acquire(timeout=1)
+    book.states['JRF1'] = 'COMPLETED'
+    server.emit([make_order_event('BTC_JPY', 'JRF1', 'EXECUTION', price=4000000, size=0.01)])
+    time.sleep(1)
+    lease.release()
+    assert ('sell_filled', 'daily') not in book.calls
+
+    # 反映対象でないイベントでも、受信した時点でreconcileする
+    server.emit([make_order_event('BTC_JPY', 'JRF2', 'ORDER', price=4000000, size=0.01)])
+    assert _wait_for(lambda: ('sell_filled', 'daily') in book.calls)
+
+
+class CaptureSocket:
+    """送信したバイト列を保持する(フレームを分割して送るため)"""
+
+    def __init__(self):
+        self.data = b''
+
+    def sendall(self, data):
+        self.data += data
+
+
+def test_recv_keeps_partial_frame_after_timeout():
+    client_sock, server_sock = socket.socketpair()
+    try:
+        ws = WebSocket(client_sock, mask=False)
+        ws.settimeout(0.1)
+        text = json.dumps({'message': 'x' * 200})
+        capture = CaptureSocket()
+        WebSocket(capture, mask=True)._send_frame(OPCODE_TEXT, text.encode('utf-8'))
+        frame = capture.data
+
+        # ヘッダーの途中までのみ届いた状態でタイムアウトする
+        server_sock.sendall(frame[:3])
+        with pytest.raises(socket.timeout):
+            ws.recv()
+        server_sock.sendall(frame[3:])
+        assert ws.recv() == text
+    finally:
+        client_sock.close()
+        server_sock.close()
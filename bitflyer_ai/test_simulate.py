@@ -0,0 +1,57 @@
+import datetime
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+from clock import JST
+from preprocess import save_day_executions
+from simulate import run_schedule
+
+
+def _executions(target_date, first_id, rng):
+    """1分ごとに買い・売りが1件ずつ約定した1日分の約定履歴"""
+    start = pd.Timestamp(target_date, tz=JST).tz_convert('UTC')
+    times = pd.date_range(start, periods=24 * 60, freq='min').repeat(2)
+    prices = 5000000 + np.cumsum(rng.normal(0, 1000, len(times))).round()
+    df = pd.DataFrame({
+        'id': np.arange(first_id, first_id + len(times)),
+        'side': ['BUY', 'SELL'] * (len(times) // 2),
+        'price': prices,
+        'size': 0.01,
+        'buy_child_order_acceptance_id': 'JRF_BUY',
+        'sell_child_order_acceptance_id': 'JRF_SELL',
+    }, index=pd.Index(times, name='exec_date'))
+    return df
+
+
+def _snapshot(p_root):
+    return {
+        str(p.relative_to(p_root)): hashlib.md5(p.read_bytes()).hexdigest()
+        for p in sorted(p_root.rglob('*')) if p.is_file()
+    }
+
+
+def test_run_schedule_leaves_storage_unchanged(local_storage):
+    rng = np.random.default_rng(0)
+    first_date = datetime.date(2026, 1, 1)
+    for i in range(10):
+        save_day_executions('BTC_JPY', first_date + datetime.timedelta(days=i),
+                            _executions(first_date + datetime.timedelta(days=i), i * 10000, rng))
+    p_row_path = local_storage.joinpath('execute_history', 'BTC_JPY', '2026', '01', '01', 'row', 'all.csv')
+    assert p_row_path.exists()
+    before = _snapshot(local_storage)
+
+    # 1/1の生データは保持期間を過ぎているため、trading内のcompact_row_dataで圧縮される
+    start = datetime.datetime(2026, 1, 10, 1, tzinfo=JST)
+    env = {
+        'MAX_BUY_PRICE_RATE_IN_LONG': 1.0,
+        'MAX_BUY_PRICE_RATE_IN_SHORT': 1.0,
+        'MAX_BUY_PRICE_RATE_IN_DCA': 1.0,
+        'BTC_JPY_MIN_SIZE': 0.001,
+    }
+    run_schedule('BTC_JPY', start, start + datetime.timedelta(hours=2), warmup_days=2, env=env)
+
+    assert p_row_path.exists()
+    assert _snapshot(local_storage) == before
+    assert sorted(p.name for p in local_storage.iterdir()) == ['execute_history']
@@ -1,35 +1,460 @@
+import datetime
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from logging import getLogger
+from pathlib import Path
+
 import pandas as pd
 
-from manage import REF_LOCAL
+import clock
+from manage import (CACHE_DIR, CACHE_MAX_BYTES, CACHE_SEALED_GRACE_DAYS,
+                    EXECUTION_HISTORY_DIR, REF_LOCAL)
+
+logger = getLogger(__name__)
 
 if not REF_LOCAL:
     from aws import S3
     s3 = S3()
 
+# execute_history/<product_code>/YYYY[/MM[/DD]]/<file>
+SEALED_PARTITION_PATTERN = re.compile(
+    rf'^{EXECUTION_HISTORY_DIR}/[^/]+/(\d{{4}})(?:/(\d{{2}}))?(?:/(\d{{2}}))?/'
+)
+
+
+def is_sealed(object_key, current_datetime=None):
+    """過去の期間に属し、今後更新されないパーティションかどうか
+
+    日・月・年のパーティションは、その期間の終了から
+    CACHE_SEALED_GRACE_DAYS日が経過すると封印済みとみなす。
+    猶予日数は、前日分の集計更新や生データの圧縮に要する期間をカバーする。
+    """
+    match = SEALED_PARTITION_PATTERN.match(str(object_key))
+    if match is None:
+        return False
+
+    if current_datetime is None:
+        current_datetime = clock.now()
+
+    year, month, day = match.groups()
+    if day is not None:
+        period_end = datetime.date(int(year), int(month), int(day)) + datetime.timedelta(days=1)
+    elif month is not None:
+        if int(month) == 12:
+            period_end = datetime.date(int(year) + 1, 1, 1)
+        else:
+            period_end = datetime.date(int(year), int(month) + 1, 1)
+    else:
+        period_end = datetime.date(int(year) + 1, 1, 1)
+
+    sealed_date = period_end + datetime.timedelta(days=CACHE_SEALED_GRACE_DAYS)
+    return sealed_date <= current_datetime.date()
+
+
+class DiskCache:
+    """S3オブジェクトのローカルディスクキャッシュ
+
+    - 封印済みパーティションは、プロセス(コンテナ)ごとに最初の1回だけETagで再検証する
+      (インポートや遅れて実行された圧縮で、封印後に書き換えられる場合があるため)
+    - それ以外のキーは毎回ETagによる条件付きGETで検証する
+    - 合計サイズがmax_bytesを超えた場合、最も長く使われていないものから削除する
+
+    ウォームコンテナでは/tmpとモジュールが再利用されるため、
+    呼び出しをまたいでキャッシュが有効になる。
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR, max_bytes=CACHE_MAX_BYTES):
+        self.p_cache_dir = Path(cache_dir)
+        self.p_cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        # object_key -> {'etag', 'size', 'immutable'} (LRU順)
+        self.entries = OrderedDict()
+        # このプロセスでS3と一致することを確認したキー
+        self.validated = set()
+        self._load_index()
+
+    def _entry_path(self, object_key):
+        digest = hashlib.sha1(object_key.encode('utf-8')).hexdigest()
+        # 拡張子を残し、pandasが圧縮形式を推定できるようにする
+        suffix = ''.join(Path(object_key).suffixes)
+        return self.p_cache_dir.joinpath(digest + suffix)
+
+    def _meta_path(self, object_key):
+        p_entry_path = self._entry_path(object_key)
+        return p_entry_path.with_name(p_entry_path.name + '.meta')
+
+    def _load_index(self):
+        metas = []
+        for p_meta_path in self.p_cache_dir.glob('*.meta'):
+            try:
+                with open(p_meta_path) as f:
+                    meta = json.load(f)
+                metas.append((p_meta_path.stat().st_mtime, meta))
+            except (OSError, ValueError):
+                continue
+        for _, meta in sorted(metas, key=lambda x: x[0]):
+            if self._entry_path(meta['key']).exists():
+                self.entries[meta['key']] = {
+                    'etag': meta['etag'],
+                    'size': meta['size'],
+                    'immutable': meta['immutable'],
+                }
+
+    def _store_meta(self, object_key):
+        entry = self.entries[object_key]
+        meta = {'key': object_key}
+        meta.update(entry)
+        with open(self._meta_path(object_key), 'w') as f:
+            json.dump(meta, f)
+
+    def _evict(self):
+        total_size = sum(entry['size'] for entry in self.entries.values())
+        while total_size > self.max_bytes and len(self.entries) > 1:
+            object_key, entry = self.entries.popitem(last=False)
+            total_size -= entry['size']
+            for p_path in [self._entry_path(object_key), self._meta_path(object_key)]:
+                if p_path.exists():
+                    p_path.unlink()
+            logger.debug(f'[{object_key}] キャッシュから削除しました。')
+
+    def contains_sealed(self, object_key):
+        """このプロセスで検証済みの封印済みパーティションかどうか"""
+        with self.lock:
+            entry = self.entries.get(object_key)
+            return entry is not None and entry['immutable'] and object_key in self.validated
+
+    def get(self, object_key):
+        """キャッシュ済み(必要なら検証済み)のローカルパスを返す"""
+        with self.lock:
+            entry = self.entries.get(object_key)
+            immutable = is_sealed(object_key)
+            fresh = entry is not None and (entry['immutable'] or immutable) and object_key in self.validated
+
+        p_entry_path = self._entry_path(object_key)
+        changed = False
+        if fresh:
+            hit = True
+        else:
+            p_tmp_path = p_entry_path.with_name(p_entry_path.name + f'.{threading.get_ident()}.tmp')
+            etag = s3.download(
+                object_key,
+                str(p_tmp_path),
+                if_none_match=None if entry is None else entry['etag']
+            )
+            hit = etag is None
+            if not hit:
+                os.replace(p_tmp_path, p_entry_path)
+                entry = {
+                    'etag': etag,
+                    'size': p_entry_path.stat().st_size,
+                    'immutable': immutable,
+                }
+                changed = True
+
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+            self.validated.add(object_key)
+            if immutable and not entry['immutable']:
+                entry['immutable'] = True
+                changed = True
+            self.entries[object_key] = entry
+            self.entries.move_to_end(object_key)
+            if changed:
+                self._store_meta(object_key)
+            else:
+                # 内容が変わらない場合はメタデータを書き直さず、LRUの順序(更新日時)のみを更新する
+                os.utime(self._meta_path(object_key))
+            self._evict()
+        return p_entry_path
+
+    def put(self, object_key, body, etag):
+        """書き込んだ内容をキャッシュにも反映する(write-through)"""
+        p_entry_path = self._entry_path(object_key)
+        p_tmp_path = p_entry_path.with_name(p_entry_path.name + f'.{threading.get_ident()}.tmp')
+        with open(p_tmp_path, 'wb') as f:
+            f.write(body)
+        os.replace(p_tmp_path, p_entry_path)
+        with self.lock:
+            self.entries[object_key] = {
+                'etag': etag,
+                'size': len(body),
+                'immutable': is_sealed(object_key),
+            }
+            self.entries.move_to_end(object_key)
+            self.validated.add(object_key)
+            self._store_meta(object_key)
+            self._evict()
+
+    def invalidate(self, object_key):
+        with self.lock:
+            self.entries.pop(object_key, None)
+            self.validated.discard(object_key)
+            for p_path in [self._entry_path(object_key), self._meta_path(object_key)]:
+                if p_path.exists():
+                    p_path.unlink()
+
+    def invalidate_prefix(self, prefix):
+        with self.lock:
+            object_keys = [key for key in self.entries.keys() if key.startswith(prefix)]
+        for object_key in object_keys:
+            self.invalidate(object_key)
+
+
+if not REF_LOCAL:
+    cache = DiskCache()
+
+
+class StorageOverlay:
+    """ストレージへの書き込みをメモリ上に保持する上書き層
+
+    読み込みは、上書き層に書き込まれたファイルがあればそれを返し、
+    なければ元のストレージ(ローカル or S3)から読み込む。
+    バックテストなどで実データを読みつつ、注文履歴などの書き込みを外部に出さないために使う。
+    """
+
+    def __init__(self):
+        # path -> bytes(削除済みの場合はNone)
+        self.files = {}
+
+    def __contains__(self, p_path):
+        return str(p_path) in self.files
+
+    def exists(self, p_path):
+        return self.files[str(p_path)] is not None
+
+    def read(self, p_path):
+        body = self.files[str(p_path)]
+        if body is None:
+            raise FileNotFoundError(str(p_path))
+        return body
+
+    def write(self, p_path, body):
+        self.files[str(p_path)] = body
+        return len(body)
+
+    def delete(self, p_path):
+        self.files[str(p_path)] = None
+
+
+_overlay = None
+
+
+@contextmanager
+def storage_overlay():
+    """withブロック内の書き込みをStorageOverlayに向ける"""
+    global _overlay
+    previous_overlay = _overlay
+    _overlay = StorageOverlay()
+    try:
+        yield _overlay
+    finally:
+        _overlay = previous_overlay
+
 
 def path_exists(p_path):
+    if _overlay is not None and p_path in _overlay:
+        return _overlay.exists(p_path)
     if REF_LOCAL:
         return p_path.exists()
     else:
+        if cache.contains_sealed(str(p_path)):
+            return True
         return s3.key_exists(str(p_path))
 
 
 def rm_file(p_path):
+    if _overlay is not None:
+        return _overlay.delete(p_path)
     if REF_LOCAL:
         return p_path.unlink()
     else:
+        cache.invalidate(str(p_path))
         return s3.delete_file(str(p_path))
 
 
-def read_csv(p_path):
+def rm_dir(p_path):
+    """ディレクトリ(S3ではprefix)以下を全て削除する
+
+    storage_overlayの中では、元のストレージは変更せず、削除を上書き層に記録する。
+
+    Returns:
+        int: 削除したファイル数
+    """
+    if _overlay is not None:
+        deleted_paths = list_files(p_path)
+        for path in deleted_paths:
+            _overlay.delete(path)
+        return len(deleted_paths)
+    if REF_LOCAL:
+        if not p_path.is_dir():
+            return 0
+        deleted_count = len([p for p in p_path.rglob('*') if p.is_file()])
+        shutil.rmtree(p_path)
+        return deleted_count
+    else:
+        prefix = str(p_path) + '/'
+        cache.invalidate_prefix(prefix)
+        return s3.delete_dir(prefix)
+
+
+def _list_storage_files(p_dir):
+    if REF_LOCAL:
+        if not p_dir.is_dir():
+            return []
+        return [str(p) for p in p_dir.rglob('*') if p.is_file()]
+    else:
+        return s3.list_keys(str(p_dir) + '/')
+
+
+def list_files(p_dir):
+    """ディレクトリ(S3ではprefix)以下の全てのファイルパスを返す
+
+    storage_overlayの中では、上書き層で削除したファイルを除き、書き込んだファイルを加える。
+    """
+    paths = set(_list_storage_files(p_dir))
+    if _overlay is not None:
+        prefix = str(p_dir) + '/'
+        for path, body in _overlay.files.items():
+            if not path.startswith(prefix):
+                continue
+            if body is None:
+                paths.discard(path)
+            else:
+                paths.add(path)
+    return sorted(paths)
+
+
+def local_path(p_path):
+    """ローカルで読み込めるパスを返す(S3の場合はキャッシュ上のパス)"""
+    if REF_LOCAL:
+        return Path(p_path)
+    else:
+        return cache.get(str(p_path))
+
+
+def read_bytes(p_path):
+    if _overlay is not None and p_path in _overlay:
+        return _overlay.read(p_path)
+    if REF_LOCAL:
+        return Path(p_path).read_bytes()
+    else:
+        return cache.get(str(p_path)).read_bytes()
+
+
+def write_bytes(p_path, body):
+    if _overlay is not None:
+        return _overlay.write(p_path, body)
+    if REF_LOCAL:
+        Path(p_path).parent.mkdir(parents=True, exist_ok=True)
+        return Path(p_path).write_bytes(body)
+    else:
+        uploaded = s3.put_bytes(str(p_path), body)
+        cache.put(str(p_path), body, s3.etags.get(str(p_path)))
+        return uploaded
+
+
+def writes_in_place():
+    """ローカルのファイルを直接更新できるかどうか(ローカル、かつstorage_overlayの外)"""
+    return REF_LOCAL and _overlay is None
+
+
+def append_bytes(p_path, body):
+    """ファイルの末尾にbodyを追記する
+
+    S3は追記に対応していないため、キャッシュ済みの既存内容と結合して書き込む。
+    """
+    if writes_in_place():
+        Path(p_path).parent.mkdir(parents=True, exist_ok=True)
+        with open(p_path, 'ab') as f:
+            return f.write(body)
+    else:
+        if path_exists(p_path):
+            body = read_bytes(p_path) + body
+        return write_bytes(p_path, body)
+
+
+def read_json(p_path):
+    return json.loads(read_bytes(p_path).decode('utf-8'))
+
+
+def write_json(p_path, obj):
+    return write_bytes(p_path, json.dumps(obj, ensure_ascii=False, sort_keys=True).encode('utf-8'))
+
+
+def append_csv(p_path, df, index=True):
+    """csvの末尾に行を追記する(既存の行は読み込まない)"""
+    body = df.to_csv(index=index, header=not path_exists(p_path)).encode('utf-8')
+    return append_bytes(p_path, body)
+
+
+def read_csv(p_path, usecols=None, chunksize=None, compression='infer'):
+    if _overlay is not None and p_path in _overlay:
+        if compression == 'infer':
+            compression = 'gzip' if str(p_path).endswith('.gz') else None
+        return pd.read_csv(
+            io.BytesIO(_overlay.read(p_path)),
+            usecols=usecols,
+            chunksize=chunksize,
+            compression=compression
+        )
     if REF_LOCAL:
-        return pd.read_csv(p_path)
+        return pd.read_csv(p_path, usecols=usecols, chunksize=chunksize, compression=compression)
     else:
-        return s3.read_csv(p_path)
+        p_local_path = cache.get(str(p_path))
+        return pd.read_csv(
+            p_local_path,
+            usecols=usecols,
+            chunksize=chunksize,
+            compression=compression,
+            memory_map=compression in ['infer', None] and not str(p_path).endswith('.gz')
+        )
+
+
+def iter_csv(p_path, chunksize=100000, usecols=None):
+    """csvをchunksize行ずつ読み込むジェネレータ
+
+    巨大なrow/all.csvを一度にメモリへ載せずに処理するために使う。
+    S3の場合はキャッシュを経由せず、ダウンロードしながら最初の行から処理する
+    (読み込んだ後に削除するファイルをキャッシュに残さない)。
+    """
+    if REF_LOCAL or (_overlay is not None and p_path in _overlay):
+        reader = read_csv(p_path, usecols=usecols, chunksize=chunksize)
+        with reader:
+            for df_chunk in reader:
+                yield df_chunk
+    else:
+        yield from s3.iter_csv(str(p_path), chunksize=chunksize, usecols=usecols)
 
 
 def df_to_csv(path, df, index=True):
+    if _overlay is not None:
+        return _overlay.write(path, df.to_csv(index=index).encode('utf-8'))
     if REF_LOCAL:
         return df.to_csv(path, index=index)
     else:
-        return s3.to_csv(path, df, index=index)
+        body = df.to_csv(index=index).encode('utf-8')
+        uploaded = s3.put_bytes(str(path), body)
+        cache.put(str(path), body, s3.etags.get(str(path)))
+        return uploaded
+
+
+def report_write_stats():
+    """ストレージへの書き込み回数と省略した書き込みを出力する"""
+    if REF_LOCAL:
+        return {}
+    else:
+        logger.info(f'[cache] ヒット: {cache.hits}回, ミス: {cache.misses}回')
+        return s3.report_write_stats()